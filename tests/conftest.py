@@ -3,7 +3,9 @@ from pytest_mysql import factories
 from contextlib import contextmanager
 from neo4j import GraphDatabase
 from pytest_mysql.executor_noop import NoopMySQLExecutor
+from datetime import date
 from traits.implementation import TraitsUtility
+from traits.timetable import Trip, compile_timetable
 
 # Default configurations
 from base.traits.interface import BASE_USER_NAME, BASE_USER_PASS, ADMIN_USER_NAME, ADMIN_USER_PASS
@@ -172,3 +174,137 @@ def neo4j_db(neo4j_db_host, neo4j_db_port):
         yield driver
 
         records, summary, keys = driver.execute_query("MATCH (a) DETACH DELETE a")
+
+
+################################################################################
+# Fakes and builders of the unit tests
+################################################################################
+class FakeCursor:
+    """
+    Cursor of a FakeConnection: records the parameters of the statements and answers with the rows of the
+    connection, or with the parameters of the last statement if it has none. Like the prepared cursors of
+    mysql-connector, the handle is only reused for the very same string. Savepoints mark the pending changes
+    of the connection
+    """
+
+    def __init__(self, connection, prepared=False):
+        self.connection = connection
+        self.prepared = prepared
+        self.prepares = 0
+        self.statement = None
+        self.executed = []
+        self.closed = False
+
+    def execute(self, statement, params=()):
+        if statement.startswith("SAVEPOINT "):
+            self.connection.savepoints[statement.split()[-1]] = len(self.connection.changes)
+        elif statement.startswith("ROLLBACK TO SAVEPOINT "):
+            del self.connection.changes[self.connection.savepoints[statement.split()[-1]]:]
+        if statement is not self.statement:
+            self.statement = statement
+            self.prepares += 1
+        self.executed.append(params)
+
+    def executemany(self, statement, rows):
+        for row in rows:
+            self.execute(statement, row)
+
+    def fetchall(self):
+        if self.connection.rows is None:
+            return [self.executed[-1]]
+        return list(self.connection.rows)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    """
+    Connection answering every query with rows. The changes are pending until commit, which hands them to
+    on_commit, rollback drops them. A broken connection fails to roll back
+    """
+
+    def __init__(self, rows=None, on_commit=None):
+        self.rows = None if rows is None else list(rows)
+        self.on_commit = on_commit
+        self.cursors = []
+        self.changes = []
+        self.savepoints = {}
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+        self.broken = False
+
+    def cursor(self, prepared=False):
+        self.cursors.append(FakeCursor(self, prepared))
+        return self.cursors[-1]
+
+    def commit(self):
+        if self.on_commit is not None:
+            self.on_commit(self.changes)
+        self.changes = []
+        self.commits += 1
+
+    def rollback(self):
+        if self.broken:
+            raise ConnectionError("Lost connection")
+        self.changes = []
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class PlainFakeConnection(FakeConnection):
+    """
+    Like PyMySQL connections: cursor() has no prepared mode
+    """
+
+    def cursor(self):
+        return super().cursor()
+
+
+@pytest.fixture
+def fake_connection():
+    """
+    Return the FakeConnection class, a factory of fake RDBMS connections
+    """
+    return FakeConnection
+
+
+@pytest.fixture
+def plain_connection():
+    """
+    Return the PlainFakeConnection class, fake RDBMS connections without prepared cursors
+    """
+    return PlainFakeConnection
+
+
+@pytest.fixture
+def make_trip():
+    """
+    Return a builder of Trips: the train leaves the first station at start (minutes) and takes travel_time
+    minutes between two stations, waiting waiting_time minutes at each one
+    """
+    def build(schedule_id, train_id, stations, start, travel_time=10, waiting_time=0,
+              valid_from=date(2024, 1, 1), valid_until=date(2024, 12, 31)):
+        arrivals, departures = [], []
+        clock = start
+        for i in range(len(stations)):
+            if i > 0:
+                clock += travel_time
+            arrivals.append(clock)
+            clock += waiting_time
+            departures.append(clock)
+        return Trip(schedule_id, train_id, valid_from, valid_until, stations, arrivals, departures)
+    return build
+
+
+@pytest.fixture
+def make_timetable():
+    """
+    Return a builder of the Timetable of the given Trips
+    """
+    def build(*trips):
+        return compile_timetable(trips)
+    return build
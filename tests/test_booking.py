@@ -0,0 +1,101 @@
+from threading import Event
+
+import pytest
+
+from traits.booking import BookingCoordinator
+
+
+class FakeDatabase:
+    """
+    Seats left per schedule, changed by the bookings of a connection only when it commits
+    """
+
+    def __init__(self, seats, fake_connection):
+        self.seats = seats
+        self.fake_connection = fake_connection
+        self.connections = []
+
+    def connect(self):
+        self.connections.append(self.fake_connection(on_commit=self.book))
+        return self.connections[-1]
+
+    def book(self, changes):
+        for schedule, seats in changes:
+            self.seats[schedule] -= seats
+
+
+class FakeStatements:
+
+    def close(self, connection):
+        pass
+
+
+class FakeTraits:
+
+    def __init__(self, database):
+        self.database = database
+        self.blocked = {}
+        self.schedules = {}
+        self.statements = FakeStatements()
+
+    def resolve_schedule_id(self, connection):
+        return self.schedules[connection["train_id"], connection["departure_date"]]
+
+    def _book(self, db, user_emails, connection, also_reserve_seats):
+        schedule = connection["schedule_id"]
+        if schedule in self.blocked:
+            self.blocked[schedule].wait(5)
+        taken = sum(seats for booked, seats in db.changes if booked == schedule)
+        if also_reserve_seats:
+            db.changes.append((schedule, len(user_emails)))
+            if self.database.seats[schedule] - taken < len(user_emails):
+                raise ValueError("No available seats for reservation")
+        return list(range(len(user_emails)))
+
+
+def test_booking_coordinator_batches_per_schedule(fake_connection):
+    database = FakeDatabase({0: 3}, fake_connection)
+    with BookingCoordinator(FakeTraits(database), database.connect, stripes=2) as coordinator:
+        futures = [coordinator.submit(["a@test.at", "b@test.at"], {"schedule_id": 0}) for _ in range(3)]
+        futures.append(coordinator.submit(["c@test.at"], {"schedule_id": 0}))
+        assert futures[0].result() == [0, 1]
+        for future in futures[1:3]:
+            with pytest.raises(ValueError):
+                future.result()
+        assert futures[3].result() == [0]
+        stats = coordinator.stats()
+    assert database.seats == {0: 0}
+    assert stats["submitted"] == 4 and stats["completed"] == 4 and stats["failed"] == 2
+    assert stats["active_stripes"] == 1 and stats["batches"] <= 4
+    assert 0 <= stats["contention"] <= 1
+    assert all(connection.closed for connection in database.connections)
+    with pytest.raises(ValueError):
+        coordinator.submit(["a@test.at"], {"schedule_id": 0})
+
+
+def test_booking_coordinator_isolates_stripes(fake_connection):
+    database = FakeDatabase({0: 10, 1: 10}, fake_connection)
+    traits = FakeTraits(database)
+    traits.blocked[0] = Event()
+    with BookingCoordinator(traits, database.connect, stripes=2) as coordinator:
+        assert coordinator.stripe({"schedule_id": 0}) != coordinator.stripe({"schedule_id": 1})
+        hot = [coordinator.submit(["a@test.at"], {"schedule_id": 0}) for _ in range(3)]
+        # The hot schedule is stuck, the other stripe keeps booking
+        assert coordinator.buy_tickets(["b@test.at"], {"schedule_id": 1}) == [0]
+        assert not any(future.done() for future in hot)
+        assert coordinator.stats()["contention"] > 0
+        traits.blocked[0].set()
+        assert [future.result() for future in hot] == [[0], [0], [0]]
+    assert database.seats == {0: 7, 1: 9}
+
+
+def test_booking_coordinator_resolves_schedules(fake_connection):
+    database = FakeDatabase({0: 10, 1: 10}, fake_connection)
+    traits = FakeTraits(database)
+    traits.schedules = {(1, "2024-01-01"): 0, (1, "2024-01-02"): 1}
+    with BookingCoordinator(traits, database.connect, stripes=2) as coordinator:
+        # Booked by train and date or by id, a schedule lands on the same stripe
+        by_train = {"train_id": 1, "departure_date": "2024-01-02"}
+        assert coordinator.stripe(by_train) == coordinator.stripe({"schedule_id": 1})
+        assert coordinator.buy_tickets(["a@test.at"], by_train) == [0]
+    assert database.seats == {0: 10, 1: 9}
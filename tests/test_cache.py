@@ -0,0 +1,97 @@
+from traits import implementation
+from traits.cache import LRUCache
+from traits.graph import StationGraph
+from traits.implementation import Traits, TraitsUtility
+
+
+def test_lru_cache_eviction_and_counters():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 3, "misses": 1, "evictions": 1, "invalidations": 0}
+    assert cache.invalidate(lambda key, value: value > 2) == 1
+    assert cache.get("c", []) == []
+
+
+def test_lru_cache_ttl():
+    now = [0.0]
+    cache = LRUCache(maxsize=10, ttl=5, clock=lambda: now[0])
+    cache.put("a", 1)
+    now[0] = 5.0
+    assert cache.get("a") == 1
+    now[0] = 5.5
+    assert cache.get("a") is None
+    assert cache.evictions == 1 and len(cache) == 0
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(maxsize=0)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+
+
+class UsersCursor:
+
+    def __init__(self, users, queries):
+        self.users = users
+        self.queries = queries
+        self.rows = []
+
+    def execute(self, statement, params):
+        self.queries.append(params)
+        # The collation of users.email is case-insensitive
+        self.rows = [(email, user_id) for email, user_id in self.users.items()
+                     if email.casefold() in {param.casefold() for param in params}]
+
+    def fetchall(self):
+        return self.rows
+
+
+class UsersConnection:
+
+    def __init__(self, users):
+        self.users = users
+        self.queries = []
+
+    def cursor(self, prepared=False):
+        return UsersCursor(self.users, self.queries)
+
+
+def test_user_id_cache():
+    connection = UsersConnection({"a@test.at": 1, "b@test.at": 2})
+    utility = TraitsUtility(None, connection, None)
+    assert utility.resolve_user_ids(connection, ["a@test.at", "nobody@test.at"]) == {"a@test.at": 1,
+                                                                                     "nobody@test.at": None}
+    # Only the emails missing from the cache are looked up, the unregistered ones are never cached
+    assert utility.resolve_user_ids(connection, ["a@test.at", "b@test.at", "nobody@test.at"])["b@test.at"] == 2
+    assert utility.get_user_id("a@test.at") == 1
+    assert connection.queries == [("a@test.at", "nobody@test.at"), ("b@test.at", "nobody@test.at")]
+    # Registered meanwhile by another process
+    connection.users["nobody@test.at"] = 3
+    assert utility.get_user_id("nobody@test.at") == 3
+    # The cache is keyed by the casefold of the emails
+    assert utility.resolve_user_ids(connection, ["B@Test.at", "NOBODY@test.at"]) == {"B@Test.at": 2,
+                                                                                    "NOBODY@test.at": 3}
+    assert len(connection.queries) == 3
+    utility.user_ids.discard("a@test.at")
+    assert utility.user_ids.get("a@test.at") is None and utility.user_ids.stats()["invalidations"] == 1
+
+
+def test_dropped_lazy_load_is_not_kept(fake_connection, monkeypatch):
+    traits = Traits(None, fake_connection(), None)
+
+    def load_while_connecting(cursor):
+        # The stations get connected while the hierarchy is being built from the old connections
+        traits._drop_cached("_contraction_hierarchy")
+        return StationGraph([(1, 2, 10)])
+
+    monkeypatch.setattr(implementation, "load_connections_graph", load_while_connecting)
+    stale = traits._get_contraction_hierarchy()
+    assert stale is not None and traits._contraction_hierarchy is None
+    monkeypatch.setattr(implementation, "load_connections_graph", lambda cursor: StationGraph([(1, 2, 10)]))
+    hierarchy = traits._get_contraction_hierarchy()
+    assert traits._contraction_hierarchy is hierarchy and traits._get_contraction_hierarchy() is hierarchy
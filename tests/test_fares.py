@@ -0,0 +1,58 @@
+import pytest
+
+from traits.fares import DistanceFare, FareEngine, TravelTimeFare, ZoneFare
+from traits.graph import StationGraph
+from traits.journey import Journey, Leg
+from traits.routing import time_based_fare
+
+
+def make_graph():
+    return StationGraph([(1, 2, 10), (2, 3, 10), (1, 3, 25), (3, 4, 5)])
+
+
+def test_fare_models():
+    graph = make_graph()
+    by_time = FareEngine(graph, TravelTimeFare(10, base=100))
+    assert by_time.fare(1, 3) == 300
+    assert by_time.fare(1, 4) == 350
+    assert by_time.fare(4, 1) == 0
+    assert by_time.fare(1, 99) == 0
+    assert by_time.has_fare(1, 3) and not by_time.has_fare(4, 1) and not by_time.has_fare(1, 99)
+
+    by_distance = FareEngine(graph, DistanceFare(50))
+    assert by_distance.fare(1, 3) == 50
+    assert by_distance.fare(1, 4) == 100
+
+    by_zone = FareEngine(graph, ZoneFare({1: 1, 2: 1, 3: 2, 4: 3}, 200))
+    assert by_zone.fare(1, 2) == 200
+    assert by_zone.fare(4, 1) == 600
+
+    with pytest.raises(ValueError):
+        TravelTimeFare(-1)
+
+
+def test_fare_engine_tells_free_rides_from_unpriced_ones():
+    free = FareEngine(make_graph(), TravelTimeFare(0))
+    assert free.fare(1, 3) == 0 and free.has_fare(1, 3)
+    assert free.fare(4, 1) == 0 and not free.has_fare(4, 1)
+
+
+def test_fare_engine_prices_journeys():
+    engine = FareEngine(make_graph(), TravelTimeFare(10))
+    by_path = Journey([1, 2, 3, 4], 25, 2)
+    by_legs = Journey([1, 3, 4], 25, 1, legs=[Leg(1, 1, 1, 3, 480, 500), Leg(2, 2, 3, 4, 505, 510)])
+    assert engine.prices([by_path, by_legs, Journey([1], 0, 0)]).tolist() == [250, 250, 0]
+    assert engine.prices([]).tolist() == []
+    engine.price([by_path])
+    assert by_path.estimated_price == 250
+
+
+def test_fare_engine_leg_fare_matches_time_based_fare(make_trip, make_timetable):
+    timetable = make_timetable(make_trip(7, 1, [1, 2, 3], 480), make_trip(8, 2, [3, 4], 500, travel_time=5))
+    engine = FareEngine(make_graph(), TravelTimeFare(10))
+    for trip in range(timetable.n_trips):
+        stops = len(timetable.trip_stations(trip))
+        for board in range(stops - 1):
+            for alight in range(board + 1, stops):
+                assert engine.leg_fare(timetable, trip, board, alight) == \
+                    time_based_fare(timetable, trip, board, alight)
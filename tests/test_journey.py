@@ -0,0 +1,27 @@
+import pickle
+
+from traits.journey import Journey, Leg
+
+
+def make_journey():
+    legs = [Leg(7, 1, 10, 20, 480, 500), Leg(8, 2, 20, 30, 505, 530)]
+    return Journey([10, 20, 30], 50, 1, 5, 450, 480, 530, legs)
+
+
+def test_journey_reads_like_a_dict():
+    journey = make_journey()
+    assert journey["path"] == [10, 20, 30]
+    assert journey["legs"][1]["train_id"] == 2
+    assert journey.get("price") is None and "waiting_time" in journey
+    assert journey.to_dict()["legs"][0] == {"schedule_id": 7, "train_id": 1, "from_station_id": 10,
+                                            "to_station_id": 20, "departure_time": 480, "arrival_time": 500}
+    assert journey == journey.to_dict()
+
+
+def test_journey_serialization():
+    journey = make_journey()
+    assert Journey.from_tuple(journey.to_tuple()) == journey
+    restored = pickle.loads(pickle.dumps(journey))
+    assert restored == journey and restored.legs[0].arrival_time == 500
+    assert len(pickle.dumps(journey)) < len(pickle.dumps(journey.to_dict()))
+    assert not hasattr(journey, "__dict__")
@@ -1,4 +1,6 @@
 import pytest
+from datetime import date
+from traits.fares import ZoneFare
 from traits.implementation import *
 
 
@@ -281,3 +283,478 @@ def test_add_user_duplicate(rdbms_connection, rdbms_admin_connection):
     traits.add_user("duplicate@example.com", {"password": "test_pass", "is_admin": False})
     with pytest.raises(ValueError):
         traits.add_user("duplicate@example.com", {"password": "test_pass", "is_admin": False})
+
+def test_search_connections_csa(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_backend="csa")
+    traits.add_train(TraitsKey(1), 100, TrainStatus.OPERATIONAL)
+    traits.add_train(TraitsKey(2), 100, TrainStatus.OPERATIONAL)
+    for key, name in [(1, "Westbahnhof"), (2, "Floridsdorf"), (3, "Krems")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 40)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 0), (TraitsKey(2), 0)], 1, 1, 2024, 31, 12, 2024)
+    traits.add_schedule(TraitsKey(2), 8, 45, [(TraitsKey(2), 0), (TraitsKey(3), 0)], 1, 1, 2024, 31, 12, 2024)
+    connections = traits.search_connections(TraitsKey(1), TraitsKey(3), 15, 3, 2024)
+    assert len(connections) == 1
+    assert connections[0]["path"] == [1, 2, 3]
+    assert connections[0]["num_changes"] == 1
+    assert connections[0]["travel_time"] == 85
+    assert traits.search_connections(TraitsKey(1), TraitsKey(3), 15, 3, 2025) == []
+
+def test_unknown_search_backend(rdbms_connection, rdbms_admin_connection):
+    with pytest.raises(ValueError):
+        Traits(rdbms_connection, rdbms_admin_connection, None, search_backend="dijkstra")
+
+def test_station_validation_round_trips(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    traits.add_train_station(TraitsKey(1), {"name": "Westbahnhof", "location": "15 Bezirk"})
+    traits.add_train_station(TraitsKey(2), {"name": "Meidling", "location": "12 Bezirk"})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 10)
+    assert traits.round_trips["connect_train_stations"] == 1
+    traits.search_connections(TraitsKey(1), TraitsKey(2))
+    assert traits.round_trips["search_connections"] == 1
+
+    cold_traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_cache_size=0)
+    assert len(cold_traits.search_connections(TraitsKey(1), TraitsKey(2))) == 1
+    assert cold_traits.round_trips["search_connections"] == 2
+    cold_traits.search_connections(TraitsKey(1), TraitsKey(2))
+    assert cold_traits.round_trips["search_connections"] == 1
+    with pytest.raises(ValueError):
+        cold_traits.search_connections(TraitsKey(1), TraitsKey(9))
+
+def test_search_connections_cache(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_backend="csa")
+    traits.add_train(TraitsKey(1), 100, TrainStatus.OPERATIONAL)
+    for key, name in [(1, "Westbahnhof"), (2, "Floridsdorf")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 0), (TraitsKey(2), 0)], 1, 1, 2024, 31, 12, 2024)
+    assert len(traits.search_connections(TraitsKey(1), TraitsKey(2), 15, 3, 2024)) == 1
+    assert len(traits.search_connections(TraitsKey(1), TraitsKey(2), 15, 3, 2025)) == 0
+    assert len(traits.search_connections(TraitsKey(1), TraitsKey(2), 15, 3, 2024)) == 1
+    assert traits.round_trips["search_connections"] == 0
+    assert traits.search_cache.stats()["hits"] == 1
+
+    # Only the searches on the days of the new schedule are dropped
+    traits.add_schedule(TraitsKey(1), 9, 0, [(TraitsKey(1), 0), (TraitsKey(2), 0)], 1, 1, 2025, 31, 12, 2025)
+    assert traits.search_cache.stats()["invalidations"] == 1
+    assert len(traits.search_connections(TraitsKey(1), TraitsKey(2), 15, 3, 2025)) == 1
+    traits.update_train_details(TraitsKey(1), train_capacity=50)
+    assert len(traits.search_cache) == 0
+
+def test_search_connections_many(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_backend="csa")
+    traits.add_train(TraitsKey(1), 100, TrainStatus.OPERATIONAL)
+    for key, name in [(1, "Westbahnhof"), (2, "Floridsdorf"), (3, "Krems"), (4, "Tulln")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 40)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 0), (TraitsKey(2), 5), (TraitsKey(3), 0)],
+                        1, 1, 2024, 31, 12, 2024)
+    results = traits.search_connections_many(TraitsKey(1), [TraitsKey(3), TraitsKey(4), TraitsKey(2)], 15, 3, 2024)
+    assert [len(connections) for connections in results] == [1, 0, 1]
+    assert results[0][0]["path"] == [1, 2, 3]
+    assert results[0] == traits.search_connections(TraitsKey(1), TraitsKey(3), 15, 3, 2024)
+    assert traits.round_trips["search_connections"] == 0
+    with pytest.raises(ValueError):
+        traits.search_connections_many(TraitsKey(1), [TraitsKey(2), TraitsKey(1)])
+    with pytest.raises(ValueError):
+        traits.search_connections_many(TraitsKey(1), [TraitsKey(9)])
+
+def test_reachable_stations(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_backend="csa")
+    traits.add_train(TraitsKey(1), 100, TrainStatus.OPERATIONAL)
+    for key, name in [(1, "Westbahnhof"), (2, "Floridsdorf"), (3, "Krems")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 40)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 0), (TraitsKey(2), 0), (TraitsKey(3), 0)],
+                        1, 1, 2024, 31, 12, 2024)
+    assert traits.reachable_stations(TraitsKey(1), 60, date(2024, 3, 15), 7, 50) == {1: 470, 2: 510}
+    assert traits.reachable_stations(TraitsKey(1), 60, date(2025, 3, 15), 7, 50) == {1: 470}
+
+    graph_traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    assert graph_traits.reachable_stations(TraitsKey(1), 70) == {1: 0, 2: 30, 3: 70}
+    with pytest.raises(ValueError):
+        graph_traits.reachable_stations(TraitsKey(9), 70)
+
+def test_search_connections_transfer_patterns(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_backend="patterns")
+    traits.add_train(TraitsKey(1), 100, TrainStatus.OPERATIONAL)
+    traits.add_train(TraitsKey(2), 100, TrainStatus.OPERATIONAL)
+    for key, name in [(1, "Westbahnhof"), (2, "Floridsdorf"), (3, "Krems")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 40)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 0), (TraitsKey(2), 0)], 1, 1, 2024, 31, 12, 2024)
+    traits.add_schedule(TraitsKey(2), 8, 45, [(TraitsKey(2), 0), (TraitsKey(3), 0)], 1, 1, 2024, 31, 12, 2024)
+    stats = traits.rebuild_transfer_patterns()
+    assert stats["sources"] == 3 and stats["pairs"] == 3
+    connections = traits.search_connections(TraitsKey(1), TraitsKey(3), 15, 3, 2024)
+    assert connections[0]["path"] == [1, 2, 3]
+
+    traits.add_schedule(TraitsKey(1), 9, 0, [(TraitsKey(1), 0), (TraitsKey(2), 0)], 1, 1, 2024, 31, 12, 2024)
+    assert len(traits.search_connections(TraitsKey(1), TraitsKey(2), 15, 3, 2024)) == 2
+    assert traits.rebuild_transfer_patterns()["stale_sources"] == 0
+
+def test_search_connections_contraction_hierarchy(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_backend="ch")
+    for key, name in [(1, "Westbahnhof"), (2, "Floridsdorf"), (3, "Krems")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 40)
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(3), 90)
+    connections = traits.search_connections(TraitsKey(1), TraitsKey(3), limit=1)
+    assert [c["path"] for c in connections] == [[1, 2, 3]]
+    assert connections[0]["travel_time"] == 70
+    # The hierarchy only knows the fastest path, Yen answers the searches for more
+    assert [c["path"] for c in traits.search_connections(TraitsKey(1), TraitsKey(3))] == [[1, 2, 3], [1, 3]]
+    assert [[c["path"] for c in connections]
+            for connections in traits.search_connections_many(TraitsKey(1), [TraitsKey(3)], limit=2)] == \
+        [[[1, 2, 3], [1, 3]]]
+
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(3), 60)
+    assert traits.search_connections(TraitsKey(1), TraitsKey(3))[0]["path"] == [1, 3]
+    stats = traits.rebuild_contraction_hierarchy(benchmark_queries=5)
+    assert stats["stations"] == 3 and stats["speedup"] > 0
+
+def test_iter_connections(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_backend="yen")
+    for key, name in [(1, "Westbahnhof"), (2, "Floridsdorf"), (3, "Krems")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 40)
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(3), 90)
+    connections = traits.iter_connections(TraitsKey(1), TraitsKey(3))
+    assert next(connections)["path"] == [1, 2, 3]
+    connections.close()
+    assert len(traits.search_cache) == 0
+    assert list(traits.iter_connections(TraitsKey(1), TraitsKey(3))) == traits.search_connections(TraitsKey(1), TraitsKey(3))
+    assert traits.search_cache.stats()["hits"] == 1
+    with pytest.raises(ValueError):
+        traits.iter_connections(TraitsKey(1), None)
+
+
+def test_search_connections_sorted_by_fare(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    fares = ZoneFare({1: 1, 2: 3, 3: 1}, 100)
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, fare_model=fares)
+    for key, name in [(1, "Westbahnhof"), (2, "Floridsdorf"), (3, "Krems")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 40)
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(3), 90)
+    connections = traits.search_connections(TraitsKey(1), TraitsKey(3), sort_by=SortingCriteria.ESTIMATED_PRICE)
+    assert [(c["path"], c["estimated_price"]) for c in connections] == [([1, 3], 100), ([1, 2, 3], 600)]
+    fastest = traits.search_connections(TraitsKey(1), TraitsKey(3))
+    assert [c["path"] for c in fastest] == [[1, 2, 3], [1, 3]]
+
+
+def test_search_connections_sorted_by_fare_ranks_every_path(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    zones = {1: 1, 8: 1}
+    zones.update({key: 3 for key in range(2, 8)})
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, fare_model=ZoneFare(zones, 100))
+    for key in range(1, 9):
+        traits.add_train_station(TraitsKey(key), {"name": f"Station {key}", "location": f"Location {key}"})
+    for key in range(2, 8):
+        traits.connect_train_stations(TraitsKey(1), TraitsKey(key), 10)
+        traits.connect_train_stations(TraitsKey(key), TraitsKey(8), 10)
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(8), 500)
+    # The cheapest path is the slowest of seven
+    cheapest = traits.search_connections(TraitsKey(1), TraitsKey(8), sort_by=SortingCriteria.ESTIMATED_PRICE, limit=1)
+    assert [(c["path"], c["estimated_price"]) for c in cheapest] == [([1, 8], 100)]
+    dearest = traits.search_connections(TraitsKey(1), TraitsKey(8), sort_by=SortingCriteria.ESTIMATED_PRICE,
+                                        is_ascending=False, limit=6)
+    assert all(c["estimated_price"] == 600 for c in dearest) and len(dearest) == 6
+
+
+def test_buy_ticket_without_fare(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    traits.add_train_station(TraitsKey(1), {"name": "Meidling", "location": "Bezirk 12"})
+    traits.add_train_station(TraitsKey(2), {"name": "Floridsdorf", "location": "Bezirk 21"})
+    traits.add_train(TraitsKey(1), 10, TrainStatus.OPERATIONAL)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 5)], 1, 1, 2023, 1, 1, 2023)
+    traits.add_user("unpriced@test.at", {"password": "test_pass", "is_admin": False})
+    # The stations are not connected, the fare matrix cannot price the ride
+    with pytest.raises(ValueError, match="No fare"):
+        traits.buy_ticket("unpriced@test.at", {"train_id": 1, "departure_date": "2023-01-01"})
+    traits.buy_ticket("unpriced@test.at", {"train_id": 1, "departure_date": "2023-01-01", "price": 0})
+    assert [purchase["total_price"] for purchase in traits.get_purchase_history("unpriced@test.at")] == [0]
+
+
+def test_buy_ticket_seat_inventory(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    train_key = traits.add_train(TraitsKey(1), 1, TrainStatus.OPERATIONAL)
+    for key, name in [(1, "Meidling"), (2, "Floridsdorf")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.add_schedule(train_key, 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 10)], 1, 1, 2023, 31, 12, 2023)
+    for email in ["first@test.at", "second@test.at"]:
+        traits.add_user(email, {"password": "test_pass", "is_admin": False})
+    connection = {"train_id": 1, "departure_date": "2023-01-01", "price": 50.00}
+
+    traits.buy_ticket("first@test.at", connection)
+    with pytest.raises(ValueError):
+        traits.buy_ticket("second@test.at", connection)
+    traits.buy_ticket("second@test.at", connection, also_reserve_seats=False)
+    assert len(traits.get_purchase_history("second@test.at")) == 1
+
+    traits.delete_user("first@test.at")
+    traits.buy_ticket("second@test.at", connection)
+    with rdbms_admin_connection.cursor() as cur:
+        cur.execute("SELECT capacity, reserved FROM schedule_inventory")
+        assert cur.fetchall() == [(1, 1)]
+
+    traits.delete_train(train_key)
+    assert traits.get_train_current_status(train_key) is None
+
+
+def test_buy_tickets_group(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    train_key = traits.add_train(TraitsKey(1), 3, TrainStatus.OPERATIONAL)
+    for key, name in [(1, "Meidling"), (2, "Floridsdorf")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.add_schedule(train_key, 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 10)], 1, 1, 2023, 31, 12, 2023)
+    emails = ["a@test.at", "b@test.at"]
+    for email in emails:
+        traits.add_user(email, {"password": "test_pass", "is_admin": False})
+    connection = {"train_id": 1, "departure_date": "2023-01-01", "price": 50.00}
+
+    with pytest.raises(ValueError):
+        traits.buy_tickets(emails + ["unknown@test.at"], connection)
+    ticket_ids = traits.buy_tickets(emails, connection)
+    assert len(ticket_ids) == 2 and ticket_ids[1] == ticket_ids[0] + 1
+    # One seat is left, the group of two gets none of it
+    with pytest.raises(ValueError):
+        traits.buy_tickets(emails, connection)
+    assert [len(traits.get_purchase_history(email)) for email in emails] == [1, 1]
+    assert traits.buy_tickets([], connection) == []
+
+
+def test_buy_ticket_segment_occupancy(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    train_key = traits.add_train(TraitsKey(1), 1, TrainStatus.OPERATIONAL)
+    for key, name in [(1, "Meidling"), (2, "Floridsdorf"), (3, "Krems")]:
+        traits.add_train_station(TraitsKey(key), {"name": name, "location": name})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 30)
+    traits.add_schedule(train_key, 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 5), (TraitsKey(3), 5)],
+                        1, 1, 2023, 31, 12, 2023)
+    for email in ["a@test.at", "b@test.at", "c@test.at"]:
+        traits.add_user(email, {"password": "test_pass", "is_admin": False})
+    schedule = {"train_id": 1, "departure_date": "2023-01-01"}
+    first_half = dict(schedule, from_station_id=1, to_station_id=2)
+    second_half = dict(schedule, from_station_id=2, to_station_id=3)
+
+    traits.buy_ticket("a@test.at", first_half)
+    assert traits.get_available_seats(first_half) == 0
+    assert traits.get_available_seats(second_half) == 1
+    traits.buy_ticket("b@test.at", second_half)
+    with pytest.raises(ValueError):
+        traits.buy_ticket("c@test.at", schedule)
+    with pytest.raises(ValueError):
+        traits.get_available_seats(dict(schedule, from_station_id=3, to_station_id=1))
+
+    traits.delete_user("a@test.at")
+    assert traits.get_available_seats(first_half) == 1
+    assert traits.get_available_seats(schedule) == 0
+
+
+def test_seats_are_counted_per_ride_day(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    traits.add_train(TraitsKey(1), 1, TrainStatus.OPERATIONAL)
+    traits.add_train_station(TraitsKey(1), {"name": "Meidling", "location": "Bezirk 12"})
+    traits.add_train_station(TraitsKey(2), {"name": "Floridsdorf", "location": "Bezirk 21"})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 5)], 1, 1, 2023, 31, 12, 2023)
+    for email in ["a@test.at", "b@test.at"]:
+        traits.add_user(email, {"password": "test_pass", "is_admin": False})
+    monday, tuesday = {"train_id": 1, "departure_date": "2023-01-02"}, {"train_id": 1, "departure_date": "2023-01-03"}
+
+    traits.buy_ticket("a@test.at", monday)
+    assert traits.get_available_seats(monday) == 0 and traits.get_available_seats(tuesday) == 1
+    with pytest.raises(ValueError):
+        traits.buy_ticket("b@test.at", monday)
+    # The single seat of the train is sold again on another day
+    traits.buy_ticket("b@test.at", tuesday)
+    assert traits.get_available_seats(tuesday) == 0
+    traits.delete_user("a@test.at")
+    assert traits.get_available_seats(monday) == 1 and traits.get_available_seats(tuesday) == 0
+
+
+def test_prepared_statements_are_reused(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    traits.add_train(TraitsKey(1), 10, TrainStatus.OPERATIONAL)
+    traits.add_user("o'brien@test.at", {"password": "test_pass", "is_admin": False})
+    traits.get_train_current_status(TraitsKey(1))
+    traits.get_purchase_history("o'brien@test.at")
+    prepared = traits.statements.stats()["prepared"]
+    for _ in range(3):
+        assert traits.get_train_current_status(TraitsKey(1)) == TrainStatus.OPERATIONAL
+        assert traits.get_purchase_history("o'brien@test.at") == []
+    assert traits.statements.stats()["prepared"] == prepared
+    assert traits.utility.get_user_by_email("o'brien@test.at")["email"] == "o'brien@test.at"
+
+
+def test_production_queries_use_indexes(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    for key in range(1, 4):
+        traits.add_train_station(TraitsKey(key), {"name": f"Station {key}", "location": "Wien"})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.connect_train_stations(TraitsKey(2), TraitsKey(3), 30)
+    for train in range(1, 4):
+        traits.add_train(TraitsKey(train), 10, TrainStatus.OPERATIONAL)
+        traits.add_schedule(TraitsKey(train), 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 5), (TraitsKey(3), 5)],
+                            1, 1, 2023, 3, 1, 2023)
+    for user in range(5):
+        traits.add_user(f"user{user}@test.at", {"password": "test_pass", "is_admin": False})
+        ride = {"train_id": 1 + user % 3, "departure_date": "2023-01-01", "from_station_id": 1, "to_station_id": 2}
+        traits.buy_ticket(f"user{user}@test.at", ride)
+        traits.get_available_seats(ride)
+        traits.get_purchase_history(f"user{user}@test.at")
+    traits.update_train_details(TraitsKey(1), train_capacity=20)
+    traits.delete_user("user0@test.at")
+    traits.delete_train(TraitsKey(2))
+    traits.utility.get_all_users()
+    traits.utility.get_all_schedules()
+
+    # Only the methods returning whole tables may read them in full
+    expected = ["SELECT * FROM users", "SELECT * FROM schedules", "SELECT * FROM trains"]
+    assert traits.statements.full_scans(rdbms_admin_connection, expected) == []
+
+
+def test_neo4j_schema_bootstrap(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    # Applying it again at startup changes nothing
+    Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    records, _, _ = neo4j_db.execute_query("SHOW CONSTRAINTS YIELD name RETURN name")
+    assert "station_id" in [record["name"] for record in records]
+    records, _, _ = neo4j_db.execute_query("SHOW INDEXES YIELD name RETURN name")
+    assert {"connected_to_travel_time", "connected_to_departure_time"} <= {record["name"] for record in records}
+
+    for key in range(1, 21):
+        traits.add_train_station(TraitsKey(key), {"name": f"Station {key}", "location": "Wien"})
+    with pytest.raises(Exception):
+        neo4j_db.execute_query("CREATE (s:Station {id: 1})")
+    stats = traits.benchmark_station_lookups(queries=20)
+    assert stats["stations"] == 20 and stats["index_query_seconds"] > 0 and stats["speedup"] > 0
+
+
+def test_purchase_history_pages(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    traits.add_train_station(TraitsKey(1), {"name": "Meidling", "location": "Bezirk 12"})
+    traits.add_train_station(TraitsKey(2), {"name": "Floridsdorf", "location": "Bezirk 21"})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.add_train(TraitsKey(1), 10, TrainStatus.OPERATIONAL)
+    for day in range(1, 5):
+        traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 5)], day, 1, 2023, day, 1, 2023)
+    traits.add_user("frequent@test.at", {"password": "test_pass", "is_admin": False})
+    for day in range(1, 5):
+        # Two tickets on the same departure, told apart by their id
+        traits.buy_tickets(["frequent@test.at"] * 2, {"train_id": 1, "departure_date": f"2023-01-0{day}"})
+
+    history = traits.get_purchase_history("frequent@test.at")
+    assert [purchase["departure_date"].day for purchase in history] == [4, 4, 3, 3, 2, 2, 1, 1]
+    pages, after = [], None
+    while True:
+        page, after = traits.get_purchase_history_page("frequent@test.at", limit=3, after=after)
+        pages.append(page)
+        if after is None:
+            break
+    assert [len(page) for page in pages] == [3, 3, 2]
+    assert [purchase for page in pages for purchase in page] == history
+    assert list(traits.iter_purchase_history("frequent@test.at", batch_size=3)) == history
+    # Stopping early leaves the connection usable
+    next(traits.iter_purchase_history("frequent@test.at", batch_size=3))
+    assert traits.get_purchase_history_page("nobody@test.at") == ([], None)
+    with pytest.raises(ValueError):
+        traits.get_purchase_history_page("frequent@test.at", limit=0)
+
+
+def test_tickets_depart_on_the_booked_day(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    traits.add_train_station(TraitsKey(1), {"name": "Meidling", "location": "Bezirk 12"})
+    traits.add_train_station(TraitsKey(2), {"name": "Floridsdorf", "location": "Bezirk 21"})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.add_train(TraitsKey(1), 10, TrainStatus.OPERATIONAL)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 5)], 1, 1, 2023, 10, 1, 2023)
+    traits.add_user("daily@test.at", {"password": "test_pass", "is_admin": False})
+    schedule_id = traits.resolve_schedule_id({"train_id": 1, "departure_date": "2023-01-05"})
+    traits.buy_ticket("daily@test.at", {"train_id": 1, "departure_date": "2023-01-03"})
+    traits.buy_ticket("daily@test.at", {"schedule_id": schedule_id, "departure_date": "2023-01-05"})
+    traits.buy_ticket("daily@test.at", {"schedule_id": schedule_id})
+    for day in ("2022-12-31", "2023-01-11"):
+        with pytest.raises(ValueError):
+            traits.buy_ticket("daily@test.at", {"train_id": 1, "departure_date": day})
+        with pytest.raises(ValueError):
+            traits.buy_ticket("daily@test.at", {"schedule_id": schedule_id, "departure_date": day})
+    history = traits.get_purchase_history("daily@test.at")
+    assert [purchase["departure_date"] for purchase in history] == [date(2023, 1, 5), date(2023, 1, 3),
+                                                                    date(2023, 1, 1)]
+    page, after = traits.get_purchase_history_page("daily@test.at", limit=1)
+    assert page == history[:1] and traits.get_purchase_history_page("daily@test.at", 2, after)[0] == history[1:]
+
+
+def test_purchase_summary(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    traits.add_train_station(TraitsKey(1), {"name": "Meidling", "location": "Bezirk 12"})
+    traits.add_train_station(TraitsKey(2), {"name": "Floridsdorf", "location": "Bezirk 21"})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    year = date.today().year + 1
+    for train in (1, 2):
+        traits.add_train(TraitsKey(train), 10, TrainStatus.OPERATIONAL)
+    # A schedule per booked day, the tickets depart on the day of their schedule
+    for train, day in [(1, date(2023, 1, 2)), (1, date(year, 1, 4)), (2, date(year, 1, 2))]:
+        traits.add_schedule(TraitsKey(train), 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 5)],
+                            day.day, day.month, day.year, day.day, day.month, day.year)
+    traits.add_user("dashboard@test.at", {"password": "test_pass", "is_admin": False})
+    assert traits.get_purchase_summary("dashboard@test.at") == {
+        'trips': 0, 'total_spent': 0, 'next_ticket_id': None, 'next_departure': None}
+
+    traits.buy_ticket("dashboard@test.at", {"train_id": 1, "departure_date": "2023-01-02"})
+    later, = traits.buy_tickets(["dashboard@test.at"], {"train_id": 1, "departure_date": f"{year}-01-04"})
+    sooner, = traits.buy_tickets(["dashboard@test.at"], {"train_id": 2, "departure_date": f"{year}-01-02"})
+    history = traits.get_purchase_history("dashboard@test.at")
+    summary = traits.get_purchase_summary("dashboard@test.at")
+    assert summary['trips'] == 3 and summary['total_spent'] == sum(purchase['total_price'] for purchase in history)
+    assert summary['next_ticket_id'] == sooner and summary['next_departure'].date() == date(year, 1, 2)
+    # The user is resolved by the user cache
+    misses = traits.utility.user_ids.stats()["misses"]
+    assert traits.get_purchase_summary("dashboard@test.at") == summary
+    assert traits.utility.user_ids.stats()["misses"] == misses
+
+    # The next trip goes with its train
+    traits.delete_train(TraitsKey(2))
+    summary = traits.get_purchase_summary("dashboard@test.at")
+    assert summary['trips'] == 2 and summary['next_ticket_id'] == later
+    traits.delete_user("dashboard@test.at")
+    assert traits.get_purchase_summary("dashboard@test.at") is None
+
+
+def test_booking_with_warm_user_cache(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    traits = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    traits.add_train_station(TraitsKey(1), {"name": "Meidling", "location": "Bezirk 12"})
+    traits.add_train_station(TraitsKey(2), {"name": "Floridsdorf", "location": "Bezirk 21"})
+    traits.connect_train_stations(TraitsKey(1), TraitsKey(2), 30)
+    traits.add_train(TraitsKey(1), 10, TrainStatus.OPERATIONAL)
+    traits.add_schedule(TraitsKey(1), 8, 0, [(TraitsKey(1), 5), (TraitsKey(2), 5)], 1, 1, 2023, 2, 1, 2023)
+    traits.add_user("cached@test.at", {"password": "test_pass", "is_admin": False})
+    assert traits.get_purchase_history("unknown@test.at") == []
+
+    misses = traits.utility.user_ids.stats()["misses"]
+    traits.buy_ticket("cached@test.at", {"train_id": 1, "departure_date": "2023-01-01"})
+    assert len(traits.get_purchase_history("cached@test.at")) == 1
+    # Every lookup of the registered email was answered by the cache
+    assert traits.utility.user_ids.stats()["misses"] == misses
+    with pytest.raises(ValueError):
+        traits.buy_ticket("unknown@test.at", {"train_id": 1, "departure_date": "2023-01-01"})
+    # The unknown email is looked up again: another instance sharing the database may have registered it
+    assert traits.utility.user_ids.stats()["misses"] == misses + 1
+    other = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    other.add_user("unknown@test.at", {"password": "test_pass", "is_admin": False})
+    traits.buy_ticket("unknown@test.at", {"train_id": 1, "departure_date": "2023-01-01"})
+
+    traits.delete_user("cached@test.at")
+    assert traits.utility.get_user_id("cached@test.at") is None
+    traits.add_user("cached@test.at", {"password": "test_pass", "is_admin": False})
+    assert traits.utility.get_user_id("cached@test.at") == traits.utility.get_user_by_email("cached@test.at")["id"]
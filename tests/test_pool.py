@@ -0,0 +1,48 @@
+from threading import Thread
+
+import pytest
+
+from traits.implementation import Traits
+from traits.interface import TraitsKey, TrainStatus
+from traits.pool import ConnectionPool
+
+
+def test_connection_pool_borrow_and_exhaustion(fake_connection):
+    pool = ConnectionPool(fake_connection, size=1, timeout=0.01)
+    with pool.borrow() as connection:
+        with pool.borrow() as nested:
+            assert nested is connection and pool.current() is connection
+        with pytest.raises(ValueError):
+            pool.checkout()
+        # Another thread waits for the connection
+        borrowed = []
+        waiting = Thread(target=lambda: borrowed.append(pool.checkout()))
+        pool.timeout = 5
+        waiting.start()
+    waiting.join()
+    assert borrowed == [connection] and connection.rollbacks == 1 and pool.current() is None
+    stats = pool.stats()
+    assert stats["created"] == 1 and stats["in_use"] == 1 and stats["exhausted"] == 2 and stats["timeouts"] == 1
+
+    connection.broken = True
+    pool.checkin(connection)
+    assert connection.closed and pool.stats()["created"] == 0
+    assert pool.checkout() is not connection
+    with pytest.raises(ValueError):
+        ConnectionPool(fake_connection, size=0)
+
+
+def test_traits_pooled_mode(fake_connection):
+    pool = ConnectionPool(lambda: fake_connection([("OPERATIONAL",)]), size=2)
+    traits = Traits(None, None, None, rdbms_pool=pool)
+    results = []
+    threads = [Thread(target=lambda: results.append(traits.get_train_current_status(TraitsKey(1))))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [TrainStatus.OPERATIONAL] * 8
+    stats = pool.stats()
+    assert stats["checkouts"] == 8 and stats["in_use"] == 0 and stats["created"] <= 2
+    assert traits.rdbms_admin_connection is None
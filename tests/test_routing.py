@@ -0,0 +1,273 @@
+from datetime import date
+from threading import Thread
+
+from traits.graph import ContractionHierarchy, StationGraph
+from traits.interface import SortingCriteria
+from traits.patterns import TransferPatterns
+from traits.routing import ConnectionScan, Raptor, sort_connections
+from traits.timetable import open_timetable, save_timetable, to_minutes
+
+
+def test_to_minutes():
+    assert to_minutes("08:30:00") == 510
+    assert to_minutes("8:05") == 485
+
+
+def test_compile_timetable(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(7, 1, [30, 10, 20], 480, waiting_time=2),
+        make_trip(3, 2, [20, 30], 470),
+    )
+    assert timetable.station_ids.tolist() == [10, 20, 30]
+    assert timetable.station_index == {10: 0, 20: 1, 30: 2}
+    assert timetable.trip_schedule_ids.tolist() == [3, 7]
+    assert timetable.trip_stop_offsets.tolist() == [0, 2, 5]
+    assert timetable.trip_stations(1) == [2, 0, 1]
+    assert timetable.trip_departures(1) == [482, 494, 506]
+    assert timetable.connection_departures.tolist() == [470, 482, 494]
+    assert timetable.connection_trips.tolist() == [0, 1, 1]
+    assert timetable.connection_positions.tolist() == [0, 0, 1]
+    assert timetable.sorted_arrivals.tolist() == [480, 492, 504]
+    assert timetable.active_trips(date(2025, 1, 1)).tolist() == [False, False]
+    assert timetable.nbytes() < 300
+
+
+def test_timetable_snapshot(tmp_path, make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2, 3], 480),
+        make_trip(2, 2, [3, 4], 505),
+    )
+    timetable.generation = "schedules:1"
+    path = str(tmp_path / "timetable.bin")
+    save_timetable(timetable, path)
+    snapshot = open_timetable(path, "schedules:1")
+    for name in timetable.ARRAYS:
+        assert getattr(snapshot, name).tolist() == getattr(timetable, name).tolist()
+    assert not snapshot.stop_stations.flags.writeable
+    assert ConnectionScan(snapshot).journeys(1, 4)[0]["path"] == [1, 2, 3, 4]
+    assert open_timetable(path, "schedules:2") is None
+    assert open_timetable(str(tmp_path / "missing.bin")) is None
+    save_timetable(make_timetable(), path)
+    assert open_timetable(path).n_connections == 0
+
+    # The threads of a process save the same snapshot at once, each through its own temporary file
+    threads = [Thread(target=save_timetable, args=(timetable, path)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert open_timetable(path, "schedules:1").n_connections == timetable.n_connections
+    assert [file.name for file in tmp_path.iterdir()] == ["timetable.bin"]
+
+
+def test_csa_direct_and_change(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2, 3], 480),
+        make_trip(2, 2, [3, 4], 505),
+        make_trip(3, 3, [1, 4], 490, travel_time=60),
+    )
+    csa = ConnectionScan(timetable)
+    journeys = csa.journeys(1, 4, limit=5)
+    assert [j["path"] for j in journeys] == [[1, 2, 3, 4], [1, 4]]
+    first = journeys[0]
+    assert first["num_changes"] == 1
+    assert first["waiting_time"] == 5
+    assert first["travel_time"] == 35
+    assert [leg["train_id"] for leg in first["legs"]] == [1, 2]
+
+
+def test_csa_respects_validity_and_arrival_deadline(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2], 480, valid_until=date(2024, 6, 30)),
+        make_trip(2, 2, [1, 2], 600, valid_from=date(2024, 7, 1)),
+        make_trip(3, 3, [1, 2], 700, valid_from=date(2024, 7, 1)),
+    )
+    csa = ConnectionScan(timetable)
+    assert [j["departure_time"] for j in csa.journeys(1, 2, date(2024, 3, 1))] == [480]
+    arriving = csa.journeys(1, 2, date(2024, 8, 1), is_departure_time=False)
+    assert [j["departure_time"] for j in arriving] == [700, 600]
+    assert csa.journeys(2, 1) == []
+
+
+def test_csa_journeys_many_matches_single_searches(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2, 3], 480),
+        make_trip(2, 2, [3, 4], 505),
+        make_trip(3, 3, [1, 4], 490, travel_time=60),
+        make_trip(4, 4, [1, 2], 600),
+        make_trip(5, 5, [2, 5], 700),
+    )
+    csa = ConnectionScan(timetable)
+    many = csa.journeys_many(1, [2, 3, 4, 5, 9], limit=3)
+    for target in [2, 3, 4, 5]:
+        assert many[target] == csa.journeys(1, target, limit=3)
+    assert [j["departure_time"] for j in many[2]] == [480, 600]
+    assert many[9] == []
+
+
+def test_csa_reachable(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2, 3], 480),
+        make_trip(2, 2, [3, 4], 505),
+        make_trip(3, 3, [1, 5], 490, travel_time=60, valid_until=date(2024, 1, 31)),
+    )
+    csa = ConnectionScan(timetable)
+    reachable = csa.reachable(0, 470, 510)
+    assert {int(timetable.station_ids[station]): arrival for station, arrival in reachable.items()} == \
+        {1: 470, 2: 490, 3: 500}
+    assert len(csa.reachable(0, 470, 600)) == 5
+    assert len(csa.reachable(0, 470, 600, timetable.active_trips(date(2024, 2, 1)))) == 4
+
+
+def test_sort_connections(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2, 3], 480),
+        make_trip(2, 2, [1, 3], 500, travel_time=30),
+    )
+    journeys = ConnectionScan(timetable).journeys(1, 3)
+    ordered = sort_connections(journeys, SortingCriteria.OVERALL_TRAVEL_TIME, False, 1)
+    assert ordered[0]["travel_time"] == 30
+
+
+def test_raptor_pareto_set(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 3], 480, travel_time=60),
+        make_trip(2, 2, [1, 3], 470, travel_time=80),
+        make_trip(3, 3, [1, 2], 480),
+        make_trip(4, 4, [2, 3], 500),
+    )
+    raptor = Raptor(timetable)
+    journeys = raptor.journeys(1, 3)
+    assert sorted(j["path"] for j in journeys) == [[1, 2, 3], [1, 3]]
+    by_changes = sort_connections(journeys, SortingCriteria.NUMBER_OF_TRAIN_CHANGES, True, 5)
+    assert by_changes[0]["legs"][0]["train_id"] == 1
+    by_price = sort_connections(journeys, SortingCriteria.ESTIMATED_PRICE, True, 5)
+    assert by_price[0]["estimated_price"] == 200
+    assert by_price[0]["waiting_time"] == 10
+    assert raptor.journeys(1, 3) is journeys
+
+
+def test_raptor_journeys_many(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 3], 480, travel_time=60),
+        make_trip(2, 2, [1, 3], 470, travel_time=80),
+        make_trip(3, 3, [1, 2], 480),
+        make_trip(4, 4, [2, 3, 4], 500),
+    )
+    many = Raptor(timetable).journeys_many(1, [3, 4, 2])
+    for target in [2, 3, 4]:
+        assert sorted(j["path"] for j in many[target]) == sorted(j["path"] for j in Raptor(timetable).journeys(1, target))
+    assert [j["path"] for j in many[4]] == [[1, 2, 3, 4]]
+
+
+def test_raptor_skips_trips_not_running_on_the_day(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2], 480, valid_until=date(2024, 1, 31)),
+        make_trip(2, 1, [1, 2], 540),
+        make_trip(3, 1, [1, 2], 600),
+    )
+    journeys = Raptor(timetable).journeys(1, 2, date(2024, 2, 1))
+    assert [j["departure_time"] for j in journeys] == [540, 600]
+
+
+def test_raptor_range_query(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2], 480, travel_time=30),
+        make_trip(2, 2, [1, 2], 500, travel_time=20),
+        make_trip(3, 3, [1, 2], 560, travel_time=20),
+    )
+    # Same price for every trip: the later faster trip must not be dominated by the earlier one
+    raptor = Raptor(timetable, fare=lambda timetable, trip, board, alight: 100)
+    journeys = raptor.journeys(1, 2)
+    assert [(j["departure_time"], j["travel_time"]) for j in journeys] == [(480, 30), (500, 20), (560, 20)]
+    assert sort_connections(journeys, SortingCriteria.OVERALL_TRAVEL_TIME, True, 1)[0]["departure_time"] == 500
+    assert [j["departure_time"] for j in raptor.journeys(1, 2, limit=2)] == [480, 500]
+    arrive_by = raptor.journeys(1, 2, is_departure_time=False, limit=2)
+    assert [j["arrival_time"] for j in arrive_by] == [520, 580]
+
+
+def test_transfer_patterns(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 2, 3], 480),
+        make_trip(2, 2, [3, 4], 505),
+        make_trip(3, 3, [1, 4], 490, travel_time=60),
+        make_trip(4, 4, [3, 4], 600, valid_until=date(2024, 1, 31)),
+    )
+    patterns = TransferPatterns(timetable)
+    stats = patterns.build()
+    assert stats["sources"] == 4 and stats["stale_sources"] == 0
+    assert patterns.patterns[1][4] == {(1, 3, 4), (1, 4)}
+    csa = ConnectionScan(timetable)
+    for is_departure_time in (True, False):
+        assert patterns.journeys(1, 4, is_departure_time=is_departure_time) == \
+            csa.journeys(1, 4, is_departure_time=is_departure_time)
+    assert [j["departure_time"] for j in patterns.journeys(1, 4, date(2024, 2, 1), False)] == [490, 480]
+
+    refreshed = patterns.refreshed(make_timetable(make_trip(5, 5, [1, 4], 470)))
+    assert refreshed.stats()["stale_sources"] == 4
+    assert refreshed.journeys(1, 4)[0]["departure_time"] == 470
+    refreshed.build([1])
+    assert refreshed.patterns[1][4] == {(1, 4)} and 1 not in refreshed.stale
+
+
+def test_transfer_patterns_of_each_validity_period(make_trip, make_timetable):
+    timetable = make_timetable(
+        make_trip(1, 1, [1, 3], 480, valid_until=date(2024, 12, 31)),
+        make_trip(2, 2, [1, 2], 470, valid_from=date(2025, 1, 1), valid_until=date(2025, 12, 31)),
+        make_trip(3, 3, [2, 3], 495, valid_from=date(2025, 1, 1), valid_until=date(2025, 12, 31)),
+        make_trip(4, 4, [1, 3], 720, valid_until=date(2025, 12, 31)),
+    )
+    assert timetable.service_days() == [date(2024, 1, 1), date(2025, 1, 1)]
+    patterns = TransferPatterns(timetable)
+    patterns.build()
+    # Over all the trips the direct one dominates the change at station 2, which is the fastest on 2025 days
+    assert patterns.patterns[1][3] == {(1, 3), (1, 2, 3)}
+    csa = ConnectionScan(timetable)
+    for day in (None, date(2024, 3, 1), date(2025, 3, 1)):
+        for is_departure_time in (True, False):
+            assert patterns.journeys(1, 3, day, is_departure_time) == csa.journeys(1, 3, day, is_departure_time)
+    assert [j["path"] for j in patterns.journeys(1, 3, date(2025, 3, 1))] == [[1, 2, 3], [1, 3]]
+
+
+def test_yen_k_shortest_paths():
+    graph = StationGraph([(1, 2, 10), (2, 4, 10), (1, 3, 5), (3, 4, 30), (2, 3, 1), (1, 4, 50), (1, 2, 40)])
+    paths = graph.k_shortest_paths(1, 4, 3)
+    assert paths == [(20, [1, 2, 4]), (35, [1, 3, 4]), (41, [1, 2, 3, 4])]
+    assert graph.k_shortest_paths(1, 4, 10)[-1] == (50, [1, 4])
+    assert graph.k_shortest_paths(1, 4, 2, by_hops=True)[0] == (1, [1, 4])
+    assert graph.k_shortest_paths(1, 4, 10, max_hops=2) == [(20, [1, 2, 4]), (35, [1, 3, 4]), (50, [1, 4])]
+    assert graph.k_shortest_paths(4, 1, 3) == []
+
+
+def test_graph_reachable():
+    graph = StationGraph([(1, 2, 10), (2, 3, 10), (1, 3, 25), (3, 4, 5)])
+    assert graph.reachable(1, 20) == {1: 0, 2: 10, 3: 20}
+    assert graph.reachable(4, 100) == {4: 0}
+
+
+def test_iter_shortest_paths_is_lazy():
+    graph = StationGraph([(1, 2, 10), (2, 4, 10), (1, 3, 5), (3, 4, 30), (2, 3, 1), (1, 4, 50), (1, 2, 40)])
+    paths = graph.iter_shortest_paths(1, 4)
+    assert next(paths) == (20, [1, 2, 4])
+    assert [path for _, path in paths] == [path for _, path in graph.k_shortest_paths(1, 4, 10)[1:]]
+
+
+def test_shortest_path_hop_bound_prefers_fewer_hops():
+    graph = StationGraph([(1, 2, 1), (2, 3, 1), (3, 4, 1), (1, 4, 10)])
+    assert graph.shortest_path(1, 4) == (3, [1, 2, 3, 4])
+    assert graph.shortest_path(1, 4, max_hops=2) == (10, [1, 4])
+
+
+def test_contraction_hierarchy_matches_dijkstra():
+    edges = [(1, 2, 4), (2, 3, 4), (3, 4, 4), (1, 5, 3), (5, 4, 20), (4, 6, 1), (6, 1, 2), (2, 5, 1), (5, 3, 2)]
+    graph = StationGraph(edges)
+    hierarchy = ContractionHierarchy(graph)
+    for source in range(1, 7):
+        for target in range(1, 7):
+            expected = graph.shortest_path(source, target, max_hops=10)
+            fastest = hierarchy.shortest_path(source, target)
+            assert fastest[0] == expected[0]
+            assert fastest[1][0] == source and fastest[1][-1] == target
+            assert graph.path_cost(fastest[1]) == fastest[0]
+    assert hierarchy.shortest_path(1, 7) is None
+    assert hierarchy.stats()["stations"] == 6
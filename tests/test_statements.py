@@ -0,0 +1,92 @@
+import pytest
+
+from traits.graph import load_connections_graph
+from traits.statements import StatementRegistry
+
+
+def test_statement_registry_reuses_prepared_cursors(fake_connection):
+    registry = StatementRegistry(maxsize=2)
+    connection = fake_connection()
+    for user_id in range(3):
+        statement = "".join(["SELECT id FROM users ", "WHERE id = %s"])
+        assert registry.fetchone(connection, statement, [user_id]) == (user_id,)
+    cur = connection.cursors[0]
+    assert len(connection.cursors) == 1 and cur.prepared and cur.prepares == 1
+    assert registry.fetchone(connection, "SELECT 1", ()) == ()
+
+    registry.executemany(connection, "INSERT INTO users (email) VALUES (%s)", [("a@test.at",), ("b@test.at",)])
+    # Three statements on a registry of two, the least recently used one is closed
+    assert cur.closed and connection.cursors[-1].prepares == 1
+    assert registry.stats() == {"connections": 1, "statements": 2, "prepared": 3, "executions": 6, "closed": 1}
+
+    registry.close(connection)
+    assert all(cur.closed for cur in connection.cursors)
+    assert registry.stats()["connections"] == 0
+
+
+def test_statement_registry_without_prepared_cursors(plain_connection):
+    registry = StatementRegistry()
+    connection = plain_connection()
+    assert registry.fetchall(connection, "SELECT id FROM trains WHERE id = %s", (1,)) == [(1,)]
+    assert registry.execute(connection, "SELECT id FROM trains WHERE id = %s", (2,)) is connection.cursors[0]
+    assert len(connection.cursors) == 1
+    with pytest.raises(ValueError):
+        StatementRegistry(maxsize=0)
+
+
+class ExplainCursor:
+    """
+    EXPLAIN answers with one plan row per table, the tables scanned in full are the ones without an index
+    """
+
+    description = [("id",), ("table",), ("type",)]
+
+    def __init__(self, indexed):
+        self.indexed = indexed
+        self.explained = []
+        self.rows = []
+        self.closed = False
+
+    def execute(self, statement, params):
+        self.explained.append((statement, params))
+        table = statement.split(" FROM ")[1].split()[0]
+        self.rows = [(1, table, "ref" if table in self.indexed else "ALL"), (2, "<derived2>", "ALL")]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        self.closed = True
+
+
+def test_statement_registry_reports_full_scans(plain_connection):
+    registry = StatementRegistry()
+    connection = plain_connection()
+    registry.fetchall(connection, "SELECT id FROM tickets WHERE user_id = %s", (1,))
+    registry.fetchall(connection, "SELECT id FROM schedules WHERE train_id = %s", (2,))
+    registry.fetchall(connection, "SELECT * FROM trains")
+    registry.executemany(connection, "INSERT INTO trains (id) VALUES (%s)", [(1,), (2,)])
+
+    cur = ExplainCursor(indexed={"tickets"})
+    connection.cursor = lambda: cur
+    scans = registry.full_scans(connection, expected=["SELECT *  FROM trains"])
+    assert scans == [("SELECT id FROM schedules WHERE train_id = %s", {"id": 1, "table": "schedules", "type": "ALL"})]
+    # The statements are explained with their last parameters, plain INSERTs are not
+    assert cur.explained == [("EXPLAIN SELECT id FROM tickets WHERE user_id = %s", (1,)),
+                             ("EXPLAIN SELECT id FROM schedules WHERE train_id = %s", (2,))]
+    assert cur.closed
+
+
+def test_statement_registry_redacts_samples_and_binds_loaders(fake_connection):
+    registry = StatementRegistry()
+    connection = fake_connection([(1, 2, 30)])
+    insert = "INSERT INTO users (email, password, is_admin) VALUES (%s, %s, %s)"
+    registry.execute(connection, insert, ("a@test.at", b"hash", False))
+    # The strings and bytes (emails, password hashes) are not kept, the other values are
+    assert registry.samples.get(insert) == ("", b"", False)
+
+    # The loaders taking a cursor run their statements through the registry, prepared once per connection
+    graph = load_connections_graph(registry.bound(connection))
+    load_connections_graph(registry.bound(connection))
+    assert graph.adjacency == {1: {2: 30}}
+    assert registry.stats()["prepared"] == 2 and registry.stats()["executions"] == 3
@@ -0,0 +1,173 @@
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional
+import time
+
+
+class BookingCoordinator:
+    """
+    Runs the bookings of Traits.buy_tickets schedule by schedule. The schedules are hashed onto stripes, each
+    with its own queue, worker thread and database connection (opened with connect), so the bookings of a
+    schedule never fight over its inventory rows and a hot train only slows down the schedules of its stripe.
+    A worker takes the bookings waiting in its queue in micro-batches of up to batch_size and runs a batch in
+    one transaction, with a savepoint per booking: a failed booking is rolled back alone.
+
+    The contention of stats is the share of the bookings that found their stripe busy
+    """
+
+    def __init__(self, traits, connect: Callable[[], Any], stripes: int = 16, batch_size: int = 32) -> None:
+        if stripes <= 0 or batch_size <= 0:
+            raise ValueError("The number of stripes and the batch size must be greater than 0")
+        self.traits = traits
+        self.connect = connect
+        self.batch_size = batch_size
+        self._queues: List[Queue] = [Queue() for _ in range(stripes)]
+        self._workers: List[Optional[Thread]] = [None] * stripes
+        # Bookings submitted and not completed yet, per stripe
+        self._pending = [0] * stripes
+        # Guards the workers, the pending bookings and the counters
+        self._lock = Lock()
+        self._closed = False
+        self.submitted = 0
+        self.contended = 0
+        self.failed = 0
+        self.batches = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def schedule_key(self, connection) -> int:
+        """
+        Return the id of the schedule the connection books (see Traits.buy_tickets), resolving its train_id and
+        departure_date on the connection of the caller: a schedule always lands on the same stripe
+        """
+        if connection.get("schedule_id") is not None:
+            return connection["schedule_id"]
+        return self.traits.resolve_schedule_id(connection)
+
+    def stripe(self, connection) -> int:
+        return hash(self.schedule_key(connection)) % len(self._queues)
+
+    def submit(self, user_emails: List[str], connection, also_reserve_seats=True) -> Future:
+        """
+        Queue the booking of buy_tickets and return the Future of its ticket ids.
+        Raise a ValueError if the schedule does not exist, the Future raises the ValueError of a failed booking
+        """
+        if connection is None:
+            raise ValueError("Connection cannot be None")
+        # The worker books the resolved schedule
+        connection = dict(connection, schedule_id=self.schedule_key(connection))
+        stripe = self.stripe(connection)
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise ValueError("The booking coordinator is closed")
+            self.submitted += 1
+            if self._pending[stripe] > 0:
+                self.contended += 1
+            self._pending[stripe] += 1
+            if self._workers[stripe] is None:
+                self._workers[stripe] = Thread(target=self._work, args=(stripe,), daemon=True)
+                self._workers[stripe].start()
+        self._queues[stripe].put((list(user_emails), connection, also_reserve_seats, future, time.perf_counter()))
+        return future
+
+    def buy_tickets(self, user_emails: List[str], connection, also_reserve_seats=True) -> List[int]:
+        return self.submit(user_emails, connection, also_reserve_seats).result()
+
+    def buy_ticket(self, user_email: str, connection, also_reserve_seats=True) -> None:
+        self.buy_tickets([user_email], connection, also_reserve_seats)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            completed = self.submitted - sum(self._pending)
+            return {
+                "stripes": len(self._queues),
+                "active_stripes": sum(worker is not None for worker in self._workers),
+                "submitted": self.submitted,
+                "completed": completed,
+                "failed": self.failed,
+                "batches": self.batches,
+                "mean_batch_size": completed / self.batches if self.batches else 0.0,
+                "contention": self.contended / self.submitted if self.submitted else 0.0,
+                "mean_wait_seconds": self.wait_seconds / completed if completed else 0.0,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+    def close(self) -> None:
+        """
+        Stop the workers once they have run the bookings already submitted, and close their connections
+        """
+        with self._lock:
+            self._closed = True
+            workers = [(stripe, worker) for stripe, worker in enumerate(self._workers) if worker is not None]
+        for stripe, _ in workers:
+            self._queues[stripe].put(None)
+        for _, worker in workers:
+            worker.join()
+
+    def __enter__(self) -> "BookingCoordinator":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _work(self, stripe: int) -> None:
+        queue = self._queues[stripe]
+        db = self.connect()
+        try:
+            stopping = False
+            while not stopping:
+                request = queue.get()
+                if request is None:
+                    break
+                batch = [request]
+                while len(batch) < self.batch_size:
+                    try:
+                        request = queue.get_nowait()
+                    except Empty:
+                        break
+                    if request is None:
+                        stopping = True
+                        break
+                    batch.append(request)
+                self._run(db, stripe, batch)
+        finally:
+            self.traits.statements.close(db)
+            db.close()
+
+    def _run(self, db, stripe: int, batch: List) -> None:
+        started = time.perf_counter()
+        outcomes = []
+        cur = db.cursor()
+        try:
+            for user_emails, connection, also_reserve_seats, future, _ in batch:
+                cur.execute("SAVEPOINT booking")
+                try:
+                    ticket_ids = self.traits._book(db, user_emails, connection, also_reserve_seats)
+                except Exception as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT booking")
+                    outcomes.append((future, None, ValueError(f"An error occurred during buying a ticket: {e}")))
+                else:
+                    cur.execute("RELEASE SAVEPOINT booking")
+                    outcomes.append((future, ticket_ids, None))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            outcomes = [(future, None, ValueError(f"An error occurred during buying a ticket: {e}"))
+                        for _, _, _, future, _ in batch]
+        finally:
+            cur.close()
+
+        with self._lock:
+            self.batches += 1
+            self._pending[stripe] -= len(batch)
+            self.failed += sum(error is not None for _, _, error in outcomes)
+            for *_, submitted in batch:
+                self.wait_seconds += started - submitted
+                self.max_wait_seconds = max(self.max_wait_seconds, started - submitted)
+        for future, ticket_ids, error in outcomes:
+            if error is None:
+                future.set_result(ticket_ids)
+            else:
+                future.set_exception(error)
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+import time
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache whose entries optionally expire ttl seconds after being stored.
+    hits, misses, evictions (entries dropped for lack of room or because they expired) and invalidations
+    count what happened to the cache since it was created. The cache can be shared between threads
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        if maxsize < 0:
+            raise ValueError("The size of a cache cannot be negative")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return the value stored for the key and mark it as the most recently used, default if there is none
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and self.clock() - entry[1] > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Store the value for the key, evicting the least recently used entries beyond maxsize
+        """
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self.clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: Hashable) -> None:
+        """
+        Drop the entry of the key if there is one
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """
+        Return the (key, value) entries that have not expired, from the least to the most recently used
+        """
+        with self._lock:
+            now = self.clock()
+            return [(key, value) for key, (value, stored) in self._entries.items()
+                    if self.ttl is None or now - stored <= self.ttl]
+
+    def invalidate(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """
+        Drop the entries for which predicate(key, value) holds and return how many were dropped
+        """
+        with self._lock:
+            stale = [key for key, (value, _) in self._entries.items() if predicate(key, value)]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self) -> int:
+        """
+        Drop every entry and return how many were dropped
+        """
+        return self.invalidate(lambda key, value: True)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
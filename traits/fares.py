@@ -0,0 +1,160 @@
+from collections import deque
+from typing import List, Tuple, Dict, Iterable
+
+import numpy as np
+
+from traits.graph import StationGraph
+from traits.journey import Journey
+from traits.timetable import Timetable
+
+
+class FareModel:
+    """
+    Price model of a ride between two stations, in cents: base + rate * measure(start, end).
+    Subclasses define the measure for every pair of stations at once
+    """
+
+    def __init__(self, rate: int, base: int = 0) -> None:
+        if rate < 0 or base < 0:
+            raise ValueError("Fares cannot be negative")
+        self.rate = rate
+        self.base = base
+
+    def measures(self, graph: StationGraph, station_ids: List[int]) -> np.ndarray:
+        raise NotImplementedError
+
+    def matrix(self, graph: StationGraph, station_ids: List[int]) -> np.ndarray:
+        """
+        Return the fares of every pair of the stations, 0 for the pairs that cannot be travelled
+        """
+        return self.fares(self.measures(graph, station_ids))
+
+    def fares(self, measures: np.ndarray) -> np.ndarray:
+        """
+        Return the fares of the measures, 0 for the negative ones (pairs that cannot be travelled)
+        """
+        fares = self.base + self.rate * measures
+        fares[measures < 0] = 0
+        return fares.astype(np.int64)
+
+
+class TravelTimeFare(FareModel):
+    """
+    Priced by the minutes of the fastest path between the stations
+    """
+
+    def measures(self, graph: StationGraph, station_ids: List[int]) -> np.ndarray:
+        index = {station: i for i, station in enumerate(station_ids)}
+        measures = np.full((len(station_ids), len(station_ids)), -1, dtype=np.int64)
+        for i, station in enumerate(station_ids):
+            for end, minutes in graph.reachable(station, np.iinfo(np.int64).max).items():
+                measures[i, index[end]] = minutes
+        return measures
+
+
+class DistanceFare(FareModel):
+    """
+    Priced by the number of sections (connections) of the shortest path between the stations
+    """
+
+    def measures(self, graph: StationGraph, station_ids: List[int]) -> np.ndarray:
+        index = {station: i for i, station in enumerate(station_ids)}
+        measures = np.full((len(station_ids), len(station_ids)), -1, dtype=np.int64)
+        for i, station in enumerate(station_ids):
+            measures[i, i] = 0
+            queue = deque([station])
+            while queue:
+                current = queue.popleft()
+                for end in graph.adjacency.get(current, {}):
+                    if measures[i, index[end]] < 0:
+                        measures[i, index[end]] = measures[i, index[current]] + 1
+                        queue.append(end)
+        return measures
+
+
+class ZoneFare(FareModel):
+    """
+    Priced by the number of concentric zones travelled, both ends included: |zone(start) - zone(end)| + 1.
+    Stations without a zone are in zone 0
+    """
+
+    def __init__(self, zones: Dict[int, int], rate: int, base: int = 0) -> None:
+        super().__init__(rate, base)
+        self.zones = zones
+
+    def measures(self, graph: StationGraph, station_ids: List[int]) -> np.ndarray:
+        zones = np.array([self.zones.get(station, 0) for station in station_ids], dtype=np.int64)
+        return np.abs(zones[:, None] - zones[None, :]) + 1
+
+
+class FareEngine:
+    """
+    Fare matrix of every pair of stations, computed once from the station graph with a FareModel.
+    A journey costs the fare of each of its rides: its legs or, for the journeys of the static station graph
+    (one train per connection), each connection of its path.
+    Unknown stations are mapped to an extra row and column of zeros.
+    A fare of 0 is a real fare only for the pairs of has_fare, the others cannot be priced
+    """
+
+    def __init__(self, graph: StationGraph, model: FareModel) -> None:
+        stations = set(graph.adjacency)
+        for neighbours in graph.adjacency.values():
+            stations.update(neighbours)
+        self.station_ids = sorted(stations)
+        self.station_index = {station: i for i, station in enumerate(self.station_ids)}
+        self.model = model
+        n = len(self.station_ids)
+        measures = model.measures(graph, self.station_ids)
+        self.matrix = np.zeros((n + 1, n + 1), dtype=np.int64)
+        self.matrix[:n, :n] = model.fares(measures)
+        self.priced = np.zeros((n + 1, n + 1), dtype=bool)
+        self.priced[:n, :n] = measures >= 0
+
+    def fare(self, start: int, end: int) -> int:
+        n = len(self.station_ids)
+        return int(self.matrix[self.station_index.get(start, n), self.station_index.get(end, n)])
+
+    def has_fare(self, start: int, end: int) -> bool:
+        """
+        Tell whether the model prices the ride between the two stations
+        """
+        n = len(self.station_ids)
+        return bool(self.priced[self.station_index.get(start, n), self.station_index.get(end, n)])
+
+    def leg_fare(self, timetable: Timetable, trip: int, board: int, alight: int) -> int:
+        """
+        Fare of a ride on a trip of the timetable, usable as the fare function of the routing engines
+        """
+        offset = int(timetable.trip_stop_offsets[trip])
+        return self.fare(int(timetable.station_ids[timetable.stop_stations[offset + board]]),
+                         int(timetable.station_ids[timetable.stop_stations[offset + alight]]))
+
+    @staticmethod
+    def rides(journey: Journey) -> Iterable[Tuple[int, int]]:
+        if journey.legs:
+            return ((leg.from_station_id, leg.to_station_id) for leg in journey.legs)
+        return zip(journey.path, journey.path[1:])
+
+    def prices(self, journeys: List[Journey]) -> np.ndarray:
+        """
+        Return the price of each journey, looking all of their rides up in the matrix at once
+        """
+        n = len(self.station_ids)
+        starts, ends, owners = [], [], []
+        for i, journey in enumerate(journeys):
+            for start, end in self.rides(journey):
+                starts.append(self.station_index.get(start, n))
+                ends.append(self.station_index.get(end, n))
+                owners.append(i)
+        if not owners:
+            return np.zeros(len(journeys), dtype=np.int64)
+        fares = self.matrix[np.array(starts, dtype=np.intp), np.array(ends, dtype=np.intp)]
+        return np.bincount(np.array(owners, dtype=np.intp), weights=fares, minlength=len(journeys)).astype(np.int64)
+
+    def price(self, journeys: List[Journey]) -> List[Journey]:
+        """
+        Set the estimated_price of the journeys and return them
+        """
+        for journey, price in zip(journeys, self.prices(journeys).tolist()):
+            journey.estimated_price = price
+        return journeys
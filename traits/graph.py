@@ -0,0 +1,323 @@
+from heapq import heapify, heappush, heappop
+from itertools import count, islice
+from typing import List, Tuple, Optional, Dict, Iterable, Iterator
+import time
+
+INFINITY = float("inf")
+
+# Upper bound on the number of connections of a path, so that dense networks cannot make a search explode
+DEFAULT_MAX_HOPS = 15
+
+# A weighted path: (cost, [station ids])
+WeightedPath = Tuple[int, List[int]]
+
+
+class StationGraph:
+    """
+    In-process adjacency of the CONNECTED_TO relationships: station -> {next station: travel time}.
+    When two stations are connected more than once the fastest connection is kept
+    """
+
+    def __init__(self, edges: Iterable[Tuple[int, int, int]]) -> None:
+        self.adjacency: Dict[int, Dict[int, int]] = {}
+        for start, end, travel_time in edges:
+            neighbours = self.adjacency.setdefault(start, {})
+            if end not in neighbours or travel_time < neighbours[end]:
+                neighbours[end] = travel_time
+
+    def weight(self, start: int, end: int, by_hops: bool = False) -> int:
+        return 1 if by_hops else self.adjacency[start][end]
+
+    def path_cost(self, path: List[int], by_hops: bool = False) -> int:
+        return sum(self.weight(path[i], path[i + 1], by_hops) for i in range(len(path) - 1))
+
+    def shortest_path(self, source: int, target: int, max_hops: int = DEFAULT_MAX_HOPS, by_hops: bool = False,
+                      removed_nodes: Optional[set] = None,
+                      removed_edges: Optional[set] = None) -> Optional[WeightedPath]:
+        """
+        Dijkstra over (station, hops) states: return the cheapest path from source to target using at most
+        max_hops connections and avoiding the removed nodes and edges, None if there is none
+        """
+        removed_nodes = removed_nodes or set()
+        removed_edges = removed_edges or set()
+        # A state settled at a station with fewer hops dominates every later (costlier) one with more hops
+        settled_hops: Dict[int, int] = {}
+        tie_breaker = count()
+        queue = [(0, 0, next(tie_breaker), source, (source, None))]
+        while queue:
+            cost, hops, _, station, trail = heappop(queue)
+            if hops >= settled_hops.get(station, max_hops + 1):
+                continue
+            settled_hops[station] = hops
+            if station == target:
+                path = []
+                while trail is not None:
+                    path.append(trail[0])
+                    trail = trail[1]
+                path.reverse()
+                return cost, path
+            if hops == max_hops:
+                continue
+            for neighbour, travel_time in self.adjacency.get(station, {}).items():
+                if neighbour in removed_nodes or (station, neighbour) in removed_edges:
+                    continue
+                if hops + 1 < settled_hops.get(neighbour, max_hops + 1):
+                    heappush(queue, (cost + (1 if by_hops else travel_time), hops + 1, next(tie_breaker),
+                                     neighbour, (neighbour, trail)))
+        return None
+
+    def reachable(self, source: int, max_cost: int) -> Dict[int, int]:
+        """
+        Dijkstra bounded by max_cost: return the travel time from source to every station reachable within it
+        """
+        costs: Dict[int, int] = {}
+        queue = [(0, source)]
+        while queue:
+            cost, station = heappop(queue)
+            if station in costs:
+                continue
+            costs[station] = cost
+            for neighbour, travel_time in self.adjacency.get(station, {}).items():
+                if neighbour not in costs and cost + travel_time <= max_cost:
+                    heappush(queue, (cost + travel_time, neighbour))
+        return costs
+
+    def k_shortest_paths(self, source: int, target: int, k: int, max_hops: int = DEFAULT_MAX_HOPS,
+                         by_hops: bool = False) -> List[WeightedPath]:
+        """
+        Yen's algorithm: return up to k loopless paths from source to target by increasing cost
+        (travel time, or number of connections with by_hops), each one using at most max_hops connections.
+        The search stops as soon as k paths are found
+        """
+        if k <= 0:
+            return []
+        return list(islice(self.iter_shortest_paths(source, target, max_hops, by_hops), k))
+
+    def iter_shortest_paths(self, source: int, target: int, max_hops: int = DEFAULT_MAX_HOPS,
+                            by_hops: bool = False) -> Iterator[WeightedPath]:
+        """
+        Yield the loopless paths of k_shortest_paths one at a time, each one computed only when requested
+        """
+        first = self.shortest_path(source, target, max_hops, by_hops)
+        if first is None:
+            return
+        yield first
+        paths = [first]
+        candidates = []
+        seen = {tuple(first[1])}
+        while True:
+            previous = paths[-1][1]
+            for i in range(len(previous) - 1):
+                spur = previous[i]
+                root = previous[:i + 1]
+                removed_edges = {(path[i], path[i + 1]) for _, path in paths
+                                 if len(path) > i + 1 and path[:i + 1] == root}
+                spur_path = self.shortest_path(spur, target, max_hops - i, by_hops,
+                                               removed_nodes=set(root[:-1]), removed_edges=removed_edges)
+                if spur_path is None:
+                    continue
+                path = root[:-1] + spur_path[1]
+                if tuple(path) not in seen:
+                    seen.add(tuple(path))
+                    heappush(candidates, (self.path_cost(root, by_hops) + spur_path[0], path))
+            if not candidates:
+                return
+            paths.append(heappop(candidates))
+            yield paths[-1]
+
+
+class ContractionHierarchy:
+    """
+    Contraction Hierarchies over a StationGraph, for fastest (travel time) point-to-point queries.
+    Stations are contracted by increasing edge difference; contracting a station adds a shortcut between
+    two of its neighbours unless a witness search finds a path at least as fast avoiding it.
+    A query runs two Dijkstra searches that only go upwards in the contraction order, one from the source
+    along the edges and one from the target against them, and unpacks the shortcuts of the meeting path.
+    """
+
+    def __init__(self, graph: StationGraph, witness_settled: int = 64) -> None:
+        started = time.perf_counter()
+        self.graph = graph
+        self.witness_settled = witness_settled
+        out_edges: Dict[int, Dict[int, int]] = {}
+        in_edges: Dict[int, Dict[int, int]] = {}
+        for start, neighbours in graph.adjacency.items():
+            out_edges.setdefault(start, {})
+            for end, travel_time in neighbours.items():
+                if end == start:
+                    continue
+                out_edges[start][end] = travel_time
+                in_edges.setdefault(end, {})[start] = travel_time
+                out_edges.setdefault(end, {})
+        for station in out_edges:
+            in_edges.setdefault(station, {})
+
+        # Middle station of every shortcut, to unpack it into the two edges it replaces
+        self.middle: Dict[Tuple[int, int], int] = {}
+        self.rank: Dict[int, int] = {}
+        # Upward edges: up[u][v] for u -> v and up_reverse[v][u] for u -> v, rank[v] > rank[u] in both
+        self.up: Dict[int, Dict[int, int]] = {}
+        self.up_reverse: Dict[int, Dict[int, int]] = {}
+        self.shortcuts = 0
+        contracted_neighbours: Dict[int, int] = {station: 0 for station in out_edges}
+
+        queue = [(self._priority(station, out_edges, in_edges, contracted_neighbours), station)
+                 for station in out_edges]
+        heapify(queue)
+        while queue:
+            _, station = heappop(queue)
+            priority = self._priority(station, out_edges, in_edges, contracted_neighbours)
+            if queue and priority > queue[0][0]:
+                # Lazy update: the priority grew since it was queued, contract it later
+                heappush(queue, (priority, station))
+                continue
+            for start, end, travel_time in self._shortcuts(station, out_edges, in_edges):
+                out_edges[start][end] = travel_time
+                in_edges[end][start] = travel_time
+                self.middle[(start, end)] = station
+                self.shortcuts += 1
+            self.rank[station] = len(self.rank)
+            self.up[station] = out_edges.pop(station)
+            self.up_reverse[station] = in_edges.pop(station)
+            for neighbour in self.up[station]:
+                del in_edges[neighbour][station]
+                contracted_neighbours[neighbour] += 1
+            for neighbour in self.up_reverse[station]:
+                del out_edges[neighbour][station]
+                contracted_neighbours[neighbour] += 1
+        self.build_seconds = time.perf_counter() - started
+
+    def _priority(self, station: int, out_edges, in_edges, contracted_neighbours) -> int:
+        """
+        Edge difference of contracting the station, plus its already contracted neighbours to spread
+        the contraction evenly over the graph
+        """
+        added = len(self._shortcuts(station, out_edges, in_edges))
+        return added - len(out_edges[station]) - len(in_edges[station]) + contracted_neighbours[station]
+
+    def _shortcuts(self, station: int, out_edges, in_edges) -> List[Tuple[int, int, int]]:
+        """
+        Return the shortcuts (start, end, travel time) that contracting the station requires
+        """
+        shortcuts = []
+        outgoing = out_edges[station]
+        for start, to_station in in_edges[station].items():
+            targets = {end: to_station + travel_time for end, travel_time in outgoing.items()
+                       if end != start and to_station + travel_time < out_edges[start].get(end, INFINITY)}
+            if not targets:
+                continue
+            witnesses = self._witness_search(start, station, max(targets.values()), out_edges, targets)
+            shortcuts.extend((start, end, travel_time) for end, travel_time in targets.items()
+                             if witnesses.get(end, INFINITY) > travel_time)
+        return shortcuts
+
+    def _witness_search(self, source: int, avoided: int, max_cost: int, out_edges, targets) -> Dict[int, int]:
+        """
+        Dijkstra from source avoiding a station, bounded by max_cost and by the number of settled stations
+        """
+        costs: Dict[int, int] = {}
+        queue = [(0, source)]
+        remaining = len(targets)
+        while queue and len(costs) < self.witness_settled:
+            cost, station = heappop(queue)
+            if station in costs:
+                continue
+            costs[station] = cost
+            if station in targets:
+                remaining -= 1
+                if remaining == 0:
+                    break
+            for neighbour, travel_time in out_edges[station].items():
+                if neighbour != avoided and neighbour not in costs and cost + travel_time <= max_cost:
+                    heappush(queue, (cost + travel_time, neighbour))
+        return costs
+
+    def shortest_path(self, source: int, target: int) -> Optional[WeightedPath]:
+        """
+        Return the fastest path from source to target, None if there is none
+        """
+        if source not in self.rank or target not in self.rank:
+            return None
+        if source == target:
+            return 0, [source]
+        # Side 0 searches from the source along the edges, side 1 from the target against them
+        costs = ({source: 0}, {target: 0})
+        parents = ({source: None}, {target: None})
+        settled = (set(), set())
+        queues = ([(0, source)], [(0, target)])
+        edges = (self.up, self.up_reverse)
+        best, meeting = INFINITY, None
+        while queues[0] or queues[1]:
+            for side in (0, 1):
+                queue = queues[side]
+                if queue and queue[0][0] >= best:
+                    # Nothing left on this side can improve the best meeting
+                    queue.clear()
+                if not queue:
+                    continue
+                cost, station = heappop(queue)
+                if station in settled[side]:
+                    continue
+                settled[side].add(station)
+                if station in costs[1 - side] and cost + costs[1 - side][station] < best:
+                    best, meeting = cost + costs[1 - side][station], station
+                for neighbour, travel_time in edges[side][station].items():
+                    if cost + travel_time < min(costs[side].get(neighbour, INFINITY), best):
+                        costs[side][neighbour] = cost + travel_time
+                        parents[side][neighbour] = station
+                        heappush(queue, (cost + travel_time, neighbour))
+        if meeting is None:
+            return None
+
+        path = [meeting]
+        station = meeting
+        while parents[0][station] is not None:
+            previous = parents[0][station]
+            path[:1] = self._unpack(previous, station)
+            station = previous
+        station = meeting
+        while parents[1][station] is not None:
+            following = parents[1][station]
+            path[-1:] = self._unpack(station, following)
+            station = following
+        return best, path
+
+    def _unpack(self, start: int, end: int) -> List[int]:
+        """
+        Return the stations of the original edges replaced by the (possibly shortcut) edge start -> end
+        """
+        middle = self.middle.get((start, end))
+        if middle is None:
+            return [start, end]
+        return self._unpack(start, middle)[:-1] + self._unpack(middle, end)
+
+    def stats(self) -> Dict:
+        return {
+            "stations": len(self.rank),
+            "edges": sum(len(neighbours) for neighbours in self.up.values()),
+            "shortcuts": self.shortcuts,
+            "build_seconds": self.build_seconds,
+        }
+
+
+def load_station_graph(session) -> StationGraph:
+    """
+    Load the CONNECTED_TO relationships and their travel_time from Neo4j with the session
+    """
+    result = session.run("""
+        MATCH (start:Station)-[r:CONNECTED_TO]->(end:Station)
+        RETURN start.id AS start, end.id AS end, r.travel_time AS travel_time
+    """)
+    return StationGraph((record["start"], record["end"], record["travel_time"]) for record in result)
+
+
+def load_connections_graph(cursor) -> StationGraph:
+    """
+    Load the station graph from the connections table of the RDBMS, keeping the fastest connection of each pair
+    """
+    cursor.execute("""
+        SELECT start_station_id, end_station_id, MIN(travel_time_minutes)
+        FROM connections
+        GROUP BY start_station_id, end_station_id
+    """)
+    return StationGraph(cursor.fetchall())
@@ -1,21 +1,153 @@
-from random import random
+from random import Random, random
 
 from traits.interface import TraitsInterface, TraitsUtilityInterface, TraitsKey, TrainStatus, SortingCriteria
 
 # Import all the necessary default configurations
 from traits.interface import BASE_USER_NAME, BASE_USER_PASS, ADMIN_USER_NAME, ADMIN_USER_PASS
 
-from typing import List, Tuple, Optional, Dict
+from traits.cache import LRUCache
+from traits.fares import FareEngine, FareModel, TravelTimeFare
+from traits.graph import DEFAULT_MAX_HOPS, ContractionHierarchy, load_connections_graph, load_station_graph
+from traits.journey import Journey
+from traits.patterns import TransferPatterns
+from traits.pool import ConnectionPool, borrows_connection
+from traits.routing import PRICE_PER_MINUTE, ConnectionScan, Raptor, path_to_connection, sort_connections
+from traits.statements import StatementRegistry
+from traits.timetable import load_timetable, open_timetable, save_timetable, timetable_generation
+
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+from datetime import date
+from threading import Lock, local
+from time import perf_counter
+from typing import List, Tuple, Optional, Dict, Iterator
 import re
 
+# Engines that search_connections can use: the Cypher path enumeration or one of the in-memory timetable engines
+TIMETABLE_ENGINES = {
+    "csa": ConnectionScan,
+    "raptor": Raptor,
+    "patterns": TransferPatterns,
+}
+# "ch" answers the ascending travel time searches for a single connection with the fastest path of a Contraction
+# Hierarchy, and leaves those for more connections to Yen (the hierarchy only knows the fastest path)
+SEARCH_BACKENDS = ("cypher", "yen", "ch") + tuple(TIMETABLE_ENGINES)
+
+# Purchase history of a user, newest departure first, read in the order of the tickets_by_user index
+PURCHASE_HISTORY_QUERY = """
+    SELECT
+        tickets.id as ticket_id,
+        schedules.start_train_station_id,
+        schedules.end_train_station_id,
+        tickets.departure_time,
+        tickets.departure_date,
+        schedules.arrival_time,
+        schedules.arrival_date,
+        tickets.purchase_date,
+        tickets.price,
+        seat_reservations.number_of_seats
+    FROM tickets
+    JOIN schedules ON tickets.schedule_id = schedules.id
+    LEFT JOIN seat_reservations ON tickets.id = seat_reservations.ticket_id
+    WHERE tickets.user_id = %s {after}
+    ORDER BY tickets.departure_date DESC, tickets.departure_time DESC, tickets.id DESC
+"""
+PURCHASE_HISTORY = PURCHASE_HISTORY_QUERY.format(after="")
+PURCHASE_HISTORY_FIRST_PAGE = PURCHASE_HISTORY + "LIMIT %s"
+# Keyset pagination: the purchases after (departure_date, departure_time, ticket_id) in the order above
+PURCHASE_HISTORY_NEXT_PAGE = PURCHASE_HISTORY_QUERY.format(after="""
+        AND (tickets.departure_date < %s OR (tickets.departure_date = %s AND (tickets.departure_time < %s
+             OR (tickets.departure_time = %s AND tickets.id < %s))))""") + "LIMIT %s"
+
+
+# Count the tickets of a user bought together (at the same price) in their summary. The ticket becomes the next
+# trip if it departs in the future before the current one
+SUMMARY_ON_PURCHASE = """
+    INSERT INTO user_purchase_summary (user_id, trips, total_spent, next_ticket_id, next_departure)
+    SELECT user_id, %s, %s * price,
+           IF(TIMESTAMP(departure_date, departure_time) >= NOW(), id, NULL),
+           IF(TIMESTAMP(departure_date, departure_time) >= NOW(), TIMESTAMP(departure_date, departure_time), NULL)
+    FROM tickets WHERE id = %s
+    ON DUPLICATE KEY UPDATE
+        trips = trips + VALUES(trips),
+        total_spent = total_spent + VALUES(total_spent),
+        next_ticket_id = IF(VALUES(next_departure) < next_departure OR next_departure IS NULL,
+                            IFNULL(VALUES(next_ticket_id), next_ticket_id), next_ticket_id),
+        next_departure = IF(VALUES(next_departure) < next_departure OR next_departure IS NULL,
+                            IFNULL(VALUES(next_departure), next_departure), next_departure)
+"""
+# Earliest upcoming ticket of a user, read from the tickets_by_user index
+NEXT_TRIP = """
+    SELECT {column} FROM tickets
+    WHERE user_id = %s AND (departure_date > CURDATE() OR departure_date = CURDATE() AND departure_time >= CURTIME())
+    ORDER BY departure_date, departure_time, id LIMIT 1
+"""
+NEXT_TRIP_TICKET = NEXT_TRIP.format(column="id, TIMESTAMP(departure_date, departure_time)")
+REFRESH_NEXT_TRIP = f"""
+    UPDATE user_purchase_summary
+    SET next_ticket_id = ({NEXT_TRIP.format(column="id")}),
+        next_departure = ({NEXT_TRIP.format(column="TIMESTAMP(departure_date, departure_time)")})
+    WHERE user_id = %s
+"""
+# The bookings look up the next trip of the passengers again once it is past, before counting their tickets
+REFRESH_PAST_NEXT_TRIP = REFRESH_NEXT_TRIP + "    AND next_departure < NOW()\n"
+
+
+def purchase_from_row(row) -> Dict:
+    return {
+        'ticket_id': row[0],
+        'start_station_id': row[1],
+        'end_station_id': row[2],
+        'departure_time': row[3],
+        'departure_date': row[4],
+        'arrival_time': row[5],
+        'arrival_date': row[6],
+        'purchase_date': row[7],
+        'total_price': row[8],
+        'reserved_seats': row[9] or 0
+    }
+
+
+# Rows of a train deleted through the schedules of the train (see delete_train)
+DELETE_BY_TRAIN = {
+    table: f"DELETE {table} FROM schedules JOIN {table} ON {table}.schedule_id = schedules.id "
+           f"WHERE schedules.train_id = %s"
+    for table in ("tickets", "schedule_inventory", "schedule_stops")
+}
+
 
 # Implement the utility class. Add any additional method that you need
 class TraitsUtility(TraitsUtilityInterface):
 
-    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver) -> None:
+    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver,
+                 rdbms_pool: Optional[ConnectionPool] = None, user_cache_size: int = 4096,
+                 user_cache_ttl: Optional[float] = 300.0) -> None:
         self.rdbms_connection = rdbms_connection
+        self.rdbms_pool = rdbms_pool
         self.rdbms_admin_connection = rdbms_admin_connection
         self.neo4j_driver = neo4j_driver
+        # Prepared statements of the RDBMS queries, shared with Traits
+        self.statements = StatementRegistry()
+        # Id of the user of each registered email. Kept up to date by add_user and delete_user, the ttl bounds
+        # how long a deletion made by another process goes unseen. The unregistered emails are not cached:
+        # another process sharing the database may register them at any time
+        self.user_ids = LRUCache(user_cache_size, user_cache_ttl)
+
+    @property
+    def rdbms_admin_connection(self):
+        """
+        The admin connection given to the constructor or, with a pool, the one borrowed by the current call
+        """
+        if self.rdbms_pool is not None:
+            return self.rdbms_pool.current()
+        return self._rdbms_admin_connection
+
+    @rdbms_admin_connection.setter
+    def rdbms_admin_connection(self, connection) -> None:
+        self._rdbms_admin_connection = connection
+
+    def _borrow(self):
+        return self.rdbms_pool.borrow() if self.rdbms_pool is not None else nullcontext()
 
     @staticmethod
     def generate_sql_initialization_code() -> List[str]:
@@ -58,7 +190,9 @@ class TraitsUtility(TraitsUtilityInterface):
                 FOREIGN KEY (train_id) REFERENCES trains(id),
                 FOREIGN KEY (start_train_station_id) REFERENCES train_stations(id),
                 FOREIGN KEY (end_train_station_id) REFERENCES train_stations(id),
-                CHECK (departure_date <= arrival_date)
+                CHECK (departure_date <= arrival_date),
+                -- Schedules of a train on a day (ride resolution, deleting a train)
+                INDEX schedules_by_train_day (train_id, departure_date, arrival_date)
             );''',
             '''CREATE TABLE IF NOT EXISTS tickets(
                 id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
@@ -66,15 +200,54 @@ class TraitsUtility(TraitsUtilityInterface):
                 schedule_id INT NOT NULL,
                 purchase_date DATETIME NOT NULL,
                 price DECIMAL(10, 2) NOT NULL,
+                departure_date DATE NOT NULL,
+                departure_time TIME NOT NULL,
                 FOREIGN KEY (user_id) REFERENCES users(id),
-                FOREIGN KEY (schedule_id) REFERENCES schedules(id)
+                FOREIGN KEY (schedule_id) REFERENCES schedules(id),
+                -- Tickets of a user newest departure first: the day of the booked ride and the departure time of
+                -- the schedule, so that a page of the purchase history is read straight from the index (keyset
+                -- pagination, deleting a user)
+                INDEX tickets_by_user (user_id, departure_date, departure_time, id),
+                INDEX tickets_by_schedule (schedule_id)
             );''',
+            # The seats are held from the stop where the passenger boards to the one where they alight (stop orders)
             '''CREATE TABLE IF NOT EXISTS seat_reservations(
                 id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
                 ticket_id INT NOT NULL,
                 number_of_seats INT NOT NULL,
+                board_stop INT NOT NULL,
+                alight_stop INT NOT NULL,
                 FOREIGN KEY (ticket_id) REFERENCES tickets(id),
-                CHECK (number_of_seats > 0)
+                CHECK (number_of_seats > 0),
+                CHECK (board_stop < alight_stop),
+                -- Covers the reservations read through their ticket (purchase history, released seats)
+                INDEX reservations_by_ticket (ticket_id, number_of_seats, board_stop, alight_stop)
+            );''',
+            # Trip count, spend and upcoming trip of each user, kept by the bookings and deletions in their own
+            # transactions so that a dashboard reads one row instead of joining the whole purchase history.
+            # The next trip is the earliest upcoming one as of the last write, looked up again by the next booking
+            # once it is past (the reads look it up without storing it)
+            '''CREATE TABLE IF NOT EXISTS user_purchase_summary(
+                user_id INT NOT NULL PRIMARY KEY,
+                trips INT NOT NULL DEFAULT 0,
+                total_spent DECIMAL(12, 2) NOT NULL DEFAULT 0,
+                next_ticket_id INT,
+                next_departure DATETIME,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                CHECK (trips >= 0)
+            );''',
+            # Seats reserved on each segment of a schedule on each day it runs (segment k goes from stop k to stop
+            # k + 1), kept next to the capacity so that a booking is one conditional UPDATE over the segments of the
+            # ride. The rows of a day are created by the first booking of a ride on that day
+            '''CREATE TABLE IF NOT EXISTS schedule_inventory(
+                schedule_id INT NOT NULL,
+                ride_date DATE NOT NULL,
+                segment INT NOT NULL,
+                capacity INT NOT NULL,
+                reserved INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (schedule_id, ride_date, segment),
+                FOREIGN KEY (schedule_id) REFERENCES schedules(id),
+                CHECK (reserved >= 0)
             );''',
             '''CREATE TABLE IF NOT EXISTS connections(
                 id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
@@ -83,7 +256,8 @@ class TraitsUtility(TraitsUtilityInterface):
                 travel_time_minutes INT NOT NULL,
                 FOREIGN KEY (start_station_id) REFERENCES train_stations(id),
                 FOREIGN KEY (end_station_id) REFERENCES train_stations(id),
-                CHECK (travel_time_minutes > 0)
+                CHECK (travel_time_minutes > 0),
+                INDEX connections_by_pair (start_station_id, end_station_id, travel_time_minutes)
             );''',
             '''CREATE TABLE IF NOT EXISTS schedule_stops(
                 id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
@@ -92,62 +266,82 @@ class TraitsUtility(TraitsUtilityInterface):
                 stop_order INT NOT NULL,
                 waiting_time INT NOT NULL,
                 FOREIGN KEY (schedule_id) REFERENCES schedules(id),
-                FOREIGN KEY (station_id) REFERENCES train_stations(id)
+                FOREIGN KEY (station_id) REFERENCES train_stations(id),
+                -- Covers the stops of a schedule in order (ride resolution, seat inventory)
+                INDEX stops_by_schedule (schedule_id, stop_order, station_id)
             );''',
         ]
 
+    @staticmethod
+    def generate_neo4j_initialization_code() -> List[str]:
+        """
+        Schema of the Neo4j graph: the stations are matched by id (unique, so looked up through the constraint
+        index instead of a scan of the Station label) and the connections filtered on their times
+        """
+        return [
+            "CREATE CONSTRAINT station_id IF NOT EXISTS FOR (s:Station) REQUIRE s.id IS UNIQUE",
+            "CREATE INDEX connected_to_travel_time IF NOT EXISTS FOR ()-[r:CONNECTED_TO]-() ON (r.travel_time)",
+            "CREATE INDEX connected_to_departure_time IF NOT EXISTS FOR ()-[r:CONNECTED_TO]-() ON (r.departure_time)",
+            "CREATE INDEX connected_to_arrival_time IF NOT EXISTS FOR ()-[r:CONNECTED_TO]-() ON (r.arrival_time)",
+        ]
+
+    def initialize_neo4j(self) -> None:
+        """
+        Apply generate_neo4j_initialization_code, the statements do nothing when the schema already exists
+        """
+        for statement in self.generate_neo4j_initialization_code():
+            try:
+                self.neo4j_driver.execute_query(statement)
+            except Exception as e:
+                # e.g. stations with the same id, the graph still works without the index
+                print(f"An error occurred during initializing Neo4j ({statement}): {e}")
+
+    @borrows_connection
     def get_all_users(self) -> List[TraitsKey]:
         """
         Return all the users stored in the database
         """
-        sql_query = "SELECT * FROM users"
         try:
-            cur = self.rdbms_admin_connection.cursor()
-            cur.execute(sql_query)
-            users = cur.fetchall()
-            cur.close()
+            users = self.statements.fetchall(self.rdbms_admin_connection, "SELECT * FROM users")
             return list(users)
         except Exception as e:
             print(f"An error occurred during getting all users: {e}")
 
+    @borrows_connection
     def get_all_schedules(self) -> List[TraitsKey]:
         """
         Return all the schedules stored in the database
         """
-        sql_query = "SELECT * FROM schedules"
         try:
-            cur = self.rdbms_admin_connection.cursor()
-            cur.execute(sql_query)
-            schedules = cur.fetchall()
-            cur.close()
+            schedules = self.statements.fetchall(self.rdbms_admin_connection, "SELECT * FROM schedules")
             return schedules
         except Exception as e:
             print(f"An error occurred during getting all schedules: {e}")
 
+    @borrows_connection
     def get_all_trains(self) -> List[TraitsKey]:
         """
         Return all the trains stored in the database
         """
-        sql_query = "SELECT * FROM trains"
         try:
-            cur = self.rdbms_admin_connection.cursor()
-            cur.execute(sql_query)
-            trains = cur.fetchall()
-            cur.close()
+            trains = self.statements.fetchall(self.rdbms_admin_connection, "SELECT * FROM trains")
             return trains
         except Exception as e:
             print(f"An error occurred during getting all trains: {e}")
 
+    @borrows_connection
     def get_user_by_email(self, user_email: str) -> Optional[Dict]:
         """
         Get the user details by email
         """
-        sql_query = f"SELECT * FROM users WHERE email = '{user_email}'"
         try:
-            cur = self.rdbms_admin_connection.cursor()
-            cur.execute(sql_query)
-            user = cur.fetchone()
-            cur.close()
+            user = self.statements.fetchone(self.rdbms_admin_connection,
+                                            "SELECT id, email, password, is_admin FROM users WHERE email = %s",
+                                            (user_email,))
+            if user:
+                self.user_ids.put(user_email.casefold(), user[0])
+            else:
+                self.user_ids.discard(user_email.casefold())
             if user:
                 return {"id": user[0], "email": user[1], "password": user[2], "is_admin": user[3]}
             else:
@@ -155,6 +349,30 @@ class TraitsUtility(TraitsUtilityInterface):
         except Exception as e:
             print(f"An error occurred during getting a user by email: {e}")
 
+    @borrows_connection
+    def get_user_id(self, user_email: str) -> Optional[int]:
+        """
+        Return the id of the user of the email, None if the email is not registered
+        """
+        return self.resolve_user_ids(self.rdbms_admin_connection, [user_email])[user_email]
+
+    def resolve_user_ids(self, db, user_emails: List[str]) -> Dict[str, Optional[int]]:
+        """
+        Return the user id (None if unregistered) of each email, from the user cache. The emails missing from the
+        cache are looked up with a single query on the RDBMS connection, the ids found are cached.
+        Emails compare case-insensitively, like the collation of users.email, the cache is keyed by their casefold
+        """
+        user_ids = {email: self.user_ids.get(email.casefold()) for email in user_emails}
+        missing = [email for email, user_id in user_ids.items() if user_id is None]
+        if missing:
+            found = {email.casefold(): user_id for email, user_id in self.statements.fetchall(
+                db, f"SELECT email, id FROM users WHERE email IN ({', '.join(['%s'] * len(missing))})", missing)}
+            for email in missing:
+                user_ids[email] = found.get(email.casefold())
+                if user_ids[email] is not None:
+                    self.user_ids.put(email.casefold(), user_ids[email])
+        return user_ids
+
     @staticmethod
     def convert_traits_key_to_int(traits_key: Optional[TraitsKey]) -> int:
         if traits_key is None:
@@ -173,16 +391,63 @@ class TraitsUtility(TraitsUtilityInterface):
 # Implement the main class that you need to implement
 class Traits(TraitsInterface):
 
-    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver) -> None:
+    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver, search_backend: str = "cypher",
+                 max_hops: Optional[int] = None, timetable_path: Optional[str] = None,
+                 search_cache_size: int = 1024, search_cache_ttl: Optional[float] = 60.0,
+                 fare_model: Optional[FareModel] = None, rdbms_pool: Optional[ConnectionPool] = None,
+                 user_cache_size: int = 4096, user_cache_ttl: Optional[float] = 300.0) -> None:
+        if search_backend not in SEARCH_BACKENDS:
+            raise ValueError(f"Unknown search backend {search_backend}, expected one of {SEARCH_BACKENDS}")
         self.rdbms_connection = rdbms_connection
+        # Pooled mode: with an rdbms_pool every public method borrows an admin connection from the pool and
+        # keeps one Neo4j session (from the pool of the driver) for the whole call, instead of using
+        # rdbms_admin_connection and a session per query
+        self.rdbms_pool = rdbms_pool
         self.rdbms_admin_connection = rdbms_admin_connection
         self.neo4j_driver = neo4j_driver
-        self.utility = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_driver)
+        self._local = local()
+        self.utility = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_driver, rdbms_pool,
+                                     user_cache_size, user_cache_ttl)
+        self.statements = self.utility.statements
+        if neo4j_driver is not None:
+            self.utility.initialize_neo4j()
+        self.search_backend = search_backend
+        # Maximum number of connections of a path returned by the static (non timetabled) searches: Yen's paths
+        # are bounded by DEFAULT_MAX_HOPS unless given, the Cypher enumeration only when given
+        self.max_hops = max_hops
+        # Adjacency of the CONNECTED_TO relationships, dropped whenever two stations get connected
+        self._station_graph = None
+        # Contraction Hierarchy of the connections, marked dirty (dropped) whenever two stations get connected
+        self._contraction_hierarchy = None
+        # Fare matrix of the station pairs priced by fare_model, dropped whenever two stations get connected
+        self.fare_model = fare_model if fare_model is not None else TravelTimeFare(PRICE_PER_MINUTE)
+        self._fare_engine = None
+        # Guards _fare_engine, the workers of BookingCoordinator price their bookings concurrently
+        self._fare_lock = Lock()
+        # Ids of the stations known to exist in Neo4j, filled by add_train_station and by the validations
+        self._known_stations = set()
+        # Number of Neo4j round trips of the last call of each method, e.g. round_trips["search_connections"]
+        self.round_trips: Dict[str, int] = {}
+        self._round_trips_lock = Lock()
+        # Timetable and routing engines built lazily from the schedules,
+        # dropped whenever the network or the schedules change
+        self._timetable = None
+        self._timetable_engines = {}
+        # Guards the lazily built station graph, Contraction Hierarchy, timetable and engines. They are loaded
+        # outside of it, and a load is only kept if no drop (which bumps the generation) happened meanwhile
+        self._cache_lock = Lock()
+        self._cache_generation = 0
+        # Optional snapshot file of the compiled timetable, shared by every instance pointing to it
+        self.timetable_path = timetable_path
+        # Results of search_connections by (start, end, day, is_departure_time, sort_by, is_ascending, limit),
+        # invalidated by the writes that can change them (search_cache_size=0 disables it)
+        self.search_cache = LRUCache(search_cache_size, search_cache_ttl)
 
     ########################################################################
     # Basic Features
     ########################################################################
 
+    @borrows_connection
     def search_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
                            travel_time_day: int = None, travel_time_month: int = None, travel_time_year: int = None,
                            is_departure_time=True,
@@ -203,17 +468,145 @@ class Traits(TraitsInterface):
         if starting_station_key is None or ending_station_key is None:
             raise ValueError("Starting and ending stations cannot be None")
 
-        # Check if the stations exist
-        neo_query = """
-            MATCH (s:Station {id: $station_id})
-            RETURN s
+        travel_day = None
+        if travel_time_day is not None and travel_time_month is not None and travel_time_year is not None:
+            travel_day = date(travel_time_year, travel_time_month, travel_time_day)
+        cache_key = (starting_station_key.to_int(), ending_station_key.to_int(), travel_day, is_departure_time,
+                     sort_by, is_ascending, limit)
+
+        with self._count_round_trips("search_connections"):
+            connections = self.search_cache.get(cache_key)
+            if connections is None:
+                self._check_stations_exist([starting_station_key, ending_station_key])
+                connections = self._search_connections(starting_station_key, ending_station_key,
+                                                       travel_time_day, travel_time_month, travel_time_year,
+                                                       is_departure_time, sort_by, is_ascending, limit)
+                self.search_cache.put(cache_key, connections)
+            return list(connections)
+
+    def _search_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                            travel_time_day: Optional[int], travel_time_month: Optional[int],
+                            travel_time_year: Optional[int], is_departure_time: bool,
+                            sort_by: SortingCriteria, is_ascending: bool, limit: int) -> List:
         """
-        for station_key in [starting_station_key, ending_station_key]:
-            with self.neo4j_driver.session() as session:
-                result = session.run(neo_query, station_id=station_key.to_int())
-                if result.single() is None:
-                    raise ValueError(f"Station with key {station_key.to_int()} does not exist in the database")
+        Run the search of search_connections on the configured backend, the stations are known to exist
+        """
+        if self.search_backend in TIMETABLE_ENGINES:
+            travel_day = None
+            if travel_time_day is not None and travel_time_month is not None and travel_time_year is not None:
+                travel_day = date(travel_time_year, travel_time_month, travel_time_day)
+            engine = self._get_timetable_engine(self.search_backend)
+            journeys = engine.journeys(starting_station_key.to_int(), ending_station_key.to_int(),
+                                       travel_day, is_departure_time, limit)
+            return sort_connections(self._price(journeys), sort_by, is_ascending, limit)
+
+        if self._uses_yen(sort_by, is_ascending, limit):
+            # Yen's paths come out by increasing cost, the longest ones and the price sorts (fares need not follow
+            # the minutes) are left to the Cypher enumeration
+            graph = self._get_station_graph()
+            by_hops = sort_by == SortingCriteria.NUMBER_OF_TRAIN_CHANGES
+            paths = graph.k_shortest_paths(starting_station_key.to_int(), ending_station_key.to_int(), limit,
+                                           self._yen_max_hops(), by_hops)
+            return self._price([path_to_connection(graph, path) for _, path in paths])
+
+        if self.search_backend == "ch" and sort_by == SortingCriteria.OVERALL_TRAVEL_TIME and is_ascending:
+            hierarchy = self._get_contraction_hierarchy()
+            fastest = hierarchy.shortest_path(starting_station_key.to_int(), ending_station_key.to_int())
+            return [] if fastest is None or limit <= 0 else self._price([path_to_connection(hierarchy.graph,
+                                                                                              fastest[1])])
+
+        return self._cypher_search_connections(starting_station_key, ending_station_key, travel_time_day,
+                                               travel_time_month, travel_time_year, is_departure_time,
+                                               sort_by, is_ascending, limit)
+
+    def _cypher_search_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                                   travel_time_day: Optional[int], travel_time_month: Optional[int],
+                                   travel_time_year: Optional[int], is_departure_time: bool,
+                                   sort_by: SortingCriteria, is_ascending: bool, limit: int) -> List:
+        """
+        Enumerate the paths between the two stations in Neo4j.
+        The fares need not follow the travel minutes Cypher orders by, a price sort reprices every path before
+        cutting to limit
+        """
+        if sort_by == SortingCriteria.ESTIMATED_PRICE:
+            candidates = list(self._cypher_iter_connections(starting_station_key, ending_station_key,
+                                                            travel_time_day, travel_time_month, travel_time_year,
+                                                            is_departure_time, sort_by, is_ascending, None))
+            return sort_connections(candidates, sort_by, is_ascending, limit)
+        return list(self._cypher_iter_connections(starting_station_key, ending_station_key, travel_time_day,
+                                                  travel_time_month, travel_time_year, is_departure_time,
+                                                  sort_by, is_ascending, limit))
+
+    def _uses_yen(self, sort_by: SortingCriteria, is_ascending: bool, limit: int) -> bool:
+        """
+        Tell whether Yen answers the search: the ascending ones of the "yen" backend, price sorts aside, and the
+        travel time ones of the "ch" backend asking for more than the single fastest path
+        """
+        if not is_ascending or sort_by == SortingCriteria.ESTIMATED_PRICE:
+            return False
+        return self.search_backend == "yen" or (
+            self.search_backend == "ch" and sort_by == SortingCriteria.OVERALL_TRAVEL_TIME and limit > 1)
+
+    def _yen_max_hops(self) -> int:
+        return DEFAULT_MAX_HOPS if self.max_hops is None else self.max_hops
+
+    def _cypher_hops(self) -> str:
+        """
+        Return the length bound of the CONNECTED_TO patterns: none unless max_hops was given
+        """
+        return "" if self.max_hops is None else f"1..{int(self.max_hops)}"
+
+    def _cypher_iter_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                                 travel_time_day: Optional[int], travel_time_month: Optional[int],
+                                 travel_time_year: Optional[int], is_departure_time: bool,
+                                 sort_by: SortingCriteria, is_ascending: bool,
+                                 limit: Optional[int]) -> Iterator[Journey]:
+        """
+        Yield the paths of _cypher_search_connections as the records arrive from Neo4j, all of them if limit is None.
+        The session stays open until the generator is exhausted or closed
+        """
+        travel_time_constraints, travel_time, sort_f, sort_order = self._cypher_search_clauses(
+            travel_time_day, travel_time_month, travel_time_year, is_departure_time, sort_by, is_ascending)
+
+        neo_query = f"""
+            MATCH path=(start:Station {{id: $start_spot}})-[:CONNECTED_TO*{self._cypher_hops()}]->(end:Station {{id: $end_spot}})
+            WITH path, reduce(minutes = 0, r IN relationships(path) | minutes + r.travel_time) as travel_time,
+                 size([r in relationships(path) | r]) - 1 as train_changes, 0 as waiting_time,
+                 reduce(minutes = 0, r IN relationships(path) | minutes + r.travel_time) as estimated_price
+            WHERE 1=1 {travel_time_constraints}
+            RETURN [n IN nodes(path) | n.id] AS stations, [r IN relationships(path) | r.travel_time] AS travel_times,
+                   travel_time, train_changes
+            ORDER BY {sort_f} {sort_order}
+            {"" if limit is None else "LIMIT $limit"}
+        """
+        try:
+            self._neo4j_round_trips += 1
+            with self._neo4j_session() as session:
+                result = session.run(neo_query, start_spot=starting_station_key.to_int(),
+                                     end_spot=ending_station_key.to_int(), limit=limit, travel_time=travel_time)
+                for record in result:
+                    yield self._price([self._record_to_journey(record)])[0]
 
+        except Exception as e:
+            raise ValueError(f"An error occurred while searching for train connections: {e}")
+
+    @staticmethod
+    def _record_to_journey(record) -> Journey:
+        """
+        Build the Journey of a path found by Cypher from its station ids and connection travel times,
+        without keeping the Neo4j Path
+        """
+        return Journey(list(record["stations"]), record["travel_time"], record["train_changes"], 0,
+                       sum(record["travel_times"]) * PRICE_PER_MINUTE)
+
+    @staticmethod
+    def _cypher_search_clauses(travel_time_day: Optional[int], travel_time_month: Optional[int],
+                               travel_time_year: Optional[int], is_departure_time: bool,
+                               sort_by: SortingCriteria, is_ascending: bool) -> Tuple[str, Optional[str], str, str]:
+        """
+        Return the travel time constraints, the travel_time parameter, the sort field and the sort order
+        of the Cypher searches
+        """
         sort_order = "ASC" if is_ascending else "DESC"
         sort_f = {
             SortingCriteria.OVERALL_TRAVEL_TIME: "travel_time",
@@ -231,54 +624,529 @@ class Traits(TraitsInterface):
                 travel_time_constraints = "AND all(r in relationships(path) WHERE r.departure_time >= $travel_time)"
             else:
                 travel_time_constraints = "AND all(r in relationships(path) WHERE r.arrival_time <= $travel_time)"
+        return travel_time_constraints, travel_time, sort_f, sort_order
+
+    def iter_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                         travel_time_day: int = None, travel_time_month: int = None, travel_time_year: int = None,
+                         is_departure_time=True,
+                         sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME, is_ascending: bool = True,
+                         limit: int = 5) -> Iterator[Journey]:
+        """
+        Generator variant of search_connections: yield the same connections in the same order, each one as soon
+        as it is produced, so that the caller can stop early.
+        The Cypher records are consumed as they arrive and Yen's paths are computed one at a time; the timetable
+        and Contraction Hierarchy backends need their (limit bounded) candidates before ordering them.
+        Once exhausted, the connections are stored in the search cache.
+        Raise a ValueError, when called, if the starting or ending stations are the same or None
+        """
+        if starting_station_key == ending_station_key:
+            raise ValueError("Starting and ending stations are the same")
+
+        if starting_station_key is None or ending_station_key is None:
+            raise ValueError("Starting and ending stations cannot be None")
+
+        travel_day = None
+        if travel_time_day is not None and travel_time_month is not None and travel_time_year is not None:
+            travel_day = date(travel_time_year, travel_time_month, travel_time_day)
+        cache_key = (starting_station_key.to_int(), ending_station_key.to_int(), travel_day, is_departure_time,
+                     sort_by, is_ascending, limit)
+        return self._iter_connections(cache_key, starting_station_key, ending_station_key, travel_time_day,
+                                      travel_time_month, travel_time_year, is_departure_time, sort_by,
+                                      is_ascending, limit)
+
+    @borrows_connection
+    def _iter_connections(self, cache_key: Tuple, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                          travel_time_day: Optional[int], travel_time_month: Optional[int],
+                          travel_time_year: Optional[int], is_departure_time: bool,
+                          sort_by: SortingCriteria, is_ascending: bool, limit: int) -> Iterator[Journey]:
+        """
+        Generator behind iter_connections, the arguments are already validated
+        """
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            yield from list(cached)
+            return
+
+        with self._count_round_trips("iter_connections"):
+            self._check_stations_exist([starting_station_key, ending_station_key])
+            if limit <= 0:
+                connections = iter(())
+            elif self._uses_yen(sort_by, is_ascending, limit):
+                graph = self._get_station_graph()
+                by_hops = sort_by == SortingCriteria.NUMBER_OF_TRAIN_CHANGES
+                paths = graph.iter_shortest_paths(starting_station_key.to_int(), ending_station_key.to_int(),
+                                                  self._yen_max_hops(), by_hops)
+                connections = (self._price([path_to_connection(graph, path)])[0] for _, path in islice(paths, limit))
+            elif self.search_backend in TIMETABLE_ENGINES or sort_by == SortingCriteria.ESTIMATED_PRICE or (
+                    self.search_backend == "ch" and sort_by == SortingCriteria.OVERALL_TRAVEL_TIME and is_ascending):
+                connections = iter(self._search_connections(starting_station_key, ending_station_key, travel_time_day,
+                                                            travel_time_month, travel_time_year, is_departure_time,
+                                                            sort_by, is_ascending, limit))
+            else:
+                connections = self._cypher_iter_connections(starting_station_key, ending_station_key, travel_time_day,
+                                                            travel_time_month, travel_time_year, is_departure_time,
+                                                            sort_by, is_ascending, limit)
+            produced = []
+            for connection in connections:
+                produced.append(connection)
+                yield connection
+            self.search_cache.put(cache_key, produced)
+
+    @borrows_connection
+    def search_connections_many(self, starting_station_key: TraitsKey, ending_station_keys: List[TraitsKey],
+                                travel_time_day: int = None, travel_time_month: int = None,
+                                travel_time_year: int = None, is_departure_time=True,
+                                sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME,
+                                is_ascending: bool = True, limit: int = 5) -> List[List]:
+        """
+        Search the connections from one starting station to each of the ending stations.
+        Return one list of connections per ending station, in the same order and format as search_connections.
+        The stations are validated together and the searches not found in the cache run as a single
+        one-to-many search: one Cypher query, one CSA or RAPTOR sweep
+        Raise a ValueError in case of errors and if an ending station is the starting one
+        """
+        if starting_station_key is None or any(key is None for key in ending_station_keys):
+            raise ValueError("Starting and ending stations cannot be None")
+        start = starting_station_key.to_int()
+        ends = [key.to_int() for key in ending_station_keys]
+        if start in ends:
+            raise ValueError("Starting and ending stations are the same")
 
+        travel_day = None
+        if travel_time_day is not None and travel_time_month is not None and travel_time_year is not None:
+            travel_day = date(travel_time_year, travel_time_month, travel_time_day)
+
+        with self._count_round_trips("search_connections_many"):
+            found = {}
+            for end in ends:
+                connections = self.search_cache.get((start, end, travel_day, is_departure_time,
+                                                     sort_by, is_ascending, limit))
+                if connections is not None:
+                    found[end] = connections
+            missing = [end for end in dict.fromkeys(ends) if end not in found]
+            if missing:
+                self._check_stations_exist([starting_station_key] + [TraitsKey(end) for end in missing])
+                searched = self._search_connections_many(start, missing, travel_time_day, travel_time_month,
+                                                         travel_time_year, travel_day, is_departure_time,
+                                                         sort_by, is_ascending, limit)
+                for end, connections in searched.items():
+                    self.search_cache.put((start, end, travel_day, is_departure_time, sort_by, is_ascending, limit),
+                                          connections)
+                found.update(searched)
+            return [list(found[end]) for end in ends]
+
+    def _search_connections_many(self, start: int, ends: List[int], travel_time_day: Optional[int],
+                                 travel_time_month: Optional[int], travel_time_year: Optional[int],
+                                 travel_day: Optional[date], is_departure_time: bool,
+                                 sort_by: SortingCriteria, is_ascending: bool, limit: int) -> Dict[int, List]:
+        """
+        Run the one-to-many search of search_connections_many on the configured backend
+        """
+        if self.search_backend in TIMETABLE_ENGINES:
+            engine = self._get_timetable_engine(self.search_backend)
+            if not is_departure_time:
+                # Arriving before queries keep the latest arrivals of each ending station, one query per ending
+                # station (the RAPTOR range query of the starting station is cached)
+                journeys = {end: engine.journeys(start, end, travel_day, is_departure_time, limit) for end in ends}
+            else:
+                journeys = engine.journeys_many(start, ends, travel_day, limit)
+            self._price([journey for end in ends for journey in journeys[end]])
+            return {end: sort_connections(journeys[end], sort_by, is_ascending, limit) for end in ends}
+
+        if self._uses_yen(sort_by, is_ascending, limit):
+            # The adjacency is cached, the searches of the ending stations cost no round trip
+            graph = self._get_station_graph()
+            by_hops = sort_by == SortingCriteria.NUMBER_OF_TRAIN_CHANGES
+            max_hops = self._yen_max_hops()
+            connections = {end: [path_to_connection(graph, path)
+                                 for _, path in graph.k_shortest_paths(start, end, limit, max_hops, by_hops)]
+                           for end in ends}
+            self._price([journey for end in ends for journey in connections[end]])
+            return connections
+
+        if self.search_backend == "ch" and sort_by == SortingCriteria.OVERALL_TRAVEL_TIME and is_ascending:
+            hierarchy = self._get_contraction_hierarchy()
+            connections = {}
+            for end in ends:
+                fastest = hierarchy.shortest_path(start, end)
+                connections[end] = [] if fastest is None or limit <= 0 else \
+                    [path_to_connection(hierarchy.graph, fastest[1])]
+            self._price([journey for end in ends for journey in connections[end]])
+            return connections
+
+        travel_time_constraints, travel_time, sort_f, sort_order = self._cypher_search_clauses(
+            travel_time_day, travel_time_month, travel_time_year, is_departure_time, sort_by, is_ascending)
+
+        # A single expansion from the starting station, the paths are grouped by ending station. The fares need not
+        # follow the travel minutes, a price sort keeps every path of an ending station and reprices them all
+        found_slice = "" if sort_by == SortingCriteria.ESTIMATED_PRICE else "[..$limit]"
         neo_query = f"""
-            MATCH path=(start:Station {{id: $start_spot}})-[:CONNECTED_TO*]->(end:Station {{id: $end_spot}})
-            WITH path, length(path) as travel_time, size([r in relationships(path) | r]) - 1 as train_changes  
+            MATCH path=(start:Station {{id: $start_spot}})-[:CONNECTED_TO*{self._cypher_hops()}]->(end:Station)
+            WHERE end.id IN $end_spots
+            WITH end, path, reduce(minutes = 0, r IN relationships(path) | minutes + r.travel_time) as travel_time,
+                 size([r in relationships(path) | r]) - 1 as train_changes, 0 as waiting_time,
+                 reduce(minutes = 0, r IN relationships(path) | minutes + r.travel_time) as estimated_price
             WHERE 1=1 {travel_time_constraints}
-            RETURN path, travel_time, train_changes
+            WITH end.id AS end_id, path, travel_time, train_changes, waiting_time, estimated_price
             ORDER BY {sort_f} {sort_order}
-            LIMIT $limit
+            WITH end_id, collect({{stations: [n IN nodes(path) | n.id],
+                                   travel_times: [r IN relationships(path) | r.travel_time],
+                                   travel_time: travel_time, train_changes: train_changes}}){found_slice} AS found
+            RETURN end_id, found
         """
         try:
-            with self.neo4j_driver.session() as session:
-                result = session.run(neo_query, start_spot=starting_station_key.to_int(),
-                                     end_spot=ending_station_key.to_int(), limit=limit, travel_time=travel_time)
-                connections = []
+            self._neo4j_round_trips += 1
+            with self._neo4j_session() as session:
+                result = session.run(neo_query, start_spot=start, end_spots=ends, limit=limit,
+                                     travel_time=travel_time)
+                connections = {end: [] for end in ends}
                 for record in result:
-                    path = record["path"]
-                    travel_time = record["travel_time"]
-                    num_changes = record["train_changes"]
-                    connections.append({
-                        "path": path,
-                        "travel_time": travel_time,
-                        "num_changes": num_changes
-                    })
-                return connections
-
+                    connections[record["end_id"]] = [self._record_to_journey(found) for found in record["found"]]
         except Exception as e:
             raise ValueError(f"An error occurred while searching for train connections: {e}")
 
+        self._price([journey for end in ends for journey in connections[end]])
+        if sort_by == SortingCriteria.ESTIMATED_PRICE:
+            connections = {end: sort_connections(connections[end], sort_by, is_ascending, limit) for end in ends}
+        return connections
+
+    @borrows_connection
+    def reachable_stations(self, station_key: TraitsKey, max_minutes: int, date: Optional[date] = None,
+                           departure_hours_24_h: int = 0, departure_minutes: int = 0) -> Dict[int, int]:
+        """
+        Return every station reachable from the given one within max_minutes, leaving not before the departure
+        time, mapped to its earliest arrival in minutes since midnight (the station itself included).
+        The timetable backends ride the trains running on date (any trip if no date is given),
+        the others travel the CONNECTED_TO graph without waiting
+        Raise a ValueError if the station does not exist or max_minutes is negative
+        """
+        if station_key is None:
+            raise ValueError("Station cannot be None")
+        if max_minutes < 0:
+            raise ValueError("The time budget cannot be negative")
+        departure = departure_hours_24_h * 60 + departure_minutes
+
+        with self._count_round_trips("reachable_stations"):
+            self._check_stations_exist([station_key])
+            if self.search_backend in TIMETABLE_ENGINES:
+                # Earliest arrivals do not need the multi-criteria search, a single connection scan answers them
+                engine = self._get_timetable_engine("csa")
+                source = engine.timetable.station_index.get(station_key.to_int())
+                if source is None:
+                    return {station_key.to_int(): departure}
+                arrivals = engine.reachable(source, departure, departure + max_minutes,
+                                            engine.timetable.active_trips(date))
+                return {int(engine.timetable.station_ids[station]): arrival for station, arrival in arrivals.items()}
+
+            costs = self._get_station_graph().reachable(station_key.to_int(), max_minutes)
+            return {station: departure + cost for station, cost in costs.items()}
+
+    @borrows_connection
+    def rebuild_transfer_patterns(self, station_keys: Optional[List[TraitsKey]] = None) -> Dict:
+        """
+        Precompute the transfer patterns used by the "patterns" search backend from the given source stations.
+        Without station keys the rebuild is incremental: only the stations never built, or built against
+        a timetable changed since, are processed.
+        Return the size of the index and the build time of this rebuild (see TransferPatterns.stats)
+        """
+        engine = self._get_timetable_engine("patterns")
+        if station_keys is not None:
+            sources = [key.to_int() for key in station_keys]
+        else:
+            sources = [station for station in engine.timetable.station_ids.tolist()
+                       if station in engine.stale or station not in engine.patterns]
+        stats = engine.build(sources)
+        # The searches from the rebuilt stations are now answered by their patterns
+        rebuilt = set(sources)
+        self.search_cache.invalidate(lambda key, connections: key[0] in rebuilt)
+        return stats
+
+    @property
+    def rdbms_admin_connection(self):
+        """
+        The admin connection given to the constructor or, with a pool, the one borrowed by the current call
+        """
+        if self.rdbms_pool is not None:
+            return self.rdbms_pool.current()
+        return self._rdbms_admin_connection
+
+    @rdbms_admin_connection.setter
+    def rdbms_admin_connection(self, connection) -> None:
+        self._rdbms_admin_connection = connection
+
+    @contextmanager
+    def _borrow(self):
+        """
+        Borrow the RDBMS connection of a public method call from the pool, nested calls share it.
+        The Neo4j session opened during the call is closed with it
+        """
+        if self.rdbms_pool is None or self.rdbms_pool.current() is not None:
+            yield
+            return
+        with self.rdbms_pool.borrow():
+            try:
+                yield
+            finally:
+                session = getattr(self._local, "neo4j_session", None)
+                self._local.neo4j_session = None
+                if session is not None:
+                    session.close()
+
+    @contextmanager
+    def _neo4j_session(self):
+        """
+        Return the Neo4j session of the current call in pooled mode, a new session otherwise
+        """
+        if self.rdbms_pool is None or self.rdbms_pool.current() is None:
+            with self.neo4j_driver.session() as session:
+                yield session
+            return
+        session = getattr(self._local, "neo4j_session", None)
+        if session is None:
+            session = self._local.neo4j_session = self.neo4j_driver.session()
+        yield session
+
+    @property
+    def _neo4j_round_trips(self) -> int:
+        """
+        Neo4j round trips of the current call, counted per thread
+        """
+        return getattr(self._local, "neo4j_round_trips", 0)
+
+    @_neo4j_round_trips.setter
+    def _neo4j_round_trips(self, round_trips: int) -> None:
+        self._local.neo4j_round_trips = round_trips
+
+    @contextmanager
+    def _count_round_trips(self, method: str):
+        """
+        Record in round_trips[method] the number of Neo4j round trips done inside the block
+        """
+        self._neo4j_round_trips = 0
+        try:
+            yield
+        finally:
+            with self._round_trips_lock:
+                self.round_trips[method] = self._neo4j_round_trips
+
+    def _check_stations_exist(self, station_keys: List[TraitsKey]) -> None:
+        """
+        Raise a ValueError if any of the stations does not exist.
+        Stations already known cost nothing, all the others are checked with a single Neo4j query
+        """
+        station_ids = [station_key.to_int() for station_key in station_keys]
+        unknown_ids = [station_id for station_id in station_ids if station_id not in self._known_stations]
+        if not unknown_ids:
+            return
+        self._neo4j_round_trips += 1
+        with self._neo4j_session() as session:
+            result = session.run("""
+                UNWIND $station_ids AS station_id
+                MATCH (s:Station {id: station_id})
+                RETURN s.id AS id
+            """, station_ids=unknown_ids)
+            self._known_stations.update(record["id"] for record in result)
+        for station_id in unknown_ids:
+            if station_id not in self._known_stations:
+                raise ValueError(f"Station with key {station_id} does not exist in the database")
+
+    def _invalidate_search_cache(self, day_ranges: Optional[List[Tuple[date, date]]] = None,
+                                 station_id: Optional[int] = None, train_id: Optional[int] = None) -> int:
+        """
+        Drop the cached searches that a write can have changed:
+        - day_ranges: schedules running on these days were added or removed. Only the timetable backends
+          read the schedules, their searches on one of these days (or on any day) are dropped
+        - station_id: searches from or to the station
+        - train_id: searches whose journeys ride the train
+        Return the number of dropped searches
+        """
+        def is_stale(key, connections) -> bool:
+            start, end, day = key[:3]
+            if day_ranges is not None and self.search_backend in TIMETABLE_ENGINES:
+                if day is None or any(valid_from <= day <= valid_until for valid_from, valid_until in day_ranges):
+                    return True
+            if station_id is not None and station_id in (start, end):
+                return True
+            if train_id is not None:
+                return any(leg.train_id == train_id
+                           for connection in connections for leg in connection.legs)
+            return False
+
+        return self.search_cache.invalidate(is_stale)
+
+    def _drop_cached(self, *names: str) -> None:
+        """
+        Drop the given lazily built attributes, the loads running meanwhile are not kept
+        """
+        with self._cache_lock:
+            self._cache_generation += 1
+            for name in names:
+                setattr(self, name, None)
+
+    def _cached(self, name: str):
+        """
+        Return the lazily built attribute and the generation its load must still match to be kept
+        """
+        with self._cache_lock:
+            return getattr(self, name), self._cache_generation
+
+    def _keep_cached(self, generation: int, **values) -> None:
+        """
+        Store the loaded attributes, unless they were dropped since the load started
+        """
+        with self._cache_lock:
+            if self._cache_generation == generation:
+                for name, value in values.items():
+                    setattr(self, name, value)
+
+    def _get_station_graph(self):
+        """
+        Return the cached adjacency of the station graph, loading it from Neo4j if needed
+        """
+        graph, generation = self._cached("_station_graph")
+        if graph is None:
+            self._neo4j_round_trips += 1
+            with self._neo4j_session() as session:
+                graph = load_station_graph(session)
+            self._keep_cached(generation, _station_graph=graph)
+        return graph
+
+    def _get_contraction_hierarchy(self) -> ContractionHierarchy:
+        """
+        Return the Contraction Hierarchy of the station graph, building it from the connections table if it is
+        missing or dirty
+        """
+        hierarchy, generation = self._cached("_contraction_hierarchy")
+        if hierarchy is None:
+            hierarchy = ContractionHierarchy(load_connections_graph(self.statements.bound(self.rdbms_admin_connection)))
+            self._keep_cached(generation, _contraction_hierarchy=hierarchy)
+        return hierarchy
+
+    def _get_fare_engine(self, db=None) -> FareEngine:
+        """
+        Return the fare matrix of the stations, computing it with the fare model from the connections table
+        if it is missing or dirty. It is loaded on the RDBMS connection db, by default the admin connection
+        """
+        with self._fare_lock:
+            if self._fare_engine is None:
+                cur = self.statements.bound(self.rdbms_admin_connection if db is None else db)
+                self._fare_engine = FareEngine(load_connections_graph(cur), self.fare_model)
+            return self._fare_engine
+
+    def _price(self, journeys: List[Journey]) -> List[Journey]:
+        """
+        Set the estimated price of the journeys from the fare matrix, in one lookup for all of them
+        """
+        return self._get_fare_engine().price(journeys) if journeys else journeys
+
+    @borrows_connection
+    def rebuild_contraction_hierarchy(self, benchmark_queries: int = 0) -> Dict:
+        """
+        Rebuild the Contraction Hierarchy used by the "ch" search backend and return its stats.
+        With benchmark_queries, as many random station pairs are also searched with the hierarchy and with the
+        Cypher path enumeration, and the stats report the average duration of both (in seconds) and the speedup
+        """
+        self._drop_cached("_contraction_hierarchy")
+        hierarchy = self._get_contraction_hierarchy()
+        stats = hierarchy.stats()
+        stations = sorted(hierarchy.rank)
+        if benchmark_queries > 0 and len(stations) > 1:
+            generator = Random(0)
+            pairs = [tuple(generator.sample(stations, 2)) for _ in range(benchmark_queries)]
+            started = perf_counter()
+            for start, end in pairs:
+                hierarchy.shortest_path(start, end)
+            stats["ch_query_seconds"] = (perf_counter() - started) / len(pairs)
+            started = perf_counter()
+            for start, end in pairs:
+                self._cypher_search_connections(TraitsKey(start), TraitsKey(end), None, None, None, True,
+                                                SortingCriteria.OVERALL_TRAVEL_TIME, True, 1)
+            stats["cypher_query_seconds"] = (perf_counter() - started) / len(pairs)
+            stats["speedup"] = stats["cypher_query_seconds"] / max(stats["ch_query_seconds"], 1e-9)
+        return stats
+
+    @borrows_connection
+    def benchmark_station_lookups(self, queries: int = 100) -> Dict:
+        """
+        Look up as many random stations by id through the Station.id constraint and with a scan of the Station
+        label (what every lookup was without the constraint), and report the average duration of both
+        (in seconds) and the speedup
+        """
+        records, _, _ = self.neo4j_driver.execute_query("MATCH (s:Station) RETURN s.id AS id")
+        stations = sorted(record["id"] for record in records)
+        stats = {"stations": len(stations)}
+        if queries <= 0 or not stations:
+            return stats
+        generator = Random(0)
+        station_ids = [generator.choice(stations) for _ in range(queries)]
+        lookups = {
+            "scan": "MATCH (s:Station) USING SCAN s:Station WHERE s.id = $station_id RETURN s.id",
+            "index": "MATCH (s:Station {id: $station_id}) RETURN s.id",
+        }
+        with self._neo4j_session() as session:
+            for name, query in lookups.items():
+                started = perf_counter()
+                for station_id in station_ids:
+                    session.run(query, station_id=station_id).consume()
+                stats[f"{name}_query_seconds"] = (perf_counter() - started) / queries
+        stats["speedup"] = stats["scan_query_seconds"] / max(stats["index_query_seconds"], 1e-9)
+        return stats
+
+    def _get_timetable_engine(self, backend: str):
+        """
+        Return the routing engine of the given backend, (re)building the timetable from the RDBMS if needed.
+        With a timetable_path the snapshot file is mapped instead, unless it is missing or stale, in which
+        case it is rebuilt and written back for the next instances
+        """
+        with self._cache_lock:
+            timetable, engines, generation = self._timetable, self._timetable_engines, self._cache_generation
+        if timetable is None:
+            # The loaders run through the prepared statements of the registry
+            cur = self.statements.bound(self.rdbms_admin_connection)
+            if self.timetable_path is None:
+                timetable = load_timetable(cur)
+            else:
+                stamp = timetable_generation(cur)
+                timetable = open_timetable(self.timetable_path, stamp)
+                if timetable is None:
+                    timetable = load_timetable(cur, stamp)
+                    save_timetable(timetable, self.timetable_path)
+            # The transfer patterns survive the new timetable, as stale until rebuilt
+            patterns = engines.get("patterns")
+            engines = {} if patterns is None else {"patterns": patterns.refreshed(timetable)}
+        engine = engines.get(backend)
+        if engine is None:
+            if backend == "raptor":
+                # The price criterion of the Pareto sets comes from the same fare matrix as the returned prices
+                engine = Raptor(timetable, fare=self._get_fare_engine().leg_fare)
+            else:
+                engine = TIMETABLE_ENGINES[backend](timetable)
+            # The engines are replaced, not updated: a dropped timetable keeps the dictionary of its own engines
+            engines = dict(engines, **{backend: engine})
+        self._keep_cached(generation, _timetable=timetable, _timetable_engines=engines)
+        return engine
+
+    @borrows_connection
     def get_train_current_status(self, train_key: TraitsKey) -> Optional[TrainStatus]:
         """
         Check the status of a train. If the train does not exist returns None
         """
-        with self.rdbms_admin_connection.cursor() as cur:
-            cur.execute(f"SELECT status FROM trains WHERE id = {train_key.to_int()}")
-            result = cur.fetchone()
-            if result:
-                status = result[0]
-                try:
-                    return TrainStatus[status]
-                except KeyError:
-                    raise ValueError(f"Invalid train status: {status}")
-            else:
-                return None
+        result = self.statements.fetchone(self.rdbms_admin_connection, "SELECT status FROM trains WHERE id = %s",
+                                          (train_key.to_int(),))
+        if result:
+            status = result[0]
+            try:
+                return TrainStatus[status]
+            except KeyError:
+                raise ValueError(f"Invalid train status: {status}")
+        else:
+            return None
 
     ########################################################################
     # Advanced Features
     ########################################################################
 
+    @borrows_connection
     def buy_ticket(self, user_email: str, connection, also_reserve_seats=True):
         """
                 Given a train connection instance (e.g., on a given date/time), registered users can book tickets and optionally reserve seats. When the user decides to reserve seats, the system will try to reserve all the available seats automatically.
@@ -293,50 +1161,171 @@ class Traits(TraitsInterface):
                 """
         if connection is None:
             raise ValueError("Connection cannot be None")
-        cur = self.rdbms_admin_connection.cursor()
+        self.buy_tickets([user_email], connection, also_reserve_seats)
+
+    @borrows_connection
+    def buy_tickets(self, user_emails: List[str], connection, also_reserve_seats=True) -> List[int]:
+        """
+        Buy the tickets of a group: one ticket per passenger email (and a seat each if also_reserve_seats),
+        on the connection of buy_ticket. The group is booked all-or-nothing in a single transaction: either every
+        passenger gets a ticket (and a seat) or none does.
+        The connection names the schedule (schedule_id, or train_id and departure_date) and optionally the ride on it
+        (from_station_id and to_station_id, the whole run by default). Seats are only held on the segments of the
+        ride, so they can be sold again before the boarding stop and after the alighting one.
+        Return the ids of the tickets, in the order of the emails.
+
+        If a user does not exist or there are not enough seats left for the whole group, raise a ValueError
+        """
+        if connection is None:
+            raise ValueError("Connection cannot be None")
+        if not user_emails:
+            return []
         try:
-            # Check if the user exists
-            user = self.utility.get_user_by_email(user_email)
-            if not user:
-                raise ValueError("User does not exist")
-            # Find the user id and schedule id
-            cur.execute(f"SELECT id FROM users WHERE email = '{user_email}'")
-            user_id = cur.fetchone()[0]
-            cur.execute(
-                f"SELECT id FROM schedules WHERE train_id = {connection['train_id']} AND departure_date = '{connection['departure_date']}'")
-            schedule_id = cur.fetchone()[0]
-
-            # Check for available seats if also_reserve_seats is True
-            if also_reserve_seats:
-                cur.execute(f"SELECT capacity FROM trains WHERE id = {connection['train_id']}")
-                train_capacity = cur.fetchone()[0]
-                cur.execute(
-                    f"SELECT SUM(number_of_seats) FROM seat_reservations WHERE ticket_id IN (SELECT id FROM tickets WHERE schedule_id = {schedule_id})")
-                reserved_seats = cur.fetchone()[0] or 0
-                available_seats = train_capacity - reserved_seats
-
-                if available_seats <= 0:
-                    raise ValueError("No available seats for reservation")
-
-                # Buy the ticket
-                cur.execute(
-                    f"INSERT INTO tickets (user_id, schedule_id, purchase_date, price) VALUES ({user_id}, {schedule_id}, NOW(), {connection['price']})")
-                ticket_id = cur.lastrowid
-
-                # Reserve seats if also_reserve_seats is True
-                if also_reserve_seats:
-                    cur.execute(
-                        f"INSERT INTO seat_reservations (ticket_id, number_of_seats) VALUES ({ticket_id}, 1)")
-
-                self.rdbms_admin_connection.commit()
+            ticket_ids = self._book(self.rdbms_admin_connection, user_emails, connection, also_reserve_seats)
+            self.rdbms_admin_connection.commit()
+            return ticket_ids
 
         except Exception as e:
             self.rdbms_admin_connection.rollback()
             raise ValueError(f"An error occurred during buying a ticket: {e}")
 
-        finally:
-            cur.close()
+    def _book(self, db, user_emails: List[str], connection, also_reserve_seats: bool) -> List[int]:
+        """
+        Run the statements of buy_tickets on the RDBMS connection and return the ticket ids,
+        the caller commits or rolls back
+        """
+        # Resolve all the passengers at once, no query at all when they are all in the user cache
+        user_ids = self.utility.resolve_user_ids(db, list(dict.fromkeys(user_emails)))
+        missing = [email for email, user_id in user_ids.items() if user_id is None]
+        if missing:
+            raise ValueError(f"User does not exist: {', '.join(missing)}")
+
+        schedule_id, start_station_id, end_station_id, board, alight, ride_date = self._resolve_ride(db, connection)
+        # The fare comes from the fare matrix (cents), the connection price only for the pairs it cannot price
+        fares = self._get_fare_engine(db)
+        if fares.has_fare(start_station_id, end_station_id):
+            price = fares.fare(start_station_id, end_station_id) / 100
+        elif connection.get('price') is not None:
+            price = connection['price']
+        else:
+            raise ValueError(f"No fare for the ride from station {start_station_id} to station {end_station_id}")
+
+        # Take the seats of the whole group on every segment of the ride: the UPDATE only matches the segments
+        # with enough seats left, so concurrent bookings cannot oversell and no reservation has to be counted.
+        # Missing a segment rolls the whole booking back. The segments not booked yet on the day of the ride
+        # start with the capacity of the train
+        if also_reserve_seats:
+            self.statements.execute(
+                db, "INSERT IGNORE INTO schedule_inventory (schedule_id, ride_date, segment, capacity) "
+                    "SELECT schedule_stops.schedule_id, %s, schedule_stops.stop_order, trains.capacity "
+                    "FROM schedule_stops JOIN schedules ON schedules.id = schedule_stops.schedule_id "
+                    "JOIN trains ON trains.id = schedules.train_id "
+                    "WHERE schedule_stops.schedule_id = %s AND schedule_stops.stop_order >= %s "
+                    "AND schedule_stops.stop_order < %s",
+                (ride_date, schedule_id, board, alight))
+            taken = self.statements.execute(
+                db, "UPDATE schedule_inventory SET reserved = reserved + %s WHERE schedule_id = %s "
+                    "AND ride_date = %s AND segment >= %s AND segment < %s AND reserved + %s <= capacity",
+                (len(user_emails), schedule_id, ride_date, board, alight, len(user_emails)))
+            if taken.rowcount < alight - board:
+                raise ValueError("No available seats for reservation")
+
+        # Buy the tickets, one execution of the prepared INSERT per passenger gives the id of each ticket.
+        # A ticket departs on the day of the ride, at the departure time of the schedule
+        ticket_ids = [self.statements.execute(
+            db, "INSERT INTO tickets (user_id, schedule_id, purchase_date, price, departure_date, departure_time) "
+                "SELECT %s, id, NOW(), %s, %s, departure_time FROM schedules WHERE id = %s",
+            (user_ids[email], price, ride_date, schedule_id)).lastrowid for email in user_emails]
+
+        if also_reserve_seats:
+            self.statements.executemany(
+                db, "INSERT INTO seat_reservations (ticket_id, number_of_seats, board_stop, alight_stop) "
+                    "VALUES (%s, 1, %s, %s)", [(ticket_id, board, alight) for ticket_id in ticket_ids])
+
+        # Add the tickets to the purchase summary of each passenger (a passenger may hold several)
+        tickets_per_user = {}
+        for email, ticket_id in zip(user_emails, ticket_ids):
+            tickets_per_user.setdefault(email, []).append(ticket_id)
+        for email, user_tickets in tickets_per_user.items():
+            user_id = user_ids[email]
+            self.statements.execute(db, REFRESH_PAST_NEXT_TRIP, (user_id, user_id, user_id))
+            self.statements.execute(db, SUMMARY_ON_PURCHASE, (len(user_tickets), len(user_tickets), user_tickets[0]))
+        return ticket_ids
+
+    @borrows_connection
+    def get_available_seats(self, connection) -> int:
+        """
+        Return the number of seats that can still be reserved on the ride of the connection (see buy_tickets),
+        the free seats of its fullest segment on the day of the ride.
+        Raise a ValueError if the schedule does not exist or does not ride between the stations
+        """
+        if connection is None:
+            raise ValueError("Connection cannot be None")
+        schedule_id, _, _, board, alight, ride_date = self._resolve_ride(self.rdbms_admin_connection, connection)
+        # The segments without a row on that day are not booked yet: the whole train is free
+        free = self.statements.fetchone(
+            self.rdbms_admin_connection,
+            "SELECT COALESCE(MIN(segments.capacity - segments.reserved), MIN(trains.capacity)) FROM schedules "
+            "JOIN trains ON trains.id = schedules.train_id "
+            "LEFT JOIN schedule_inventory segments ON segments.schedule_id = schedules.id "
+            "AND segments.ride_date = %s AND segments.segment >= %s AND segments.segment < %s "
+            "WHERE schedules.id = %s",
+            (ride_date, board, alight, schedule_id))
+        return max(free[0] or 0, 0)
+
+    @borrows_connection
+    def resolve_schedule_id(self, connection) -> int:
+        """
+        Return the id of the schedule the connection books (see _resolve_ride).
+        Raise a ValueError if there is none
+        """
+        return self._find_schedule(self.rdbms_admin_connection, connection)[0]
 
+    def _find_schedule(self, db, connection) -> Tuple[int, int, int, date]:
+        """
+        Return the id, starting and ending station of the schedule of the connection and the day of the ride.
+        A schedule runs every day from its departure_date to its arrival_date: the schedule is the schedule_id of
+        the connection, or the one of its train_id running on its departure_date (the latest one to start if
+        several do). The ride is on the departure_date of the connection, by default the first day of the schedule
+        """
+        ride_date = connection.get('departure_date')
+        if connection.get('schedule_id') is not None:
+            schedule = self.statements.fetchone(
+                db, "SELECT id, start_train_station_id, end_train_station_id, "
+                    "COALESCE(CAST(%s AS DATE), departure_date) FROM schedules WHERE id = %s "
+                    "AND COALESCE(CAST(%s AS DATE), departure_date) BETWEEN departure_date AND arrival_date",
+                (ride_date, connection['schedule_id'], ride_date))
+        else:
+            schedule = self.statements.fetchone(
+                db, "SELECT id, start_train_station_id, end_train_station_id, CAST(%s AS DATE) FROM schedules "
+                    "WHERE train_id = %s AND departure_date <= %s AND arrival_date >= %s "
+                    "ORDER BY departure_date DESC, id LIMIT 1",
+                (ride_date, connection['train_id'], ride_date, ride_date))
+        if schedule is None:
+            raise ValueError("Schedule does not exist")
+        return schedule
+
+    def _resolve_ride(self, db, connection) -> Tuple[int, int, int, int, int, date]:
+        """
+        Return the schedule of the connection, the stations where the ride starts and ends, the stop orders of
+        these stations and the day of the ride (see _find_schedule). The ride goes from its from_station_id to
+        its to_station_id, by default the whole run
+        """
+        schedule_id, start_station_id, end_station_id, ride_date = self._find_schedule(db, connection)
+        start_station_id = connection.get('from_station_id') or start_station_id
+        end_station_id = connection.get('to_station_id') or end_station_id
+
+        stops = self.statements.fetchall(
+            db, "SELECT station_id, stop_order FROM schedule_stops WHERE schedule_id = %s ORDER BY stop_order",
+            (schedule_id,))
+        board = next((order for station, order in stops if station == start_station_id), None)
+        alight = next((order for station, order in stops
+                       if station == end_station_id and board is not None and order > board), None)
+        if alight is None:
+            raise ValueError(f"Schedule {schedule_id} does not ride from {start_station_id} to {end_station_id}")
+        return schedule_id, start_station_id, end_station_id, board, alight, ride_date
+
+    @borrows_connection
     def get_purchase_history(self, user_email: str) -> List:
         """
         Access Purchase History
@@ -347,61 +1336,107 @@ class Traits(TraitsInterface):
         If the user is not registered, the list is empty
         """
 
-        cur = self.rdbms_admin_connection.cursor()
         try:
-            # Get the user id
-            user = self.utility.get_user_by_email(user_email)
-            if not user:
-                return []
-            user_id = user["id"]
-            # Check if the user exists and return an empty list if not
+            # Get the user id and return an empty list if the user does not exist
+            user_id = self.utility.get_user_id(user_email)
             if not user_id:
                 return []
             # Get the purchase history
-            cur.execute(f"""
-                    SELECT 
-                        tickets.id as ticket_id,
-                        schedules.start_train_station_id,
-                        schedules.end_train_station_id,
-                        schedules.departure_time,
-                        schedules.departure_date,
-                        schedules.arrival_time,
-                        schedules.arrival_date,
-                        tickets.purchase_date,
-                        tickets.price,
-                        seat_reservations.number_of_seats
-                    FROM tickets
-                    JOIN schedules ON tickets.schedule_id = schedules.id
-                    LEFT JOIN seat_reservations ON tickets.id = seat_reservations.ticket_id
-                    WHERE tickets.user_id = {user_id}
-                    ORDER BY schedules.departure_date DESC, schedules.departure_time DESC
-                """)
-
-            purchase_history = []
-            for row in cur.fetchall():
-                purchase_history.append({
-                    'ticket_id': row[0],
-                    'start_station_id': row[1],
-                    'end_station_id': row[2],
-                    'departure_time': row[3],
-                    'departure_date': row[4],
-                    'arrival_time': row[5],
-                    'arrival_date': row[6],
-                    'purchase_date': row[7],
-                    'total_price': row[8],
-                    'reserved_seats': row[9] or 0
-                })
+            rows = self.statements.fetchall(self.rdbms_admin_connection, PURCHASE_HISTORY, (user_id,))
+            purchase_history = [purchase_from_row(row) for row in rows]
             return purchase_history
         except Exception as e:
             raise ValueError(f"An error occurred during getting purchase history: {e}")
-        finally:
-            cur.close()
+
+    @borrows_connection
+    def get_purchase_history_page(self, user_email: str, limit: int = 20,
+                                  after: Optional[Tuple] = None) -> Tuple[List, Optional[Tuple]]:
+        """
+        Return one page of the purchase history (see get_purchase_history) with the key to pass as after to get
+        the next page, None on the last one. The key is the (departure_date, departure_time, ticket_id) of the
+        last purchase of the page: the next page is read from the index where this one stopped, so every page
+        costs the same however long the history is
+        """
+        if limit <= 0:
+            raise ValueError("The page size must be greater than 0")
+        user_id = self.utility.get_user_id(user_email)
+        if not user_id:
+            return [], None
+        return self._purchase_history_page(user_id, limit, after)
+
+    @borrows_connection
+    def iter_purchase_history(self, user_email: str, batch_size: int = 100):
+        """
+        Stream the purchase history (see get_purchase_history) page by page, batch_size purchases at a time.
+        Each page is a keyset page of get_purchase_history_page, read whole before its purchases are yielded:
+        no result is left open while the iteration is suspended, so the connection can run other statements
+        in between and stopping early costs nothing
+        """
+        if batch_size <= 0:
+            raise ValueError("The page size must be greater than 0")
+        user_id = self.utility.get_user_id(user_email)
+        if not user_id:
+            return
+        page, after = self._purchase_history_page(user_id, batch_size, None)
+        yield from page
+        while after is not None:
+            page, after = self._purchase_history_page(user_id, batch_size, after)
+            yield from page
+
+    def _purchase_history_page(self, user_id: int, limit: int, after: Optional[Tuple]) -> Tuple[List, Optional[Tuple]]:
+        try:
+            if after is None:
+                rows = self.statements.fetchall(self.rdbms_admin_connection, PURCHASE_HISTORY_FIRST_PAGE,
+                                                (user_id, limit))
+            else:
+                departure_date, departure_time, ticket_id = after
+                rows = self.statements.fetchall(self.rdbms_admin_connection, PURCHASE_HISTORY_NEXT_PAGE,
+                                                (user_id, departure_date, departure_date, departure_time,
+                                                 departure_time, ticket_id, limit))
+        except Exception as e:
+            raise ValueError(f"An error occurred during getting purchase history: {e}")
+        page = [purchase_from_row(row) for row in rows]
+        if len(page) < limit:
+            return page, None
+        last = page[-1]
+        return page, (last['departure_date'], last['departure_time'], last['ticket_id'])
+
+    @borrows_connection
+    def get_purchase_summary(self, user_email: str) -> Optional[Dict]:
+        """
+        Return the number of tickets, the total spent and the next upcoming trip (ticket id and departure, None if
+        there is none) of the user, read from the user_purchase_summary row of the user. Only the writes update
+        the row: once its next trip is past, the upcoming one is looked up without storing it.
+        If the user is not registered, return None
+        """
+        db = self.rdbms_admin_connection
+        try:
+            # The user is resolved through the user cache, the summary row is read by its key
+            user_id = self.utility.get_user_id(user_email)
+            if user_id is None:
+                return None
+            trips, total_spent, next_ticket_id, next_departure, departed = self.statements.fetchone(
+                db, "SELECT trips, total_spent, next_ticket_id, next_departure, next_departure < NOW() "
+                    "FROM user_purchase_summary WHERE user_id = %s", (user_id,)) or (0, 0, None, None, None)
+            if departed:
+                # The next trip is past, look up the one after it
+                next_ticket_id, next_departure = self.statements.fetchone(db, NEXT_TRIP_TICKET, (user_id,)) or \
+                    (None, None)
+        except Exception as e:
+            raise ValueError(f"An error occurred during getting the purchase summary: {e}")
+        return {
+            'trips': trips or 0,
+            'total_spent': total_spent or 0,
+            'next_ticket_id': next_ticket_id,
+            'next_departure': next_departure,
+        }
 
     ########################################################################
     # Admin Features:
     ########################################################################
 
     # Add and remove users
+    @borrows_connection
     def add_user(self, user_email: str, user_details) -> None:
         """
         Add a new user to the system with given email and details.
@@ -414,45 +1449,67 @@ class Traits(TraitsInterface):
         if not re.match(r"[^@]+@[^@]+\.[^@]+", user_email):
             raise ValueError("Invalid email format")
 
-        cur = self.rdbms_admin_connection.cursor()
         try:
-            user = self.utility.get_user_by_email(user_email)
-            if user:
+            if self.utility.get_user_id(user_email):
                 raise ValueError("User already exists")
 
-            if user_details is not None:
-                cur.execute(
-                    f"INSERT INTO users (email, password, is_admin) VALUES ('{user_email}', '{user_details['password']}', {user_details['is_admin']})")
-            else:
-                cur.execute(
-                    f"INSERT INTO users (email, password, is_admin) VALUES ('{user_email}', NULL, NULL)")
+            if user_details is None:
+                user_details = {"password": None, "is_admin": None}
+            user_id = self.statements.execute(self.rdbms_admin_connection,
+                                              "INSERT INTO users (email, password, is_admin) VALUES (%s, %s, %s)",
+                                              (user_email, user_details['password'],
+                                               user_details['is_admin'])).lastrowid
             self.rdbms_admin_connection.commit()
+            self.utility.user_ids.put(user_email.casefold(), user_id)
         except Exception as e:
             print(f"An error occurred during adding a new user: {e}")
             raise
 
+    @borrows_connection
     def delete_user(self, user_email: str) -> None:
         """
         Delete the user from the db if the user exists.
         The method should also delete any data related to the user (past/future tickets and seat reservations)
         """
-        cur = self.rdbms_admin_connection.cursor()
+        db = self.rdbms_admin_connection
         try:
             # Check if the user exists
-            user = self.utility.get_user_by_email(user_email)
-            if not user:
+            user_id = self.utility.get_user_id(user_email)
+            if not user_id:
                 raise ValueError("User does not exist")
-            # Delete the user
-            cur.execute(f"DELETE FROM users WHERE email = '{user_email}'")
-            # Delete all tickets of the user
-            cur.execute(f"DELETE FROM tickets WHERE user_id = (SELECT id FROM users WHERE email = '{user_email}')")
-            # Delete all seat reservations of the user
-            cur.execute(
-                f"DELETE FROM seat_reservations WHERE ticket_id IN (SELECT id FROM tickets WHERE user_id = (SELECT id FROM users WHERE email = '{user_email}'))")
-            self.rdbms_admin_connection.commit()
+            # Give the reserved seats of the user back to the schedules
+            self.statements.execute(db, """
+                UPDATE schedule_inventory
+                JOIN (SELECT segments.schedule_id, segments.ride_date, segments.segment,
+                             SUM(seat_reservations.number_of_seats) AS seats
+                      FROM tickets
+                      JOIN seat_reservations ON seat_reservations.ticket_id = tickets.id
+                      JOIN schedule_inventory segments ON segments.schedule_id = tickets.schedule_id
+                          AND segments.ride_date = tickets.departure_date
+                          AND segments.segment >= seat_reservations.board_stop
+                          AND segments.segment < seat_reservations.alight_stop
+                      WHERE tickets.user_id = %s
+                      GROUP BY segments.schedule_id, segments.ride_date, segments.segment) released
+                    ON released.schedule_id = schedule_inventory.schedule_id
+                    AND released.ride_date = schedule_inventory.ride_date
+                    AND released.segment = schedule_inventory.segment
+                SET schedule_inventory.reserved = schedule_inventory.reserved - released.seats
+            """, (user_id,))
+            # Delete the seat reservations, the tickets, the purchase summary and then the user
+            self.statements.execute(
+                db, "DELETE seat_reservations FROM seat_reservations "
+                    "JOIN tickets ON tickets.id = seat_reservations.ticket_id WHERE tickets.user_id = %s",
+                (user_id,))
+            self.statements.execute(db, "DELETE FROM tickets WHERE user_id = %s", (user_id,))
+            self.statements.execute(db, "DELETE FROM user_purchase_summary WHERE user_id = %s", (user_id,))
+            self.statements.execute(db, "DELETE FROM users WHERE id = %s", (user_id,))
+            db.commit()
+            self.utility.user_ids.discard(user_email.casefold())
         except Exception as e:
+            db.rollback()
             print(f"An error occurred during deleting a user: {e}")
 
+    @borrows_connection
     def add_train(self, train_key: Optional[TraitsKey], train_capacity: int, train_status: TrainStatus) -> TraitsKey:
         """
         Add new trains to the system with given code.
@@ -462,49 +1519,55 @@ class Traits(TraitsInterface):
         """
         if train_capacity <= 0:
             raise ValueError("Train capacity must be greater than 0")
-        cur = self.rdbms_admin_connection.cursor()
+        db = self.rdbms_admin_connection
         if train_key is None:
-            cur.execute("SELECT MAX(id) FROM trains")
-            max_id = cur.fetchone()[0]
+            max_id = self.statements.fetchone(db, "SELECT MAX(id) FROM trains")[0]
             new_id = 1 if max_id is None else max_id + 1
             train_key = TraitsKey(new_id)
         else:
-            cur.execute(f"SELECT * FROM trains WHERE id = {train_key.to_int()}")
-            if cur.fetchone():
+            if self.statements.fetchone(db, "SELECT id FROM trains WHERE id = %s", (train_key.to_int(),)):
                 raise ValueError("Train already exists")
 
         status_str = train_status.name
-        cur.execute(
-            f"INSERT INTO trains (id, capacity, status) VALUES ({train_key.to_int()}, {train_capacity}, '{status_str}')")
-        self.rdbms_admin_connection.commit()
+        self.statements.execute(db, "INSERT INTO trains (id, capacity, status) VALUES (%s, %s, %s)",
+                                (train_key.to_int(), train_capacity, status_str))
+        db.commit()
         return train_key
 
+    @borrows_connection
     def update_train_details(self, train_key: TraitsKey, train_capacity: Optional[int] = None,
                              train_status: Optional[TrainStatus] = None) -> None:
         """
         Update the details of existing train if specified (i.e., not None), otherwise do nothing.
         """
-        cur = self.rdbms_admin_connection.cursor()
+        db = self.rdbms_admin_connection
         try:
             # Check if the train exists
-            cur.execute(f"SELECT * FROM trains WHERE id = {train_key.to_int()}")
-            if not cur.fetchone():
+            if not self.statements.fetchone(db, "SELECT id FROM trains WHERE id = %s", (train_key.to_int(),)):
                 raise ValueError("Train does not exist")
 
             # Update the train capacity
             if train_capacity is not None:
-                cur.execute(f"UPDATE trains SET capacity = {train_capacity} WHERE id = {train_key.to_int()}")
+                self.statements.execute(db, "UPDATE trains SET capacity = %s WHERE id = %s",
+                                        (train_capacity, train_key.to_int()))
+                # The days already booked from today on, the other days take the new capacity when first booked
+                self.statements.execute(db, "UPDATE schedule_inventory "
+                                            "JOIN schedules ON schedules.id = schedule_inventory.schedule_id "
+                                            "SET schedule_inventory.capacity = %s WHERE schedules.train_id = %s "
+                                            "AND schedule_inventory.ride_date >= CURDATE()",
+                                        (train_capacity, train_key.to_int()))
 
             # Update the train status
             if train_status is not None:
-                cur.execute(f"UPDATE trains SET status = '{train_status.name}' WHERE id = {train_key.to_int()}")
+                self.statements.execute(db, "UPDATE trains SET status = %s WHERE id = %s",
+                                        (train_status.name, train_key.to_int()))
 
-            self.rdbms_admin_connection.commit()
+            db.commit()
+            self._invalidate_search_cache(train_id=train_key.to_int())
         except Exception as e:
             raise ValueError(f"An error occurred during updating train details: {e}")
-        finally:
-            cur.close()
 
+    @borrows_connection
     def delete_train(self, train_key: TraitsKey) -> None:
         """
         Deleting a train should ensure consistency! Reservations are cancelled, schedules/trips are cancelled, etc.
@@ -514,22 +1577,52 @@ class Traits(TraitsInterface):
         if train_key is None:
             raise ValueError("Invalid train key")
 
-        cur = self.rdbms_admin_connection.cursor()
+        db = self.rdbms_admin_connection
+        train_id = (train_key.to_int(),)
         try:
-            # Delete the train
-            cur.execute(f"DELETE FROM trains WHERE id = {train_key}")
-            # Delete all schedules
-            cur.execute(f"DELETE FROM schedules WHERE train_id = {train_key}")
-            # Delete all tickets
-            cur.execute(
-                f"DELETE FROM tickets WHERE schedule_id IN (SELECT id FROM schedules WHERE train_id = {train_key})")
-            # Delete all seat reservations
-            cur.execute(
-                f"DELETE FROM seat_reservations WHERE ticket_id IN (SELECT id FROM tickets WHERE schedule_id IN (SELECT id FROM schedules WHERE train_id = {train_key}))")
-            self.rdbms_admin_connection.commit()
+            # Days on which the schedules of the train were running, searches on them must be dropped
+            day_ranges = self.statements.fetchall(
+                db, "SELECT departure_date, arrival_date FROM schedules WHERE train_id = %s", train_id)
+            # Take the tickets of the train out of the purchase summaries of their users, the users whose next
+            # trip was on the train get it looked up again once the tickets are gone
+            self.statements.execute(db, """
+                UPDATE user_purchase_summary
+                JOIN (SELECT tickets.user_id, COUNT(*) AS trips, SUM(tickets.price) AS spent
+                      FROM schedules
+                      JOIN tickets ON tickets.schedule_id = schedules.id
+                      WHERE schedules.train_id = %s
+                      GROUP BY tickets.user_id) removed
+                    ON removed.user_id = user_purchase_summary.user_id
+                SET user_purchase_summary.trips = user_purchase_summary.trips - removed.trips,
+                    user_purchase_summary.total_spent = user_purchase_summary.total_spent - removed.spent
+            """, train_id)
+            next_trip_users = self.statements.fetchall(
+                db, "SELECT user_purchase_summary.user_id FROM schedules "
+                    "JOIN tickets ON tickets.schedule_id = schedules.id "
+                    "JOIN user_purchase_summary ON user_purchase_summary.user_id = tickets.user_id "
+                    "WHERE schedules.train_id = %s AND user_purchase_summary.next_ticket_id = tickets.id", train_id)
+            # Delete the rows referencing the train before the train itself: seat reservations, tickets,
+            # seat inventory, stops and schedules. Joined from the schedules of the train so that each table is
+            # read through its schedule (or ticket) index, an IN subquery in a DELETE scans the whole table
+            self.statements.execute(
+                db, "DELETE seat_reservations FROM schedules "
+                    "JOIN tickets ON tickets.schedule_id = schedules.id "
+                    "JOIN seat_reservations ON seat_reservations.ticket_id = tickets.id "
+                    "WHERE schedules.train_id = %s", train_id)
+            for table in ("tickets", "schedule_inventory", "schedule_stops"):
+                self.statements.execute(db, DELETE_BY_TRAIN[table], train_id)
+            for user_id, in next_trip_users:
+                self.statements.execute(db, REFRESH_NEXT_TRIP, (user_id, user_id, user_id))
+            self.statements.execute(db, "DELETE FROM schedules WHERE train_id = %s", train_id)
+            self.statements.execute(db, "DELETE FROM trains WHERE id = %s", train_id)
+            db.commit()
+            self._drop_cached("_timetable")
+            self._invalidate_search_cache(day_ranges=day_ranges, train_id=train_key.to_int())
         except Exception as e:
+            db.rollback()
             print(f"An error occurred during deleting a train: {e}")
 
+    @borrows_connection
     def add_train_station(self, train_station_key: TraitsKey, train_station_details) -> None:
         """
         Add a train station
@@ -537,10 +1630,8 @@ class Traits(TraitsInterface):
         """
 
         # Check if the train station already exists in RDBMS
-        cur = self.rdbms_admin_connection.cursor()
-
-        cur.execute(f"SELECT * FROM train_stations WHERE id = {train_station_key.to_int()}")
-        if cur.fetchone():
+        db = self.rdbms_admin_connection
+        if self.statements.fetchone(db, "SELECT id FROM train_stations WHERE id = %s", (train_station_key.to_int(),)):
             raise ValueError("Train station already exists in RDBMS")
 
         if train_station_details is None:
@@ -556,32 +1647,35 @@ class Traits(TraitsInterface):
             raise ValueError("Invalid train station details")
 
         # Check if a train station with the same name already exists
-        cur.execute(f"SELECT * FROM train_stations WHERE name = '{train_station_details['name']}'")
-        if cur.fetchone():
+        if self.statements.fetchone(db, "SELECT id FROM train_stations WHERE name = %s",
+                                    (train_station_details['name'],)):
             raise ValueError("Train station with the same name already exists")
 
         try:
             # Add the station to RDBMS
-            cur.execute(
-                f"INSERT INTO train_stations (id, name, location) VALUES ({train_station_key.to_int()}, '{train_station_details['name']}', '{train_station_details['location']}')"
-            )
-            self.rdbms_admin_connection.commit()
+            self.statements.execute(db, "INSERT INTO train_stations (id, name, location) VALUES (%s, %s, %s)",
+                                    (train_station_key.to_int(), train_station_details['name'],
+                                     train_station_details['location']))
+            db.commit()
 
             # Add the station to Neo4j
-            with self.neo4j_driver.session() as session:
-                session.run(
-                    "CREATE (s:Station {id: $station_id, name: $name, location: $location})",
-                    station_id=train_station_key.to_int(),
-                    name=train_station_details['name'],
-                    location=train_station_details['location']
-                )
+            with self._count_round_trips("add_train_station"):
+                self._neo4j_round_trips += 1
+                with self._neo4j_session() as session:
+                    session.run(
+                        "CREATE (s:Station {id: $station_id, name: $name, location: $location})",
+                        station_id=train_station_key.to_int(),
+                        name=train_station_details['name'],
+                        location=train_station_details['location']
+                    )
+            self._known_stations.add(train_station_key.to_int())
+            self._invalidate_search_cache(station_id=train_station_key.to_int())
         except Exception as e:
-            self.rdbms_admin_connection.rollback()
+            db.rollback()
             print(f"An error occurred during adding a new train station: {e}")
             raise
-        finally:
-            cur.close()
 
+    @borrows_connection
     def connect_train_stations(self, starting_train_station_key: TraitsKey, ending_train_station_key: TraitsKey,
                                travel_time_in_minutes: int) -> None:
         """
@@ -593,41 +1687,41 @@ class Traits(TraitsInterface):
         if travel_time_in_minutes <= 0:
             raise ValueError("Invalid travel time, minimum travel time is 1 minute")
 
-        # Check if the stations exist
-        neo_query = """
-                        MATCH (s:Station {id: $station_id})
-                        RETURN s
-                    """
-        for station_key in [starting_train_station_key, ending_train_station_key]:
-            with self.neo4j_driver.session() as session:
-                result = session.run(neo_query, station_id=station_key.to_int())
-                if result.single() is None:
-                    raise ValueError(f"Station with id {station_key.to_int()} does not exist")
+        with self._count_round_trips("connect_train_stations"):
+            # Check if the stations exist
+            self._check_stations_exist([starting_train_station_key, ending_train_station_key])
 
-        # Connect the stations in Neo4j
-        neo_query = """
-                        MATCH (start:Station {id: $start_point}), (end:Station {id: $end_point})
-                        CREATE (start)-[:CONNECTED_TO {travel_time: $travel_time}]->(end)
-                    """
-        try:
-            with self.neo4j_driver.session() as session:
-                result = session.run(neo_query, start_point=starting_train_station_key.to_int(),
-                                     end_point=ending_train_station_key.to_int(),
-                                     travel_time=travel_time_in_minutes)
-                if result.consume().counters.relationships_created == 0:
-                    raise ValueError("NEO4J: Failed to connect the train stations.")
-        except Exception as e:
-            print(f"An error occurred during connecting train stations: {e}")
-            raise
+            # Connect the stations in Neo4j
+            neo_query = """
+                            MATCH (start:Station {id: $start_point}), (end:Station {id: $end_point})
+                            CREATE (start)-[:CONNECTED_TO {travel_time: $travel_time}]->(end)
+                        """
+            try:
+                self._neo4j_round_trips += 1
+                with self._neo4j_session() as session:
+                    result = session.run(neo_query, start_point=starting_train_station_key.to_int(),
+                                         end_point=ending_train_station_key.to_int(),
+                                         travel_time=travel_time_in_minutes)
+                    if result.consume().counters.relationships_created == 0:
+                        raise ValueError("NEO4J: Failed to connect the train stations.")
+            except Exception as e:
+                print(f"An error occurred during connecting train stations: {e}")
+                raise
 
         # Connect the stations in RDBMS
-        cur = self.rdbms_admin_connection.cursor()
-        cur.execute(
-            f"INSERT INTO connections (start_station_id, end_station_id, travel_time_minutes) VALUES ({starting_train_station_key.to_int()}, {ending_train_station_key.to_int()}, {travel_time_in_minutes})"
-        )
+        self.statements.execute(self.rdbms_admin_connection,
+                                "INSERT INTO connections (start_station_id, end_station_id, travel_time_minutes) "
+                                "VALUES (%s, %s, %s)",
+                                (starting_train_station_key.to_int(), ending_train_station_key.to_int(),
+                                 travel_time_in_minutes))
         self.rdbms_admin_connection.commit()
-        cur.close()
+        self._drop_cached("_timetable", "_station_graph", "_contraction_hierarchy")
+        with self._fare_lock:
+            self._fare_engine = None
+        # A new connection can shorten or create paths between any two stations
+        self.search_cache.clear()
 
+    @borrows_connection
     def add_schedule(self, train_key: TraitsKey,
                      starting_hours_24_h: int, starting_minutes: int,
                      stops: List[Tuple[TraitsKey, int]],  # [station_key, waiting_time]
@@ -645,19 +1739,16 @@ class Traits(TraitsInterface):
         """
         # IF THE TRAIN_KEY IS NONE
         # GIVE IT ONE WE GO INTO THIS
-        cur = self.rdbms_admin_connection.cursor()
+        db = self.rdbms_admin_connection
         if train_key is None:
-            cur.execute("SELECT MAX(id) FROM trains")
-            max_id = cur.fetchone()[0]
+            max_id = self.statements.fetchone(db, "SELECT MAX(id) FROM trains")[0]
             new_id = 1 if max_id is None else max_id + 1
             train_key = TraitsKey(new_id)
             # Insert the train with its new key into the trains table
-            cur.execute(
-                f"INSERT INTO trains (id, status, capacity) VALUES ({train_key.to_int()}, 'OPERATIONAL', 100)"
-            )
+            self.statements.execute(db, "INSERT INTO trains (id, status, capacity) VALUES (%s, 'OPERATIONAL', 100)",
+                                    (train_key.to_int(),))
         else:
-            cur.execute(f"SELECT * FROM trains WHERE id = {train_key.to_int()}")
-            if cur.fetchone() is None:
+            if self.statements.fetchone(db, "SELECT id FROM trains WHERE id = %s", (train_key.to_int(),)) is None:
                 raise ValueError("Train does not exist")
 
         if len(stops) < 2:
@@ -671,7 +1762,7 @@ class Traits(TraitsInterface):
                                 MATCH (start:Station {id: $start_point})-[:CONNECTED_TO]->(end:Station {id: $end_point})
                                 RETURN start, end
                             """
-            with self.neo4j_driver.session() as session:
+            with self._neo4j_session() as session:
                 result = session.run(neo_query, start_point=start_station_key.to_int(),
                                      end_point=end_station_key.to_int())
                 if result.single() is None:
@@ -683,22 +1774,27 @@ class Traits(TraitsInterface):
             raise ValueError("Valid from date must be in the past w.r.t. valid until date")
 
         # Add the schedule to RDBMS
-        cur = self.rdbms_admin_connection.cursor()
         try:
-            cur.execute(
-                f"INSERT INTO schedules (train_id, start_train_station_id, end_train_station_id, departure_time, departure_date, arrival_time, arrival_date) VALUES ({train_key.to_int()}, {stops[0][0].to_int()}, {stops[-1][0].to_int()}, '{starting_hours_24_h}:{starting_minutes:02d}', '{valid_from_year}-{valid_from_month:02d}-{valid_from_day:02d}', '{starting_hours_24_h}:{starting_minutes:02d}', '{valid_until_year}-{valid_until_month:02d}-{valid_until_day:02d}')"
-            )
-            schedule_id = cur.lastrowid
-
-            for i, (station_key, waiting_time) in enumerate(stops):
-                cur.execute(
-                    f"INSERT INTO schedule_stops (schedule_id, station_id, stop_order, waiting_time) VALUES ({schedule_id}, {station_key.to_int()}, {i + 1}, {waiting_time})"
-                )
-
-            self.rdbms_admin_connection.commit()
+            starting_time = f"{starting_hours_24_h}:{starting_minutes:02d}"
+            schedule_id = self.statements.execute(
+                db, "INSERT INTO schedules (train_id, start_train_station_id, end_train_station_id, departure_time, "
+                    "departure_date, arrival_time, arrival_date) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                (train_key.to_int(), stops[0][0].to_int(), stops[-1][0].to_int(), starting_time,
+                 date(valid_from_year, valid_from_month, valid_from_day), starting_time,
+                 date(valid_until_year, valid_until_month, valid_until_day))).lastrowid
+
+            self.statements.executemany(
+                db, "INSERT INTO schedule_stops (schedule_id, station_id, stop_order, waiting_time) "
+                    "VALUES (%s, %s, %s, %s)",
+                [(schedule_id, station_key.to_int(), i + 1, waiting_time)
+                 for i, (station_key, waiting_time) in enumerate(stops)])
+
+            db.commit()
+            self._drop_cached("_timetable")
+            self._invalidate_search_cache(day_ranges=[(
+                date(valid_from_year, valid_from_month, valid_from_day),
+                date(valid_until_year, valid_until_month, valid_until_day))])
         except Exception as e:
-            self.rdbms_admin_connection.rollback()
+            db.rollback()
             print(f"An error occurred during adding a new schedule: {e}")
             raise
-        finally:
-            cur.close()
@@ -0,0 +1,102 @@
+from typing import List, Tuple, Optional, Dict, Any
+
+
+class Record:
+    """
+    Base of the compact search results: plain int fields stored in __slots__, readable as attributes
+    and, like the dicts search_connections used to return, by key (journey["travel_time"])
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.__slots__
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return type(self) is type(other) and self.to_tuple() == other.to_tuple()
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def __reduce__(self):
+        # Pickle as the plain tuple, without the per-field names
+        return type(self).from_tuple, (self.to_tuple(),)
+
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def to_tuple(self) -> Tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_tuple(cls, values: Tuple):
+        return cls(*values)
+
+
+class Leg(Record):
+    """
+    Ride on a single train of a Journey, times are minutes since midnight
+    """
+
+    __slots__ = ("schedule_id", "train_id", "from_station_id", "to_station_id", "departure_time", "arrival_time")
+
+    def __init__(self, schedule_id: int, train_id: int, from_station_id: int, to_station_id: int,
+                 departure_time: int, arrival_time: int) -> None:
+        self.schedule_id = schedule_id
+        self.train_id = train_id
+        self.from_station_id = from_station_id
+        self.to_station_id = to_station_id
+        self.departure_time = departure_time
+        self.arrival_time = arrival_time
+
+
+class Journey(Record):
+    """
+    A connection returned by the searches: the station ids of its path, its travel time, changes, waiting time
+    (minutes) and estimated price (cents) and, for the timetable searches, its departure and arrival times and legs.
+    Journeys hold no driver object, so they can be cached, pickled or sent to other processes as they are
+    """
+
+    __slots__ = ("path", "travel_time", "num_changes", "waiting_time", "estimated_price",
+                 "departure_time", "arrival_time", "legs")
+
+    def __init__(self, path: List[int], travel_time: int, num_changes: int, waiting_time: int = 0,
+                 estimated_price: int = 0, departure_time: Optional[int] = None, arrival_time: Optional[int] = None,
+                 legs: Optional[List[Leg]] = None) -> None:
+        self.path = path
+        self.travel_time = travel_time
+        self.num_changes = num_changes
+        self.waiting_time = waiting_time
+        self.estimated_price = estimated_price
+        self.departure_time = departure_time
+        self.arrival_time = arrival_time
+        self.legs = legs if legs is not None else []
+
+    def to_dict(self) -> Dict:
+        values = super().to_dict()
+        values["legs"] = [leg.to_dict() for leg in self.legs]
+        return values
+
+    def to_tuple(self) -> Tuple:
+        return (tuple(self.path), self.travel_time, self.num_changes, self.waiting_time, self.estimated_price,
+                self.departure_time, self.arrival_time, tuple(leg.to_tuple() for leg in self.legs))
+
+    @classmethod
+    def from_tuple(cls, values: Tuple) -> "Journey":
+        path, travel_time, num_changes, waiting_time, estimated_price, departure_time, arrival_time, legs = values
+        return cls(list(path), travel_time, num_changes, waiting_time, estimated_price, departure_time, arrival_time,
+                   [Leg(*leg) for leg in legs])
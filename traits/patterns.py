@@ -0,0 +1,222 @@
+from bisect import bisect_left, bisect_right
+from datetime import date
+from typing import List, Tuple, Optional, Dict, Set, Iterable
+import time
+
+from traits.journey import Journey
+from traits.routing import Leg, ConnectionScan, Raptor, journey_to_connection
+from traits.timetable import Timetable
+
+# A transfer pattern: the station keys where the journey boards its trains, followed by the target station key
+Pattern = Tuple[int, ...]
+
+# A direct connection between two stops of the same trip: (departure, arrival, trip, boarding position, alighting position)
+Direct = Tuple[int, int, int, int, int]
+
+
+class DirectConnections:
+    """
+    The trips going from a station to another one without changing, sorted by departure and by arrival
+    """
+
+    def __init__(self, rides: List[Direct]) -> None:
+        self.by_departure = sorted(rides)
+        self.departures = [ride[0] for ride in self.by_departure]
+        self.by_arrival = sorted(rides, key=lambda ride: (ride[1], -ride[0]))
+        self.arrivals = [ride[1] for ride in self.by_arrival]
+
+    def earliest_arrival(self, departure: int, active: Optional[List[bool]]) -> Optional[Direct]:
+        """
+        Return the ride leaving not before departure that arrives first (the latest leaving one on ties)
+        """
+        best = None
+        for i in range(bisect_left(self.departures, departure), len(self.by_departure)):
+            ride = self.by_departure[i]
+            if best is not None and ride[0] > best[1]:
+                # Leaves after the best arrival, neither this nor any later ride arrives earlier
+                break
+            if active is not None and not active[ride[2]]:
+                continue
+            if best is None or ride[1] <= best[1]:
+                best = ride
+        return best
+
+    def latest_departure(self, deadline: int, active: Optional[List[bool]]) -> Optional[Direct]:
+        """
+        Return the ride arriving not after deadline that leaves last (the earliest arriving one on ties)
+        """
+        best = None
+        for i in range(bisect_right(self.arrivals, deadline) - 1, -1, -1):
+            ride = self.by_arrival[i]
+            if best is not None and ride[1] < best[0]:
+                break
+            if active is not None and not active[ride[2]]:
+                continue
+            if best is None or ride[0] >= best[0]:
+                best = ride
+        return best
+
+
+class TransferPatterns:
+    """
+    Transfer pattern index over a compiled Timetable.
+    The offline stage (build) runs, from every source station, a connection scan profile over all the
+    departures and a McRAPTOR search, and keeps the sequence of boarding stations of each optimal journey.
+    The searches are run over all the trips and over the trips of each validity period: a journey dominated
+    by a trip that does not run on the day of a query is optimal on that day.
+    A query then only evaluates the patterns of its station pair against the direct connections table.
+
+    The patterns are kept (by station key) when the timetable is replaced, but the sources built against
+    an older timetable become stale: their queries fall back to the connection scan until they are rebuilt.
+    """
+
+    def __init__(self, timetable: Timetable, patterns: Optional[Dict[int, Dict[int, Set[Pattern]]]] = None,
+                 stale: Optional[Set[int]] = None) -> None:
+        self.timetable = timetable
+        self.patterns: Dict[int, Dict[int, Set[Pattern]]] = patterns if patterns is not None else {}
+        self.stale: Set[int] = stale if stale is not None else set()
+        self.build_seconds = 0.0
+        self._scan = ConnectionScan(timetable)
+
+        rides: Dict[Tuple[int, int], List[Direct]] = {}
+        for trip in range(timetable.n_trips):
+            stations = timetable.trip_stations(trip)
+            arrivals = timetable.trip_arrivals(trip)
+            departures = timetable.trip_departures(trip)
+            for board in range(len(stations) - 1):
+                for alight in range(board + 1, len(stations)):
+                    rides.setdefault((stations[board], stations[alight]), []).append(
+                        (departures[board], arrivals[alight], trip, board, alight))
+        self.direct: Dict[Tuple[int, int], DirectConnections] = {
+            pair: DirectConnections(pair_rides) for pair, pair_rides in rides.items()}
+
+    def refreshed(self, timetable: Timetable) -> "TransferPatterns":
+        """
+        Return the index over a new timetable, keeping the patterns built so far as stale
+        """
+        return TransferPatterns(timetable, self.patterns, self.stale | set(self.patterns))
+
+    def build(self, sources: Optional[Iterable[int]] = None) -> Dict:
+        """
+        Compute the patterns of the given source station keys (every station if None), replacing their
+        previous ones, and return the stats of the index. The patterns are the union of those of every
+        validity period of the timetable, and of those of the queries without day
+        """
+        started = time.perf_counter()
+        station_ids = self.timetable.station_ids.tolist()
+        sources = station_ids if sources is None else list(sources)
+        days = [None] + self.timetable.service_days()
+        raptor = Raptor(self.timetable, cache_size=0)
+        for source in sources:
+            self.stale.discard(source)
+            self.patterns.pop(source, None)
+            if source not in self.timetable.station_index:
+                continue
+            targets = [station for station in station_ids if station != source]
+            source_patterns: Dict[int, Set[Pattern]] = {}
+            for day in days:
+                # The earliest arrival journey of every departure, plus the ones with fewer changes
+                profiles = self._scan.journeys_many(source, targets, day, limit=self.timetable.n_connections)
+                pareto = raptor.journeys_many(source, targets, day, limit=None)
+                for target in targets:
+                    for connection in profiles[target] + pareto[target]:
+                        legs = connection["legs"]
+                        pattern = tuple(leg["from_station_id"] for leg in legs) + (legs[-1]["to_station_id"],)
+                        source_patterns.setdefault(target, set()).add(pattern)
+            self.patterns[source] = source_patterns
+        self.build_seconds = time.perf_counter() - started
+        return self.stats()
+
+    def stats(self) -> Dict:
+        """
+        Return the size of the index: sources, station pairs, patterns and stations stored in the patterns,
+        stale sources and the duration of the last build in seconds
+        """
+        pairs = [patterns for source_patterns in self.patterns.values() for patterns in source_patterns.values()]
+        return {
+            "sources": len(self.patterns),
+            "stale_sources": len(self.stale),
+            "pairs": len(pairs),
+            "patterns": sum(len(patterns) for patterns in pairs),
+            "stations": sum(len(pattern) for patterns in pairs for pattern in patterns),
+            "direct_rides": sum(len(direct.by_departure) for direct in self.direct.values()),
+            "build_seconds": self.build_seconds,
+        }
+
+    def _forward(self, pattern: Pattern, departure: int, active: Optional[List[bool]]) -> Optional[List[Direct]]:
+        rides = []
+        clock = departure
+        for i in range(len(pattern) - 1):
+            direct = self.direct.get((pattern[i], pattern[i + 1]))
+            ride = direct.earliest_arrival(clock, active) if direct is not None else None
+            if ride is None:
+                return None
+            rides.append(ride)
+            clock = ride[1]
+        return rides
+
+    def _backward(self, pattern: Pattern, deadline: int, active: Optional[List[bool]]) -> Optional[List[Direct]]:
+        rides = []
+        clock = deadline
+        for i in range(len(pattern) - 1, 0, -1):
+            direct = self.direct.get((pattern[i - 1], pattern[i]))
+            ride = direct.latest_departure(clock, active) if direct is not None else None
+            if ride is None:
+                return None
+            rides.append(ride)
+            clock = ride[0]
+        rides.reverse()
+        return rides
+
+    def journeys(self, source: int, target: int, day: Optional[date] = None, is_departure_time: bool = True,
+                 limit: int = 5) -> List[Journey]:
+        """
+        Return the journeys that ConnectionScan.journeys returns, evaluating the patterns of the station pair.
+        Among the journeys with the same arrival (resp. departure) the one leaving last (resp. arriving first)
+        is kept. Stale or unknown sources, and pairs without any working pattern, use the connection scan
+        """
+        source_patterns = None if source in self.stale else self.patterns.get(source)
+        if source_patterns is None or source not in self.timetable.station_index:
+            return self._scan.journeys(source, target, day, is_departure_time, limit)
+        patterns = [tuple(self.timetable.station_index.get(station, -1) for station in pattern)
+                    for pattern in source_patterns.get(target, ())]
+        active = self.timetable.active_trips(day)
+        active = None if active is None else active.tolist()
+
+        results = []
+        if is_departure_time:
+            departure = 0
+            while len(results) < limit:
+                best = None
+                for pattern in patterns:
+                    rides = self._forward(pattern, departure, active)
+                    if rides is not None and (best is None or (rides[-1][1], -rides[0][0]) < (best[-1][1], -best[0][0])):
+                        best = rides
+                if best is None:
+                    break
+                results.append(journey_to_connection(self.timetable, self._legs(best)))
+                departure = best[0][0] + 1
+        else:
+            deadline = self.timetable.horizon()
+            while len(results) < limit:
+                best = None
+                for pattern in patterns:
+                    rides = self._backward(pattern, deadline, active)
+                    if rides is not None and (best is None or (-rides[0][0], rides[-1][1]) < (-best[0][0], best[-1][1])):
+                        best = rides
+                if best is None:
+                    break
+                results.append(journey_to_connection(self.timetable, self._legs(best)))
+                deadline = best[-1][1] - 1
+        if not results and limit > 0:
+            # Trips added since the build can connect a pair no pattern knows about
+            return self._scan.journeys(source, target, day, is_departure_time, limit)
+        return results
+
+    def journeys_many(self, source: int, targets: List[int], day: Optional[date] = None,
+                      limit: int = 5) -> Dict[int, List[Journey]]:
+        return {target: self.journeys(source, target, day, True, limit) for target in targets}
+
+    @staticmethod
+    def _legs(rides: List[Direct]) -> List[Leg]:
+        return [(trip, board, alight) for _, _, trip, board, alight in rides]
@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+from functools import wraps
+from inspect import isgeneratorfunction
+from threading import Condition, local
+from typing import Any, Callable, Dict, List, Optional
+import time
+
+
+class ConnectionPool:
+    """
+    Bounded pool of RDBMS connections opened with connect (e.g. a mysql.connector.connect partial, or the
+    get_connection of a mysql.connector.pooling pool). A thread borrows one connection for the whole of a call
+    (borrow is re-entrant) and gives it back rolled back, so no transaction or snapshot outlives the call.
+    When all the size connections are borrowed, checkout waits up to timeout seconds (forever if None).
+
+    stats reports the checkouts, the exhausted ones (that had to wait for a connection), the timeouts and
+    the time spent in checkout
+    """
+
+    def __init__(self, connect: Callable[[], Any], size: int = 8, timeout: Optional[float] = 30.0) -> None:
+        if size <= 0:
+            raise ValueError("The size of a connection pool must be greater than 0")
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._idle: List[Any] = []
+        self._available = Condition()
+        self._local = local()
+        self.created = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.exhausted = 0
+        self.timeouts = 0
+        self.checkout_seconds = 0.0
+        self.max_checkout_seconds = 0.0
+
+    def checkout(self) -> Any:
+        """
+        Return an idle connection, a new one if there is room, or wait for one to be checked in.
+        Raise a ValueError if none is available within the timeout
+        """
+        started = time.perf_counter()
+        with self._available:
+            if not self._idle and self.created >= self.size:
+                self.exhausted += 1
+                if not self._available.wait_for(lambda: self._idle or self.created < self.size, self.timeout):
+                    self.timeouts += 1
+                    raise ValueError(f"No connection available in the pool within {self.timeout} seconds")
+            connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                # Counted now so that other threads do not open more than size connections
+                self.created += 1
+            self.in_use += 1
+        if connection is None:
+            try:
+                connection = self.connect()
+            except Exception:
+                with self._available:
+                    self.created -= 1
+                    self.in_use -= 1
+                    self._available.notify()
+                raise
+        elapsed = time.perf_counter() - started
+        with self._available:
+            self.checkouts += 1
+            self.checkout_seconds += elapsed
+            self.max_checkout_seconds = max(self.max_checkout_seconds, elapsed)
+        return connection
+
+    def checkin(self, connection: Any) -> None:
+        """
+        Give a connection back, ending its transaction. A connection that fails to roll back is closed
+        """
+        try:
+            connection.rollback()
+            broken = False
+        except Exception:
+            broken = True
+        with self._available:
+            self.in_use -= 1
+            if broken:
+                self.created -= 1
+            else:
+                self._idle.append(connection)
+            self._available.notify()
+        if broken:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def borrow(self):
+        """
+        Borrow a connection for the current thread, nested borrows of the thread share it
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            yield connection
+            return
+        connection = self._local.connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self._local.connection = None
+            self.checkin(connection)
+
+    def current(self) -> Optional[Any]:
+        """
+        Return the connection borrowed by the current thread, None outside of borrow
+        """
+        return getattr(self._local, "connection", None)
+
+    def close(self) -> None:
+        """
+        Close the idle connections, the borrowed ones stay open
+        """
+        with self._available:
+            idle, self._idle = self._idle, []
+            self.created -= len(idle)
+        for connection in idle:
+            connection.close()
+
+    def stats(self) -> Dict:
+        with self._available:
+            return {
+                "size": self.size,
+                "created": self.created,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "exhausted": self.exhausted,
+                "timeouts": self.timeouts,
+                "mean_checkout_seconds": self.checkout_seconds / self.checkouts if self.checkouts else 0.0,
+                "max_checkout_seconds": self.max_checkout_seconds,
+            }
+
+
+def borrows_connection(method):
+    """
+    Decorate the public methods of Traits and TraitsUtility: the whole call, or the whole iteration of a
+    generator, runs inside self._borrow()
+    """
+    if isgeneratorfunction(method):
+        @wraps(method)
+        def generator(self, *args, **kwargs):
+            with self._borrow():
+                yield from method(self, *args, **kwargs)
+        return generator
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._borrow():
+            return method(self, *args, **kwargs)
+    return wrapper
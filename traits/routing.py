@@ -0,0 +1,580 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import date
+from typing import List, Tuple, Optional, Dict
+
+import numpy as np
+
+from traits.graph import StationGraph
+from traits.interface import SortingCriteria
+from traits.journey import Journey, Leg as JourneyLeg
+from traits.timetable import Timetable
+
+INFINITY = float("inf")
+
+# Number of connections materialized at once while scanning the compiled timetable
+SCAN_CHUNK = 4096
+
+# A leg is a ride on a single trip: (trip index, boarding stop position, alighting stop position)
+Leg = Tuple[int, int, int]
+
+# Field of the journeys used to order the results for each sorting criteria
+SORT_KEYS = {
+    SortingCriteria.OVERALL_TRAVEL_TIME: "travel_time",
+    SortingCriteria.NUMBER_OF_TRAIN_CHANGES: "num_changes",
+    SortingCriteria.OVERALL_WAITING_TIME: "waiting_time",
+    SortingCriteria.ESTIMATED_PRICE: "estimated_price",
+}
+
+# Price (in cents) of each minute spent on board
+PRICE_PER_MINUTE = 10
+
+
+def time_based_fare(timetable: Timetable, trip: int, board: int, alight: int) -> int:
+    """
+    Price in cents of riding trip from the stop at position board to the one at position alight
+    """
+    offset = int(timetable.trip_stop_offsets[trip])
+    return int(timetable.stop_arrivals[offset + alight] - timetable.stop_departures[offset + board]) * PRICE_PER_MINUTE
+
+
+def journey_to_connection(timetable: Timetable, legs: List[Leg], fare=time_based_fare) -> Journey:
+    """
+    Convert a list of legs into the Journey returned by Traits.search_connections
+    """
+    path, leg_details = [], []
+    waiting_time = 0
+    price = 0
+    previous_arrival = None
+    for trip, board, alight in legs:
+        stops = timetable.trip_stops(trip)
+        stations = timetable.station_ids[timetable.stop_stations[stops][board:alight + 1]].tolist()
+        path.extend(stations if not path else stations[1:])
+        departure = int(timetable.stop_departures[stops.start + board])
+        arrival = int(timetable.stop_arrivals[stops.start + alight])
+        if previous_arrival is not None:
+            waiting_time += departure - previous_arrival
+        previous_arrival = arrival
+        price += fare(timetable, trip, board, alight)
+        leg_details.append(JourneyLeg(int(timetable.trip_schedule_ids[trip]), int(timetable.trip_train_ids[trip]),
+                                      stations[0], stations[-1], departure, arrival))
+    departure_time = leg_details[0].departure_time
+    arrival_time = leg_details[-1].arrival_time
+    return Journey(path, arrival_time - departure_time, len(legs) - 1, waiting_time, price,
+                   departure_time, arrival_time, leg_details)
+
+
+def path_to_connection(graph: StationGraph, path: List[int]) -> Journey:
+    """
+    Convert a path of the static station graph into the Journey returned by Traits.search_connections
+    """
+    travel_time = graph.path_cost(path)
+    return Journey(path, travel_time, len(path) - 2, 0, travel_time * PRICE_PER_MINUTE)
+
+
+def sort_connections(connections: List[Journey], sort_by: SortingCriteria, is_ascending: bool,
+                     limit: int) -> List[Journey]:
+    """
+    Order the journeys by the given criteria (ties broken by departure time) and keep the first limit ones
+    """
+    key = SORT_KEYS.get(sort_by, "travel_time")
+    ordered = sorted(connections, key=lambda c: (c[key], c.get("departure_time") or 0), reverse=not is_ascending)
+    return ordered[:limit]
+
+
+class ConnectionScan:
+    """
+    Connection Scan Algorithm over a compiled Timetable.
+    A single scan over the connections sorted by departure answers an earliest arrival query,
+    a scan over the connections sorted by arrival (backwards) answers a latest departure query.
+    The connections are read from the arrays in chunks, so a scan stopping early touches only a few of them.
+    Changing train at a station does not require any minimum transfer time.
+    Stations are dense indexes of the timetable, except for journeys which takes and returns station keys.
+    """
+
+    def __init__(self, timetable: Timetable) -> None:
+        self.timetable = timetable
+
+    def _columns(self, indexes, active: Optional[np.ndarray]):
+        timetable = self.timetable
+        columns = [timetable.connection_departures[indexes], timetable.connection_arrivals[indexes],
+                   timetable.connection_from[indexes], timetable.connection_to[indexes],
+                   timetable.connection_trips[indexes], timetable.connection_positions[indexes]]
+        if active is not None:
+            keep = active[columns[4]]
+            columns = [column[keep] for column in columns]
+        return zip(*(column.tolist() for column in columns))
+
+    def _forward_connections(self, departure: int, active: Optional[np.ndarray]):
+        """
+        Yield the connections leaving not before departure by increasing departure
+        """
+        timetable = self.timetable
+        start = int(np.searchsorted(timetable.connection_departures, departure, side="left"))
+        for begin in range(start, timetable.n_connections, SCAN_CHUNK):
+            yield from self._columns(slice(begin, begin + SCAN_CHUNK), active)
+
+    def _backward_connections(self, deadline: int, active: Optional[np.ndarray]):
+        """
+        Yield the connections arriving not after deadline by decreasing arrival
+        """
+        timetable = self.timetable
+        end = int(np.searchsorted(timetable.sorted_arrivals, deadline, side="right"))
+        for stop in range(end, 0, -SCAN_CHUNK):
+            yield from self._columns(timetable.connection_arrival_order[max(stop - SCAN_CHUNK, 0):stop][::-1], active)
+
+    def earliest_arrival(self, source: int, target: int, departure: int,
+                         active: Optional[np.ndarray] = None) -> Optional[List[Leg]]:
+        """
+        Return the legs of the journey reaching target as early as possible leaving source not before departure,
+        None if target cannot be reached
+        """
+        return self.earliest_arrivals(source, [target], departure, active).get(target)
+
+    def earliest_arrivals(self, source: int, targets: List[int], departure: int,
+                          active: Optional[np.ndarray] = None) -> Dict[int, List[Leg]]:
+        """
+        Return the legs of the earliest arrival journeys leaving source not before departure to each of the
+        targets that can be reached. A single scan serves all of them: it stops once every target is reached
+        and the connections leave after the latest of their arrivals
+        """
+        targets = set(targets)
+        if not targets:
+            return {}
+        arrival = [INFINITY] * self.timetable.n_stations
+        arrival[source] = departure
+        boarded = {}
+        reached = {}
+        unreached = len(targets)
+        bound = INFINITY
+        for dep, arr, from_station, to_station, trip, position in self._forward_connections(departure, active):
+            if dep > bound:
+                # Arrivals only improve, the bound may have moved down since it was computed
+                bound = max(arrival[target] for target in targets)
+                if dep > bound:
+                    break
+            if trip not in boarded:
+                if arrival[from_station] > dep:
+                    continue
+                boarded[trip] = position
+            if arr < arrival[to_station]:
+                if to_station in targets and arrival[to_station] == INFINITY:
+                    unreached -= 1
+                    if unreached == 0:
+                        bound = max(arr, max(arrival[target] for target in targets))
+                arrival[to_station] = arr
+                reached[to_station] = (trip, boarded[trip], position + 1)
+        legs_by_target = {}
+        for target in targets:
+            if target not in reached:
+                continue
+            legs = []
+            station = target
+            while station != source:
+                leg = reached[station]
+                legs.append(leg)
+                station = int(self.timetable.stop_stations[self.timetable.trip_stop_offsets[leg[0]] + leg[1]])
+            legs.reverse()
+            legs_by_target[target] = legs
+        return legs_by_target
+
+    def reachable(self, source: int, departure: int, deadline: int,
+                  active: Optional[np.ndarray] = None) -> Dict[int, int]:
+        """
+        Return the earliest arrival at every station reachable from source leaving not before departure
+        and arriving not after deadline. The scan stops at the first connection leaving after the deadline
+        """
+        arrival = {source: departure}
+        boarded = set()
+        for dep, arr, from_station, to_station, trip, _ in self._forward_connections(departure, active):
+            if dep > deadline:
+                break
+            if trip not in boarded:
+                if arrival.get(from_station, INFINITY) > dep:
+                    continue
+                boarded.add(trip)
+            if arr <= deadline and arr < arrival.get(to_station, INFINITY):
+                arrival[to_station] = arr
+        return arrival
+
+    def latest_departure(self, source: int, target: int, deadline: int,
+                         active: Optional[np.ndarray] = None) -> Optional[List[Leg]]:
+        """
+        Return the legs of the journey leaving source as late as possible reaching target not after deadline,
+        None if target cannot be reached
+        """
+        departure = [-INFINITY] * self.timetable.n_stations
+        departure[target] = deadline
+        alighted = {}
+        reached = {}
+        best = -INFINITY
+        for dep, arr, from_station, to_station, trip, position in self._backward_connections(deadline, active):
+            if arr < best:
+                break
+            if trip not in alighted:
+                if departure[to_station] < arr:
+                    continue
+                alighted[trip] = position + 1
+            if dep > departure[from_station]:
+                departure[from_station] = dep
+                reached[from_station] = (trip, position, alighted[trip])
+                if from_station == source:
+                    best = dep
+        if source not in reached:
+            return None
+        legs = []
+        station = source
+        while station != target:
+            leg = reached[station]
+            legs.append(leg)
+            station = int(self.timetable.stop_stations[self.timetable.trip_stop_offsets[leg[0]] + leg[2]])
+        return legs
+
+    def journeys(self, source: int, target: int, day: Optional[date] = None, is_departure_time: bool = True,
+                 limit: int = 5) -> List[Journey]:
+        """
+        Return up to limit journeys between the source and target station keys for the given day as Journeys.
+        With is_departure_time the journeys are the earliest arrival ones departing from the beginning of the day,
+        otherwise the latest departure ones arriving before the end of the day.
+        Each journey departs strictly later (resp. arrives strictly earlier) than the previous one
+        """
+        source = self.timetable.station_index.get(source)
+        target = self.timetable.station_index.get(target)
+        if source is None or target is None:
+            return []
+        active = self.timetable.active_trips(day)
+        results = []
+        if is_departure_time:
+            departure = 0
+            while len(results) < limit:
+                legs = self.earliest_arrival(source, target, departure, active)
+                if legs is None:
+                    break
+                connection = journey_to_connection(self.timetable, legs)
+                results.append(connection)
+                departure = connection["departure_time"] + 1
+        else:
+            deadline = self.timetable.horizon()
+            while len(results) < limit:
+                legs = self.latest_departure(source, target, deadline, active)
+                if legs is None:
+                    break
+                connection = journey_to_connection(self.timetable, legs)
+                results.append(connection)
+                deadline = connection["arrival_time"] - 1
+        return results
+
+    def journeys_many(self, source: int, targets: List[int], day: Optional[date] = None,
+                      limit: int = 5) -> Dict[int, List[Journey]]:
+        """
+        Return, for each of the target station keys, the journeys that journeys (with is_departure_time)
+        returns from the source station key. Every scan serves all the targets waiting for a journey
+        departing after the same time, so the targets share the scans instead of running limit scans each
+        """
+        source = self.timetable.station_index.get(source)
+        results = {target: [] for target in targets}
+        if source is None:
+            return results
+        active = self.timetable.active_trips(day)
+        # Earliest departure of the next journey of each target, by dense index
+        next_departure = {self.timetable.station_index[target]: 0 for target in targets
+                          if target in self.timetable.station_index and limit > 0}
+        next_departure.pop(source, None)
+        while next_departure:
+            departure = min(next_departure.values())
+            legs_by_target = self.earliest_arrivals(source, list(next_departure), departure, active)
+            for target, target_departure in list(next_departure.items()):
+                legs = legs_by_target.get(target)
+                if legs is None:
+                    # Nothing reaches it leaving after departure, nor after its own later departure
+                    del next_departure[target]
+                    continue
+                connection = journey_to_connection(self.timetable, legs)
+                if connection["departure_time"] < target_departure:
+                    # Leaves too early for this target, it is served by a later scan
+                    continue
+                connection_list = results[int(self.timetable.station_ids[target])]
+                connection_list.append(connection)
+                if len(connection_list) == limit:
+                    del next_departure[target]
+                else:
+                    next_departure[target] = connection["departure_time"] + 1
+        return results
+
+
+class Label:
+    """
+    A McRAPTOR label: a way of reaching a stop with the given arrival time, number of trips (rounds),
+    waiting time at interchanges and price, leaving the source at departure (None before the first trip).
+    Within one search every label leaves from the same departure, the departure only matters between the
+    searches of a range query (see Raptor.range_pareto_sets).
+    Journeys are rebuilt following the parent labels
+    """
+    __slots__ = ("arrival", "rounds", "waiting_time", "price", "departure", "parent", "leg")
+
+    def __init__(self, arrival: int, rounds: int, waiting_time: int, price: int, departure: Optional[int] = None,
+                 parent: Optional["Label"] = None, leg: Optional[Leg] = None) -> None:
+        self.arrival = arrival
+        self.rounds = rounds
+        self.waiting_time = waiting_time
+        self.price = price
+        self.departure = departure
+        self.parent = parent
+        self.leg = leg
+
+    def dominates(self, other: "Label") -> bool:
+        return (self.arrival <= other.arrival and self.rounds <= other.rounds
+                and self.waiting_time <= other.waiting_time and self.price <= other.price)
+
+    def legs(self) -> List[Leg]:
+        legs = []
+        label = self
+        while label.leg is not None:
+            legs.append(label.leg)
+            label = label.parent
+        legs.reverse()
+        return legs
+
+
+def insert_label(bag: List[Label], label: Label) -> bool:
+    """
+    Add label to the Pareto bag unless it is dominated, dropping the labels it dominates.
+    Return whether the label was added
+    """
+    for other in bag:
+        if other.dominates(label):
+            return False
+    bag[:] = [other for other in bag if not label.dominates(other)]
+    bag.append(label)
+    return True
+
+
+class Route:
+    """
+    Trips serving the same sequence of stations, sorted by departure.
+    No trip of a route overtakes another one, so the earliest trip leaving a stop is also the earliest arriving
+    """
+
+    def __init__(self, stations: Tuple[int, ...]) -> None:
+        self.stations = stations
+        self.trips: List[int] = []
+        self.trip_departures: List[List[int]] = []
+        self.trip_arrivals: List[List[int]] = []
+        self.departures: List[List[int]] = [[] for _ in stations]
+
+    def accepts(self, departures: List[int], arrivals: List[int]) -> bool:
+        """
+        Whether a trip leaving the first stop after all the others can join the route without overtaking
+        """
+        if not self.trips:
+            return True
+        return (all(a <= b for a, b in zip(self.trip_departures[-1], departures))
+                and all(a <= b for a, b in zip(self.trip_arrivals[-1], arrivals)))
+
+    def add(self, trip: int, departures: List[int], arrivals: List[int]) -> None:
+        self.trips.append(trip)
+        self.trip_departures.append(departures)
+        self.trip_arrivals.append(arrivals)
+        for i, departure in enumerate(departures):
+            self.departures[i].append(departure)
+
+
+class Raptor:
+    """
+    Multi-criteria RAPTOR (McRAPTOR) over a compiled Timetable.
+    Round k scans the routes serving the stops improved in round k-1 and finds the journeys using k trips.
+    Every label is kept in a Pareto bag over arrival time, number of changes, waiting time and price.
+    journeys runs a range query: one search per departure from the source, latest first, so that a later but
+    faster journey is not hidden by an earlier one. The journeys Pareto optimal over departure time too
+    (hence travel time) are optimal for every SortingCriteria, for departing after and arriving before queries
+    """
+
+    def __init__(self, timetable: Timetable, max_transfers: int = 5, fare=time_based_fare,
+                 cache_size: int = 128) -> None:
+        self.timetable = timetable
+        self.max_transfers = max_transfers
+        self.fare = fare
+        self.cache_size = cache_size
+        self._pareto_sets = OrderedDict()
+        # Trips with the same stations share a route, unless they overtake each other
+        self.routes: List[Route] = []
+        routes_by_stations: Dict[Tuple[int, ...], List[Route]] = {}
+        trips = sorted((timetable.trip_departures(trip), timetable.trip_arrivals(trip), trip)
+                       for trip in range(timetable.n_trips))
+        for departures, arrivals, trip in trips:
+            candidates = routes_by_stations.setdefault(tuple(timetable.trip_stations(trip)), [])
+            route = next((route for route in candidates if route.accepts(departures, arrivals)), None)
+            if route is None:
+                route = Route(tuple(timetable.trip_stations(trip)))
+                candidates.append(route)
+                self.routes.append(route)
+            route.add(trip, departures, arrivals)
+        self.routes_by_stop: Dict[int, List[Tuple[int, int]]] = {}
+        for route_id, route in enumerate(self.routes):
+            for position, station in enumerate(route.stations):
+                self.routes_by_stop.setdefault(station, []).append((route_id, position))
+
+    def pareto_set(self, source: int, target: int, departure: int = 0,
+                   active: Optional[np.ndarray] = None) -> List[Label]:
+        """
+        Return the Pareto optimal labels reaching target, leaving source not before departure
+        """
+        return self.pareto_sets(source, [target], departure, active)[target]
+
+    def pareto_sets(self, source: int, targets: List[int], departure: int = 0,
+                    active: Optional[np.ndarray] = None,
+                    seeds: Optional[Dict[int, List[Label]]] = None) -> Dict[int, List[Label]]:
+        """
+        Return the Pareto optimal labels reaching each of the targets, leaving source not before departure.
+        One search serves all the targets, a label is pruned only if it is dominated at every one of them.
+        The bags of the targets start with the seeds, labels leaving later found by previous searches
+        """
+        if isinstance(active, np.ndarray):
+            active = active.tolist()
+        bags: Dict[int, List[Label]] = {target: list(labels) for target, labels in (seeds or {}).items()}
+        bags[source] = [Label(departure, 0, 0, 0)]
+        marked = {source}
+        for k in range(1, self.max_transfers + 2):
+            queue: Dict[int, int] = {}
+            for stop in marked:
+                for route_id, position in self.routes_by_stop.get(stop, ()):
+                    if position < queue.get(route_id, len(self.routes[route_id].stations)):
+                        queue[route_id] = position
+            marked = set()
+            for route_id, start in queue.items():
+                self._scan_route(self.routes[route_id], start, k, bags, marked, targets, active)
+            if not marked:
+                break
+        return {target: bags.get(target, []) for target in targets}
+
+    def _scan_route(self, route: Route, start: int, k: int, bags: Dict[int, List[Label]], marked: set,
+                    targets: List[int], active: Optional[List[bool]]) -> None:
+        # Route labels: (trip index in the route, boarding position, waiting time, price, departure, parent label)
+        route_bag = []
+        target_bags = [bags.setdefault(target, []) for target in targets]
+        for i in range(start, len(route.stations)):
+            stop = route.stations[i]
+            for trip_index, board, waiting_time, price, departure, parent in route_bag:
+                trip = route.trips[trip_index]
+                label = Label(route.trip_arrivals[trip_index][i], k, waiting_time,
+                              price + self.fare(self.timetable, trip, board, i), departure, parent,
+                              (trip, board, i))
+                if all(any(other.dominates(label) for other in target_bag) for target_bag in target_bags):
+                    continue
+                if insert_label(bags.setdefault(stop, []), label):
+                    marked.add(stop)
+            if i == len(route.stations) - 1:
+                break
+            for label in bags.get(stop, ()):
+                if label.rounds != k - 1:
+                    continue
+                trip_index = self._earliest_trip(route, i, label.arrival, active)
+                if trip_index is None:
+                    continue
+                # Waiting at the source before the first train is not an interchange
+                waiting_time = label.waiting_time
+                departure = label.departure
+                if k > 1:
+                    waiting_time += route.trip_departures[trip_index][i] - label.arrival
+                else:
+                    departure = route.trip_departures[trip_index][i]
+                if not any(other[0] == trip_index and other[1] == i and other[2] <= waiting_time
+                           and other[3] <= label.price for other in route_bag):
+                    route_bag.append((trip_index, i, waiting_time, label.price, departure, label))
+
+    @staticmethod
+    def _earliest_trip(route: Route, position: int, arrival: int, active: Optional[List[bool]]) -> Optional[int]:
+        """
+        Return the index of the earliest active trip of route leaving position not before arrival
+        """
+        for trip_index in range(bisect_left(route.departures[position], arrival), len(route.trips)):
+            if active is None or active[route.trips[trip_index]]:
+                return trip_index
+        return None
+
+    def range_pareto_sets(self, source: int, targets: List[int],
+                          active: Optional[np.ndarray] = None) -> Dict[int, List[Label]]:
+        """
+        Return the labels reaching each of the targets that are Pareto optimal over departure time, arrival time,
+        changes, waiting time and price. One search per departure of an active trip from the source, latest
+        first: the labels found by the later searches seed the target bags of the earlier ones and prune every
+        label they dominate, since those leave earlier too
+        """
+        if isinstance(active, np.ndarray):
+            active = active.tolist()
+        departures = sorted({departure
+                             for route_id, position in self.routes_by_stop.get(source, ())
+                             for trip, departure in zip(self.routes[route_id].trips,
+                                                        self.routes[route_id].departures[position])
+                             if active is None or active[trip]}, reverse=True)
+        found: Dict[int, List[Label]] = {target: [] for target in targets}
+        for departure in departures:
+            bags = self.pareto_sets(source, targets, departure, active, found)
+            # The new labels are not dominated by the seeds, and leave earlier than all of them
+            for target in targets:
+                found[target] += [label for label in bags[target] if label.departure == departure]
+        return found
+
+    @staticmethod
+    def _window(journeys: List[Journey], is_departure_time: bool, limit: Optional[int]) -> List[Journey]:
+        """
+        Keep the journeys leaving at the limit first departure times (resp. arriving at the limit last arrival
+        times), like ConnectionScan.journeys, together with all their Pareto optimal alternatives
+        """
+        if is_departure_time:
+            times = sorted({journey.departure_time for journey in journeys})[:limit]
+            kept = [journey for journey in journeys if journey.departure_time in times]
+        else:
+            times = sorted({journey.arrival_time for journey in journeys}, reverse=True)[:limit]
+            kept = [journey for journey in journeys if journey.arrival_time in times]
+        return journeys if len(kept) == len(journeys) else kept
+
+    def journeys(self, source: int, target: int, day: Optional[date] = None, is_departure_time: bool = True,
+                 limit: Optional[int] = 5) -> List[Journey]:
+        """
+        Return the Pareto optimal journeys between the source and target station keys for the given day as
+        Journeys, ordered by departure. With is_departure_time they are the ones leaving at the limit earliest
+        departure times, otherwise the ones arriving at the limit latest arrival times (None for all of them).
+        All the Pareto optimal journeys at these times are returned, so that they can be ordered by any
+        SortingCriteria. The Pareto set of each (source, target, day) is cached, switching criteria does not
+        search again
+        """
+        return self._window(self._journeys_many(source, [target], day)[target], is_departure_time, limit)
+
+    def journeys_many(self, source: int, targets: List[int], day: Optional[date] = None,
+                      limit: Optional[int] = 5) -> Dict[int, List[Journey]]:
+        """
+        Return, for each of the target station keys, the journeys that journeys (with is_departure_time)
+        returns from the source station key. The targets whose Pareto set is not cached are all served by the
+        same range query
+        """
+        return {target: self._window(journeys, True, limit)
+                for target, journeys in self._journeys_many(source, targets, day).items()}
+
+    def _journeys_many(self, source: int, targets: List[int], day: Optional[date]) -> Dict[int, List[Journey]]:
+        results = {}
+        missing = []
+        for target in targets:
+            key = (source, target, day)
+            if key in self._pareto_sets:
+                self._pareto_sets.move_to_end(key)
+                results[target] = self._pareto_sets[key]
+            elif target not in missing:
+                missing.append(target)
+        if not missing:
+            return results
+        source_index = self.timetable.station_index.get(source)
+        target_indexes = {target: self.timetable.station_index.get(target) for target in missing}
+        searched = [index for index in target_indexes.values() if index is not None and index != source_index]
+        labels = {}
+        if source_index is not None and searched:
+            labels = self.range_pareto_sets(source_index, searched, self.timetable.active_trips(day))
+        for target in missing:
+            connections = sorted((journey_to_connection(self.timetable, label.legs(), self.fare)
+                                  for label in labels.get(target_indexes[target], [])),
+                                 key=lambda journey: (journey.departure_time, journey.arrival_time))
+            self._pareto_sets[(source, target, day)] = connections
+            results[target] = connections
+        while len(self._pareto_sets) > self.cache_size:
+            self._pareto_sets.popitem(last=False)
+        return results
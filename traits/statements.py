@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from weakref import WeakKeyDictionary
+
+from traits.cache import LRUCache
+
+# Statements that EXPLAIN can plan, besides INSERT ... SELECT
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE")
+
+
+def redact(params: Sequence) -> Tuple:
+    """
+    Return the parameters with their strings (emails, password hashes, ...) emptied, the other values kept
+    so that the plans still see their types
+    """
+    return tuple("" if isinstance(param, str) else b"" if isinstance(param, bytes) else param for param in params)
+
+
+class StatementRegistry:
+    """
+    Runs the parameterized SQL statements (%s placeholders) of Traits as server-side prepared statements.
+    Each connection gets one prepared cursor per statement text, kept across calls: MariaDB parses the
+    statement once and every later execution only sends its parameters.
+    Drivers without prepared cursors (PyMySQL) get plain cursors and send the parameters escaped client-side.
+    At most maxsize statements stay prepared per connection, the least recently used ones are closed.
+    The last parameters of the statements are kept, redacted, so that full_scans can EXPLAIN what actually ran
+    """
+
+    def __init__(self, maxsize: int = 256) -> None:
+        if maxsize <= 0:
+            raise ValueError("The number of prepared statements must be greater than 0")
+        self.maxsize = maxsize
+        # connection -> statement -> (the statement string the cursor was prepared with, cursor)
+        self._cursors: "WeakKeyDictionary[Any, OrderedDict]" = WeakKeyDictionary()
+        self._lock = Lock()
+        # statement -> redacted parameters of its last execution
+        self.samples = LRUCache(maxsize * 4)
+        self.prepared = 0
+        self.executions = 0
+        self.closed = 0
+
+    def cursor(self, connection, statement: str) -> Tuple[str, Any]:
+        """
+        Return the prepared cursor of the statement on the connection, preparing it if needed, together with
+        the statement string to execute it with (the cursors only reuse their handle for that very object)
+        """
+        with self._lock:
+            cursors = self._cursors.get(connection)
+            if cursors is None:
+                cursors = self._cursors[connection] = OrderedDict()
+            entry = cursors.get(statement)
+            if entry is not None:
+                cursors.move_to_end(statement)
+                return entry
+            try:
+                cur = connection.cursor(prepared=True)
+            except TypeError:
+                cur = connection.cursor()
+            entry = cursors[statement] = (statement, cur)
+            self.prepared += 1
+            while len(cursors) > self.maxsize:
+                _, (_, evicted) = cursors.popitem(last=False)
+                evicted.close()
+                self.closed += 1
+            return entry
+
+    def execute(self, connection, statement: str, params: Sequence = ()) -> Any:
+        """
+        Execute the statement and return its cursor, to read rowcount or lastrowid.
+        The rows of a query must be read before the next statement runs on the connection, see fetchall
+        """
+        statement, cur = self.cursor(connection, statement)
+        cur.execute(statement, tuple(params))
+        self.executions += 1
+        self.samples.put(statement, redact(params))
+        return cur
+
+    def executemany(self, connection, statement: str, rows: List[Sequence]) -> Any:
+        statement, cur = self.cursor(connection, statement)
+        cur.executemany(statement, [tuple(row) for row in rows])
+        self.executions += len(rows)
+        if rows:
+            self.samples.put(statement, redact(rows[-1]))
+        return cur
+
+    def fetchall(self, connection, statement: str, params: Sequence = ()) -> List[Tuple]:
+        return self.execute(connection, statement, params).fetchall()
+
+    def bound(self, connection) -> "BoundStatements":
+        """
+        Return a cursor-like view of the registry on the connection, for the loaders taking a DB-API cursor
+        """
+        return BoundStatements(self, connection)
+
+    def fetchone(self, connection, statement: str, params: Sequence = ()) -> Optional[Tuple]:
+        """
+        Return the first row of the query, the other rows are read and dropped so the cursor can be reused
+        """
+        rows = self.fetchall(connection, statement, params)
+        return rows[0] if rows else None
+
+    def full_scans(self, connection, expected: Iterable[str] = ()) -> List[Tuple[str, Dict]]:
+        """
+        EXPLAIN every statement run so far with its last (redacted) parameters and return (statement, plan row) for each
+        table the plans read in full (access type ALL), derived tables aside.
+        The expected statements (the ones returning whole tables) are not checked
+        """
+        expected = {" ".join(statement.split()) for statement in expected}
+        scans = []
+        cur = connection.cursor()
+        try:
+            for statement, params in self.samples.items():
+                words = statement.upper().split()
+                if " ".join(statement.split()) in expected or \
+                        not (words[0] in EXPLAINABLE or words[0] == "INSERT" and "SELECT" in words):
+                    continue
+                cur.execute("EXPLAIN " + statement, params)
+                columns = [column[0] for column in cur.description]
+                for row in cur.fetchall():
+                    plan = dict(zip(columns, row))
+                    if plan.get("type") == "ALL" and not str(plan.get("table", "")).startswith("<"):
+                        scans.append((statement, plan))
+        finally:
+            cur.close()
+        return scans
+
+    def close(self, connection) -> None:
+        """
+        Close the prepared statements of the connection, before closing or giving the connection back
+        """
+        with self._lock:
+            cursors = self._cursors.pop(connection, None) or {}
+            for _, cur in cursors.values():
+                cur.close()
+            self.closed += len(cursors)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "connections": len(self._cursors),
+                "statements": sum(len(cursors) for cursors in self._cursors.values()),
+                "prepared": self.prepared,
+                "executions": self.executions,
+                "closed": self.closed,
+            }
+
+
+class BoundStatements:
+    """
+    The execute/fetchall/close subset of a DB-API cursor, running the statements through a StatementRegistry
+    """
+
+    def __init__(self, registry: StatementRegistry, connection) -> None:
+        self.registry = registry
+        self.connection = connection
+        self._rows: List[Tuple] = []
+
+    def execute(self, statement: str, params: Sequence = ()) -> None:
+        self._rows = self.registry.fetchall(self.connection, statement, params)
+
+    def fetchall(self) -> List[Tuple]:
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self) -> None:
+        self._rows = []
@@ -0,0 +1,326 @@
+from datetime import date, time, timedelta
+from typing import List, Tuple, Optional, Dict, Iterable
+import json
+import mmap
+import os
+import struct
+from uuid import uuid4
+
+import numpy as np
+
+# Snapshot file layout: magic, format version and header length, a JSON header (generation and the
+# offset/length of every array) and the little-endian arrays, each aligned on SNAPSHOT_ALIGNMENT bytes
+SNAPSHOT_MAGIC = b"TRAITSTT"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PREAMBLE = struct.Struct("<8sII")
+SNAPSHOT_ALIGNMENT = 64
+
+
+def to_minutes(value) -> int:
+    """
+    Convert a TIME value as returned by the MariaDB drivers (timedelta, time or 'HH:MM[:SS]' string)
+    into minutes since midnight
+    """
+    if isinstance(value, timedelta):
+        return int(value.total_seconds()) // 60
+    if isinstance(value, time):
+        return value.hour * 60 + value.minute
+    if isinstance(value, str):
+        parts = value.split(":")
+        return int(parts[0]) * 60 + int(parts[1])
+    raise ValueError(f"Cannot convert {value!r} to minutes")
+
+
+class Trip:
+    """
+    A single run of a schedule, as read from the database. Times are minutes since midnight of the
+    service day and may exceed 1440 for trips running past midnight.
+    The train waits waiting_time minutes at every stop (the first one included) before leaving it.
+    """
+
+    def __init__(self, schedule_id: int, train_id: int, valid_from: date, valid_until: date,
+                 stations: List[int], arrivals: List[int], departures: List[int]) -> None:
+        self.schedule_id = schedule_id
+        self.train_id = train_id
+        self.valid_from = valid_from
+        self.valid_until = valid_until
+        self.stations = stations
+        self.arrivals = arrivals
+        self.departures = departures
+
+
+class Timetable:
+    """
+    Timetable compiled into NumPy arrays.
+    Stations are identified by a dense index (station_ids maps it back to the station key, station_index
+    the other way round) and trips by their position in the trip arrays.
+
+    Trip arrays: trip_schedule_ids, trip_train_ids, trip_valid_from, trip_valid_until (date ordinals)
+    and trip_stop_offsets, the CSR index of the stops of each trip in the stop arrays.
+    Stop arrays: stop_stations, stop_arrivals, stop_departures.
+    Connection arrays, one entry per pair of consecutive stops sorted by departure: connection_departures,
+    connection_arrivals, connection_from, connection_to, connection_trips and connection_positions
+    (position of the departure stop inside the trip). connection_arrival_order sorts them by arrival.
+    """
+
+    ARRAYS = {
+        "station_ids": np.int64,
+        "trip_schedule_ids": np.int64,
+        "trip_train_ids": np.int64,
+        "trip_valid_from": np.int32,
+        "trip_valid_until": np.int32,
+        "trip_stop_offsets": np.int32,
+        "stop_stations": np.int32,
+        "stop_arrivals": np.int32,
+        "stop_departures": np.int32,
+        "connection_departures": np.int32,
+        "connection_arrivals": np.int32,
+        "connection_from": np.int32,
+        "connection_to": np.int32,
+        "connection_trips": np.int32,
+        "connection_positions": np.int32,
+        "connection_arrival_order": np.int32,
+    }
+
+    def __init__(self, arrays: Dict[str, np.ndarray], generation: Optional[str] = None) -> None:
+        # Stamp of the database content the timetable was compiled from, see timetable_generation
+        self.generation = generation
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.station_index: Dict[int, int] = {key: index for index, key in enumerate(self.station_ids.tolist())}
+        self.schedule_index: Dict[int, int] = {key: index for index, key in enumerate(self.trip_schedule_ids.tolist())}
+        self._sorted_arrivals = None
+
+    @property
+    def n_stations(self) -> int:
+        return len(self.station_ids)
+
+    @property
+    def n_trips(self) -> int:
+        return len(self.trip_schedule_ids)
+
+    @property
+    def n_connections(self) -> int:
+        return len(self.connection_departures)
+
+    @property
+    def sorted_arrivals(self) -> np.ndarray:
+        if self._sorted_arrivals is None:
+            self._sorted_arrivals = self.connection_arrivals[self.connection_arrival_order]
+        return self._sorted_arrivals
+
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def trip_stops(self, trip: int) -> slice:
+        return slice(int(self.trip_stop_offsets[trip]), int(self.trip_stop_offsets[trip + 1]))
+
+    def trip_stations(self, trip: int) -> List[int]:
+        return self.stop_stations[self.trip_stops(trip)].tolist()
+
+    def trip_arrivals(self, trip: int) -> List[int]:
+        return self.stop_arrivals[self.trip_stops(trip)].tolist()
+
+    def trip_departures(self, trip: int) -> List[int]:
+        return self.stop_departures[self.trip_stops(trip)].tolist()
+
+    def active_trips(self, day: Optional[date]) -> Optional[np.ndarray]:
+        """
+        Return the mask of the trips running on the given day, None if all of them do (no day given)
+        """
+        if day is None:
+            return None
+        ordinal = day.toordinal()
+        return (self.trip_valid_from <= ordinal) & (ordinal <= self.trip_valid_until)
+
+    def service_days(self) -> List[date]:
+        """
+        Return the first day of each validity period with a running trip. The same trips run on every day
+        of a period, which ends where a trip starts or stops running
+        """
+        changes = np.unique(np.concatenate([self.trip_valid_from, self.trip_valid_until + 1])).tolist()
+        return [date.fromordinal(day) for day in changes
+                if ((self.trip_valid_from <= day) & (day <= self.trip_valid_until)).any()]
+
+    def horizon(self) -> int:
+        """
+        Return the latest arrival time of the timetable
+        """
+        return int(self.connection_arrivals.max()) if self.n_connections else 0
+
+
+def compile_timetable(trips: Iterable[Trip]) -> Timetable:
+    """
+    Compile the trips into the arrays of a Timetable, translating the station keys to dense indexes once
+    """
+    trips = sorted(trips, key=lambda trip: trip.schedule_id)
+    station_ids = sorted({station for trip in trips for station in trip.stations})
+    station_index = {key: index for index, key in enumerate(station_ids)}
+
+    offsets = np.zeros(len(trips) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum([len(trip.stations) for trip in trips])
+    stop_stations = np.array([station_index[station] for trip in trips for station in trip.stations], dtype=np.int32)
+    stop_arrivals = np.array([minutes for trip in trips for minutes in trip.arrivals], dtype=np.int32)
+    stop_departures = np.array([minutes for trip in trips for minutes in trip.departures], dtype=np.int32)
+
+    # Every stop but the last one of each trip starts a connection towards the next stop
+    stop_trips = np.repeat(np.arange(len(trips), dtype=np.int32), np.diff(offsets))
+    starts = np.ones(len(stop_stations), dtype=bool)
+    starts[offsets[1:] - 1] = False
+    first_stops = np.flatnonzero(starts)
+    departures = stop_departures[first_stops]
+    arrivals = stop_arrivals[first_stops + 1]
+    order = np.lexsort((arrivals, departures))
+    first_stops = first_stops[order]
+    connection_trips = stop_trips[first_stops]
+
+    arrays = {
+        "station_ids": np.array(station_ids, dtype=np.int64),
+        "trip_schedule_ids": np.array([trip.schedule_id for trip in trips], dtype=np.int64),
+        "trip_train_ids": np.array([trip.train_id for trip in trips], dtype=np.int64),
+        "trip_valid_from": np.array([trip.valid_from.toordinal() for trip in trips], dtype=np.int32),
+        "trip_valid_until": np.array([trip.valid_until.toordinal() for trip in trips], dtype=np.int32),
+        "trip_stop_offsets": offsets,
+        "stop_stations": stop_stations,
+        "stop_arrivals": stop_arrivals,
+        "stop_departures": stop_departures,
+        "connection_departures": departures[order],
+        "connection_arrivals": arrivals[order],
+        "connection_from": stop_stations[first_stops],
+        "connection_to": stop_stations[first_stops + 1],
+        "connection_trips": connection_trips,
+        "connection_positions": (first_stops - offsets[connection_trips]).astype(np.int32),
+    }
+    arrays["connection_arrival_order"] = np.lexsort((arrays["connection_departures"],
+                                                     arrays["connection_arrivals"])).astype(np.int32)
+    return Timetable({name: np.ascontiguousarray(array, dtype=Timetable.ARRAYS[name])
+                      for name, array in arrays.items()})
+
+
+def load_trips(cursor) -> List[Trip]:
+    """
+    Read the schedules, schedule_stops and connections tables (one query each) and rebuild the trips.
+    Travel times between consecutive stops are taken from connections (the fastest one if the stations
+    are connected more than once)
+    """
+    cursor.execute("""
+        SELECT start_station_id, end_station_id, MIN(travel_time_minutes)
+        FROM connections
+        GROUP BY start_station_id, end_station_id
+    """)
+    travel_times = {(start, end): minutes for start, end, minutes in cursor.fetchall()}
+
+    cursor.execute("SELECT id, train_id, departure_time, departure_date, arrival_date FROM schedules")
+    schedules = cursor.fetchall()
+
+    cursor.execute("SELECT schedule_id, station_id, waiting_time FROM schedule_stops ORDER BY schedule_id, stop_order")
+    stops: Dict[int, List[Tuple[int, int]]] = {}
+    for schedule_id, station_id, waiting_time in cursor.fetchall():
+        stops.setdefault(schedule_id, []).append((station_id, waiting_time))
+
+    trips = []
+    for schedule_id, train_id, departure_time, valid_from, valid_until in schedules:
+        schedule_stops = stops.get(schedule_id, [])
+        if len(schedule_stops) < 2:
+            continue
+        stations, arrivals, departures = [], [], []
+        clock = to_minutes(departure_time)
+        for i, (station_id, waiting_time) in enumerate(schedule_stops):
+            if i > 0:
+                minutes = travel_times.get((stations[-1], station_id))
+                if minutes is None:
+                    # The connection was removed, the trip cannot run anymore
+                    break
+                clock += minutes
+            stations.append(station_id)
+            arrivals.append(clock)
+            clock += waiting_time
+            departures.append(clock)
+        else:
+            trips.append(Trip(schedule_id, train_id, valid_from, valid_until, stations, arrivals, departures))
+    return trips
+
+
+def timetable_generation(cursor) -> str:
+    """
+    Return a stamp of the content of the tables the timetable is compiled from. It changes whenever
+    one of them does, so that a snapshot compiled from an older content can be detected
+    """
+    cursor.execute("CHECKSUM TABLE schedules, schedule_stops, connections")
+    return ",".join(f"{table.split('.')[-1]}:{checksum}" for table, checksum in cursor.fetchall())
+
+
+def load_timetable(cursor, generation: Optional[str] = None) -> Timetable:
+    """
+    Build the compiled timetable from the schedules, schedule_stops and connections tables,
+    stamped with their generation (read from the database unless given)
+    """
+    if generation is None:
+        generation = timetable_generation(cursor)
+    timetable = compile_timetable(load_trips(cursor))
+    timetable.generation = generation
+    return timetable
+
+
+def save_timetable(timetable: Timetable, path: str) -> None:
+    """
+    Write the timetable to a snapshot file that open_timetable can map back into memory.
+    The file is written next to its destination and renamed over it, so that concurrent readers
+    either see the previous snapshot or the complete new one
+    """
+    header = {"generation": timetable.generation, "arrays": {}}
+    offset = 0
+    for name, dtype in Timetable.ARRAYS.items():
+        array = getattr(timetable, name)
+        offset = -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+        header["arrays"][name] = [offset, len(array)]
+        offset += len(array) * np.dtype(dtype).itemsize
+    encoded = json.dumps(header).encode()
+    data_start = -(-(SNAPSHOT_PREAMBLE.size + len(encoded)) // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+    # Unique per writer: the threads of a process may save the same snapshot at once
+    temporary = f"{path}.{os.getpid()}.{uuid4().hex}.tmp"
+    try:
+        with open(temporary, "wb") as file:
+            file.write(SNAPSHOT_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(encoded)))
+            file.write(encoded)
+            for name, dtype in Timetable.ARRAYS.items():
+                file.seek(data_start + header["arrays"][name][0])
+                file.write(np.ascontiguousarray(getattr(timetable, name),
+                                                dtype=np.dtype(dtype).newbyteorder("<")).tobytes())
+            file.truncate(data_start + -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def open_timetable(path: str, generation: Optional[str] = None) -> Optional[Timetable]:
+    """
+    Map a snapshot written by save_timetable into memory. The arrays are read-only views of the file,
+    shared through the page cache by every process opening it.
+    Return None if the file is missing, unreadable or was compiled for another generation
+    """
+    try:
+        with open(path, "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, version, header_length = SNAPSHOT_PREAMBLE.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        header = json.loads(buffer[SNAPSHOT_PREAMBLE.size:SNAPSHOT_PREAMBLE.size + header_length])
+        if generation is not None and header["generation"] != generation:
+            return None
+        data_start = -(-(SNAPSHOT_PREAMBLE.size + header_length) // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+        arrays = {}
+        for name, dtype in Timetable.ARRAYS.items():
+            offset, length = header["arrays"][name]
+            arrays[name] = np.frombuffer(buffer, dtype=np.dtype(dtype).newbyteorder("<"), count=length,
+                                         offset=data_start + offset)
+    except (struct.error, ValueError, KeyError, TypeError):
+        buffer.close()
+        return None
+    return Timetable(arrays, header["generation"])